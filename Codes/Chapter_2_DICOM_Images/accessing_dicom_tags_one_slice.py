@@ -23,9 +23,13 @@ def read_tags(input_file,plot=True):
     reader.SetImageIO(gdcmImageIO)  
 
 
-    # Read the image
+    # Read the image; without a plot only the header is needed, so the pixel data is not decoded
     try:
-        reader.Update()
+        if plot:
+            reader.Update()
+        else:
+            gdcmImageIO.SetFileName(input_file)
+            gdcmImageIO.ReadImageInformation()
     except Exception as e:
         print("Exception in file reader:", e)
         
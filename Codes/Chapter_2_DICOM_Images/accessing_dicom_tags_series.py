@@ -7,34 +7,35 @@
 # All the dicom files names in one dicom series can be obtained
 # using GDCMSeriesFileNames class and GetInputFileNames() method.
 
-import itk
+import argparse
 
-def read_series_of_slices_tags(input_dir):
-    # Setup the image readers with their type
-    PixelType = itk.ctype("signed short")
-    Dimension = 3
+import itk
 
-    ImageType = itk.Image[PixelType, Dimension]
+from dicom_series_index import add_index_arguments, index_from_args
 
-    # Using GDCMSeriesFileNames to generate the names of
-    # DICOM files.
-    namesGenerator = itk.GDCMSeriesFileNames.New()
-    namesGenerator.SetUseSeriesDetails(True)
-    namesGenerator.SetDirectory(input_dir)
+def read_series_of_slices_tags(input_dir, index=None):
+    if index is not None:
+        # The names come from the DICOM index, in the order GDCMSeriesFileNames would give them
+        fileNames = index.file_names(input_dir)
+    else:
+        # Using GDCMSeriesFileNames to generate the names of
+        # DICOM files.
+        namesGenerator = itk.GDCMSeriesFileNames.New()
+        namesGenerator.SetUseSeriesDetails(True)
+        namesGenerator.SetDirectory(input_dir)
 
-    # Get the names of files
-    fileNames = namesGenerator.GetInputFileNames()
+        # Get the names of files
+        fileNames = namesGenerator.GetInputFileNames()
 
-    # Setup the image series reader using GDCMImageIO
-    reader = itk.ImageSeriesReader[ImageType].New()
+    # Only the tags are printed, so only the header of the last slice is read (the one the
+    # series reader's ImageIO would hold after reading the whole series), not the pixel data
     dicomIO = itk.GDCMImageIO.New()
     dicomIO.LoadPrivateTagsOn()
-    reader.SetImageIO(dicomIO)
-    reader.SetFileNames(fileNames)
 
-    # Attempt to read the series, exit if unable to.
+    # Attempt to read the header, exit if unable to.
     try:
-        reader.Update()
+        dicomIO.SetFileName(fileNames[-1])
+        dicomIO.ReadImageInformation()
     except:
         print("Error occured while reading DICOMs in: " + input_dir)
 
@@ -64,5 +65,14 @@ def read_series_of_slices_tags(input_dir):
             tagvalue = metadata[entryID]
             print(label[1] + " (" + entryID + ") is: " + str(tagvalue))
 
-input_dir = "./images/DICOMSeries"
-read_series_of_slices_tags(input_dir=input_dir)        
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description="Print the DICOM tags of a series of slices.")
+    parser.add_argument("-i", "--input_dir", default="./images/DICOMSeries", help="Directory holding the DICOM series.")
+    add_index_arguments(parser)
+
+    args = parser.parse_args()
+    read_series_of_slices_tags(input_dir=args.input_dir, index=index_from_args(args, args.input_dir))
+
+
+if __name__ == "__main__":
+    main()        
\ No newline at end of file
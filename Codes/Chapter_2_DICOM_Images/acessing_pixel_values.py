@@ -1,8 +1,16 @@
 #Note that these two methods are
 #relatively slow and should not be used in situations where high-performance access is required.
 #Image iterators are the appropriate mechanism to efficiently access image pixel data. 
+#From Python, the helpers in common/pixel_access.py read, write and locate many
+#pixels at once through a NumPy view of the image buffer.
 
 import itk
+import numpy as np
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pixel_access import get_pixels, index_to_physical_points, mask_to_indices, physical_points_to_index, set_pixels
 
 # reading the input image
 input_file = './images/DICOM'
@@ -35,4 +43,20 @@ new_pixel_value = 255
 image.SetPixel(pixel_index, new_pixel_value)
 
 # Verify the change
-print(f"New pixel value at {pixel_index}: {image.GetPixel(pixel_index)}")
\ No newline at end of file
+print(f"New pixel value at {pixel_index}: {image.GetPixel(pixel_index)}")
+
+# The same for many pixels in one call: an (N, 2) array of indices, x first like itk.Index
+indices = np.array([[0, 0], [1, 0], [0, 1]])
+print(f"Pixel values at {indices.tolist()}: {get_pixels(image, indices)}")
+set_pixels(image, [10, 20, 30], indices)
+print(f"New pixel values: {get_pixels(image, indices)}")
+
+# Physical points of the indices and back, like TransformIndexToPhysicalPoint / TransformPhysicalPointToIndex
+points = index_to_physical_points(image, indices)
+print(f"Physical points: {points.tolist()}")
+print(f"Indices of the points: {physical_points_to_index(image, points).tolist()}")
+
+# Every pixel above the mean, with its index
+pixels = itk.array_view_from_image(image)
+mask = pixels > pixels.mean()
+print(f"{mask.sum()} pixels above the mean, the first at {mask_to_indices(image, mask)[:1].tolist()}")
@@ -0,0 +1,269 @@
+# Persistent SQLite index of the DICOM files in a directory.
+#
+# GDCMSeriesFileNames re-reads every file of a directory each time it is
+# asked for the series in it. The index keeps the header fields needed to
+# group and order series (UIDs, instance number, position, orientation and the
+# series-detail tags) per file, keyed by path together with the file's size
+# and mtime. refresh() only re-parses files that are new or whose size or
+# mtime changed, and drops the rows of deleted files. Headers are read with
+# GDCMImageIO.ReadImageInformation(), which skips the pixel data, in a
+# process pool.
+#
+# series_uids() and file_names() follow GDCMSeriesFileNames: the same series
+# identifiers (with SetUseSeriesDetails and AddSeriesRestriction), sorted the
+# same way, and files ordered by image position along the slice normal, then
+# by instance number, then by file name.
+#
+#   python dicom_series_index.py -i ./images/DICOMSeries
+
+import argparse
+import os
+import re
+import sqlite3
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import itk
+
+DEFAULT_INDEX = './cache/dicom_index.sqlite'
+
+# Bumped whenever the table layout changes; older index files are rebuilt
+SCHEMA_VERSION = 1
+
+TAG_COLUMNS = {
+    '0020|000d': 'study_uid',
+    '0020|000e': 'series_uid',
+    '0008|0018': 'instance_uid',
+    '0020|0013': 'instance_number',
+    '0020|0032': 'position',
+    '0020|0037': 'orientation',
+    '0020|0011': 'series_number',
+    '0018|0024': 'sequence_name',
+    '0018|0050': 'slice_thickness',
+    '0028|0010': 'rows',
+    '0028|0011': 'columns',
+    '0008|0021': 'series_date',
+    '0008|0060': 'modality',
+}
+
+# Tags GDCMSeriesFileNames appends to the series UID with SetUseSeriesDetails(True)
+SERIES_DETAIL_TAGS = ['0020|0011', '0018|0024', '0018|0050', '0028|0010', '0028|0011']
+
+# Below this many changed files the headers are read in this process
+MIN_PARALLEL_FILES = 64
+
+
+def read_header(path):
+    # Header fields of one file, or None for files GDCM cannot read
+    dicom_io = itk.GDCMImageIO.New()
+    if not dicom_io.CanReadFile(path):
+        return None
+    dicom_io.SetFileName(path)
+    try:
+        dicom_io.ReadImageInformation()
+    except RuntimeError:
+        return None
+    metadata = dicom_io.GetMetaDataDictionary()
+    return {column: metadata[tag].strip() if metadata.HasKey(tag) else None for tag, column in TAG_COLUMNS.items()}
+
+
+def read_headers(paths):
+    return [read_header(path) for path in paths]
+
+
+def series_identifier(row, use_series_details=True, restrictions=()):
+    # Same identifier as gdcm::SerieHelper::CreateUniqueSeriesIdentifier
+    uid = row['series_uid']
+    identifier = uid
+    tags = (SERIES_DETAIL_TAGS if use_series_details else []) + list(restrictions)
+    for tag in tags:
+        value = row[TAG_COLUMNS[tag]] or ''
+        if identifier == uid and value:
+            identifier += '.'
+        identifier += value
+    return re.sub(r'[^.a-zA-Z0-9]', '', identifier)
+
+
+def _floats(value, count):
+    try:
+        numbers = [float(v) for v in value.split('\\')]
+    except (AttributeError, ValueError):
+        return None
+    return numbers if len(numbers) == count else None
+
+
+def _position_order(rows):
+    # Distance of every slice along the normal of the first slice's orientation
+    orientation = _floats(rows[0]['orientation'], 6)
+    if orientation is None:
+        return None
+    r, c = orientation[:3], orientation[3:]
+    normal = [r[1] * c[2] - r[2] * c[1], r[2] * c[0] - r[0] * c[2], r[0] * c[1] - r[1] * c[0]]
+    distances = []
+    for row in rows:
+        position = _floats(row['position'], 3)
+        if position is None:
+            return None
+        distances.append(sum(n * p for n, p in zip(normal, position)))
+    # Slices sharing a position cannot be ordered by it
+    if len(set(distances)) != len(distances):
+        return None
+    return [row for _, row in sorted(zip(distances, rows), key=lambda pair: pair[0])]
+
+
+def _instance_number_order(rows):
+    try:
+        numbers = [int(row['instance_number']) for row in rows]
+    except (TypeError, ValueError):
+        return None
+    if len(rows) > 1 and min(numbers) == max(numbers):
+        return None
+    return [row for _, row in sorted(zip(numbers, rows), key=lambda pair: pair[0])]
+
+
+def order_series(rows):
+    # gdcm::SerieHelper::OrderFileList: image position, then instance number, then file name
+    return _position_order(rows) or _instance_number_order(rows) or sorted(rows, key=lambda row: row['path'])
+
+
+class DicomSeriesIndex:
+    def __init__(self, index_path=DEFAULT_INDEX):
+        self.index_path = index_path
+        os.makedirs(os.path.dirname(index_path) or '.', exist_ok=True)
+        self._db = sqlite3.connect(index_path)
+        self._db.row_factory = sqlite3.Row
+        # Readers can use the index while another job refreshes it
+        self._db.execute('PRAGMA journal_mode=WAL')
+        if self._db.execute('PRAGMA user_version').fetchone()[0] != SCHEMA_VERSION:
+            self._create_tables()
+
+    def _create_tables(self):
+        tag_columns = ', '.join(f'{column} TEXT' for column in TAG_COLUMNS.values())
+        with self._db:
+            self._db.execute('DROP TABLE IF EXISTS files')
+            # is_dicom = 0 keeps unreadable files from being parsed again on every refresh
+            self._db.execute(f'CREATE TABLE files (path TEXT PRIMARY KEY, directory TEXT NOT NULL, size INTEGER NOT NULL, '
+                             f'mtime_ns INTEGER NOT NULL, is_dicom INTEGER NOT NULL, {tag_columns})')
+            self._db.execute('CREATE INDEX files_directory ON files (directory)')
+            self._db.execute('CREATE INDEX files_series_uid ON files (series_uid)')
+            self._db.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+
+    def _scope(self, directory, recursive):
+        directory = os.path.abspath(directory)
+        if recursive:
+            pattern = directory.rstrip(os.sep).replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + os.sep + '%'
+            return "(directory = ? OR directory LIKE ? ESCAPE '\\')", [directory, pattern]
+        return 'directory = ?', [directory]
+
+    def refresh(self, directory, recursive=False, workers=None):
+        start = time.perf_counter()
+        directory = os.path.abspath(directory)
+        on_disk = {}
+        for root, dirs, files in os.walk(directory):
+            for name in files:
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                on_disk[path] = (stat.st_size, stat.st_mtime_ns)
+            if not recursive:
+                break
+
+        where, parameters = self._scope(directory, recursive)
+        indexed = {row['path']: (row['size'], row['mtime_ns'])
+                   for row in self._db.execute(f'SELECT path, size, mtime_ns FROM files WHERE {where}', parameters)}
+        changed = [path for path, signature in on_disk.items() if indexed.get(path) != signature]
+        removed = [path for path in indexed if path not in on_disk]
+
+        if len(changed) >= MIN_PARALLEL_FILES and workers != 1:
+            # Forked workers inherit the loaded GDCM module; each reads headers in chunks of paths
+            workers = workers or os.cpu_count()
+            chunk = max(1, min(256, len(changed) // (4 * workers)))
+            with ProcessPoolExecutor(max_workers=workers) as pool:
+                headers = [header for batch in pool.map(read_headers, [changed[i:i + chunk] for i in range(0, len(changed), chunk)])
+                           for header in batch]
+        else:
+            headers = read_headers(changed)
+
+        columns = ['path', 'directory', 'size', 'mtime_ns', 'is_dicom'] + list(TAG_COLUMNS.values())
+        rows = [[path, os.path.dirname(path), *on_disk[path], header is not None]
+                + [header[column] if header is not None else None for column in TAG_COLUMNS.values()]
+                for path, header in zip(changed, headers)]
+        with self._db:
+            self._db.executemany(f'INSERT OR REPLACE INTO files ({", ".join(columns)}) VALUES ({", ".join("?" * len(columns))})', rows)
+            self._db.executemany('DELETE FROM files WHERE path = ?', [(path,) for path in removed])
+
+        stats = {'files': len(on_disk), 'parsed': len(changed), 'removed': len(removed), 'seconds': time.perf_counter() - start}
+        print(f"Indexed {directory}: {stats['files']} files, {stats['parsed']} parsed, {stats['removed']} removed in {stats['seconds']:.2f} s.")
+        return stats
+
+    def _rows(self, directory, recursive):
+        where, parameters = self._scope(directory, recursive)
+        return [dict(row) for row in self._db.execute(
+            f'SELECT * FROM files WHERE {where} AND is_dicom AND series_uid IS NOT NULL', parameters)]
+
+    def _check_restrictions(self, restrictions):
+        for tag in restrictions:
+            if tag not in TAG_COLUMNS:
+                raise ValueError(f"Tag {tag} is not indexed; indexed tags are {', '.join(TAG_COLUMNS)}.")
+
+    def series(self, directory, use_series_details=True, restrictions=(), recursive=False):
+        # {series identifier: ordered file paths}, with the identifiers sorted like GDCMSeriesFileNames.GetSeriesUIDs()
+        self._check_restrictions(restrictions)
+        groups = {}
+        for row in self._rows(directory, recursive):
+            groups.setdefault(series_identifier(row, use_series_details, restrictions), []).append(row)
+        return {identifier: [row['path'] for row in order_series(groups[identifier])] for identifier in sorted(groups)}
+
+    def series_uids(self, directory, use_series_details=True, restrictions=(), recursive=False):
+        return list(self.series(directory, use_series_details, restrictions, recursive))
+
+    def file_names(self, directory, series_identifier=None, use_series_details=True, restrictions=(), recursive=False):
+        # Without an identifier the first series is returned, like GetInputFileNames()
+        series = self.series(directory, use_series_details, restrictions, recursive)
+        if series_identifier is None:
+            return next(iter(series.values()), [])
+        return series.get(series_identifier, [])
+
+    def close(self):
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_index_arguments(parser):
+    parser.add_argument("--index", nargs='?', const=DEFAULT_INDEX, help=f"Look series up in a SQLite index, refreshed for changed files first (default path: {DEFAULT_INDEX}).")
+    parser.add_argument("--index_workers", type=int, help="Processes reading DICOM headers while the index is refreshed (default: all cores).")
+
+
+def index_from_args(args, directory):
+    # None when --index is not given; the scripts then scan the directory with GDCMSeriesFileNames
+    if args.index is None:
+        return None
+    index = DicomSeriesIndex(args.index)
+    index.refresh(directory, workers=args.index_workers)
+    return index
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the SQLite index of the DICOM series in a directory.")
+    parser.add_argument("-i", "--input_dir", default="./images/DICOMSeries", help="Directory holding DICOM files.")
+    parser.add_argument("--db", default=DEFAULT_INDEX, help="SQLite index file.")
+    parser.add_argument("-r", "--recursive", action="store_true", help="Also index the subdirectories.")
+    parser.add_argument("-w", "--workers", type=int, help="Processes reading DICOM headers (default: all cores).")
+    parser.add_argument("--restriction", action="append", default=[], help="Extra tag (e.g. 0008|0021) that splits series, like AddSeriesRestriction.")
+
+    args = parser.parse_args()
+    with DicomSeriesIndex(args.db) as index:
+        index.refresh(args.input_dir, args.recursive, args.workers)
+        for identifier, file_names in index.series(args.input_dir, restrictions=args.restriction, recursive=args.recursive).items():
+            print(f"{identifier}: {len(file_names)} files")
+
+
+if __name__ == "__main__":
+    main()
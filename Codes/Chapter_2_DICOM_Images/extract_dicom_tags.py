@@ -0,0 +1,220 @@
+# Bulk DICOM tag extraction into one columnar file.
+#
+# Walks a directory tree, reads the header of every DICOM file in a process
+# pool and writes one row per instance: the file path and the chosen tags (or
+# every top-level tag found), as Parquet (.parquet), Arrow IPC (.arrow,
+# .feather) or CSV (.csv). Parquet and Arrow need pyarrow; CSV needs nothing
+# beyond the standard library.
+#
+# With pydicom installed the headers are parsed up to, but not including, the
+# pixel data (7fe0|0010), and column types follow the tags' value
+# representations. Without it GDCMImageIO.ReadImageInformation() is used:
+# the pixel data is never decoded, though GDCM still reads past it, and
+# column types are inferred from the values. Integer (IS, US, UL, ...) and
+# decimal (DS, FL, FD) tags become int64 and float64 columns, multi-valued
+# tags such as 0020|0032 become lists, and everything else stays a string.
+#
+#   python extract_dicom_tags.py -i ./images -o ./output/tags.parquet -t "0020|000e" "0020|0013" "0020|0032"
+
+import argparse
+import csv
+import os
+import re
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import itk
+
+try:
+    import pyarrow
+    import pyarrow.feather
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+BACKENDS = ['auto', 'pydicom', 'gdcm']
+INTEGER_VRS = {'IS', 'SL', 'SS', 'SV', 'UL', 'US', 'UV'}
+DECIMAL_VRS = {'DS', 'FD', 'FL'}
+# Bulk binary data and sequences do not fit a flat table
+SKIPPED_VRS = {'OB', 'OD', 'OF', 'OL', 'OV', 'OW', 'SQ', 'UN'}
+
+# GDCM does not report value representations: these decimal string (DS) tags often hold whole
+# numbers and would otherwise be typed as integers in one batch and as floats in the next
+DECIMAL_TAGS = {'0018|0050', '0018|0088', '0020|0032', '0020|0037', '0028|0030', '0018|1164',
+                '0028|1050', '0028|1051', '0028|1052', '0028|1053'}
+
+# Without value representations, labels like these mark numeric-looking text that is not a number
+_TEXT_LABEL = re.compile(r'Date|Time|UID|ID\b')
+_INTEGER = re.compile(r'[+-]?(0|[1-9][0-9]*)$')
+
+
+def read_header_gdcm(path, tags=None):
+    # {tag: (None, text)}: GDCM does not expose value representations
+    dicom_io = itk.GDCMImageIO.New()
+    if not dicom_io.CanReadFile(path):
+        return None
+    dicom_io.SetFileName(path)
+    try:
+        dicom_io.ReadImageInformation()
+    except RuntimeError:
+        return None
+    metadata = dicom_io.GetMetaDataDictionary()
+    header = {}
+    for tag in tags if tags is not None else metadata.GetKeys():
+        if tag == '7fe0|0010' or not metadata.HasKey(tag):
+            continue
+        try:
+            header[tag] = (None, str(metadata[tag]).strip())
+        except RuntimeError:
+            # Values ITK cannot hand to Python, e.g. binary blobs
+            pass
+    return header
+
+
+def _pydicom_tag(tag):
+    group, element = tag.split('|')
+    return pydicom.tag.Tag(int(group, 16), int(element, 16))
+
+
+def read_header_pydicom(path, tags=None):
+    # {tag: (VR, text)} of the top-level elements before the pixel data
+    try:
+        dataset = pydicom.dcmread(path, stop_before_pixels=True,
+                                  specific_tags=[_pydicom_tag(tag) for tag in tags] if tags is not None else None)
+    except (pydicom.errors.InvalidDicomError, OSError):
+        return None
+    header = {}
+    for element in dataset:
+        if element.VR in SKIPPED_VRS or element.value is None:
+            continue
+        tag = f"{element.tag.group:04x}|{element.tag.element:04x}"
+        values = element.value if element.VM > 1 else [element.value]
+        header[tag] = (element.VR, '\\'.join(str(value) for value in values).strip())
+    return header
+
+
+def read_headers(paths, tags, backend):
+    read_header = read_header_pydicom if backend == 'pydicom' else read_header_gdcm
+    return [(path, read_header(path, tags)) for path in paths]
+
+
+def _column_kind(tag, entries):
+    # 'int', 'float' or 'string', and whether any instance holds several values
+    vrs = {vr for vr, _ in entries if vr is not None} or ({'DS'} if tag in DECIMAL_TAGS else set())
+    parts = [text.split('\\') for _, text in entries if text]
+    multi = any(len(p) > 1 for p in parts)
+    if vrs:
+        if vrs <= INTEGER_VRS:
+            return 'int', multi
+        if vrs <= DECIMAL_VRS | INTEGER_VRS:
+            return 'float', multi
+        return 'string', multi
+
+    values = [value for p in parts for value in p]
+    if not values or _TEXT_LABEL.search(itk.GDCMImageIO.GetLabelFromTag(tag, '')[1]):
+        return 'string', multi
+    if all(_INTEGER.match(value) for value in values):
+        return 'int', multi
+    try:
+        for value in values:
+            float(value)
+        return 'float', multi
+    except ValueError:
+        return 'string', multi
+
+
+def _convert(text, kind, multi):
+    if text is None or (text == '' and kind != 'string'):
+        return None
+    convert = {'int': int, 'float': float, 'string': str}[kind]
+    try:
+        values = [convert(part) for part in text.split('\\')] if multi else convert(text)
+    except ValueError:
+        return None
+    return values
+
+
+def build_columns(headers, tags=None):
+    # {column: (kind, multi, values)} with one value per instance, in tag order
+    if tags is None:
+        tags = sorted({tag for _, header in headers for tag in header})
+    columns = {'path': ('string', False, [path for path, _ in headers])}
+    for tag in tags:
+        entries = [header.get(tag, (None, None)) for _, header in headers]
+        kind, multi = _column_kind(tag, [entry for entry in entries if entry[1] is not None])
+        columns[tag] = (kind, multi, [_convert(text, kind, multi) for _, text in entries])
+    return columns
+
+
+def write_columns(columns, output_path):
+    os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension == '.csv':
+        with open(output_path, 'w', newline='') as f:
+            table = csv.writer(f)
+            table.writerow(list(columns))
+            for row in zip(*(values for _, _, values in columns.values())):
+                table.writerow(['\\'.join(map(str, value)) if isinstance(value, list) else ('' if value is None else value)
+                                for value in row])
+        return
+
+    if pyarrow is None:
+        raise RuntimeError(f"Writing {extension} files needs pyarrow (pip install pyarrow); use a .csv output instead.")
+    arrow_types = {'int': pyarrow.int64(), 'float': pyarrow.float64(), 'string': pyarrow.string()}
+    arrays = [pyarrow.array(values, type=pyarrow.list_(arrow_types[kind]) if multi else arrow_types[kind])
+              for kind, multi, values in columns.values()]
+    table = pyarrow.table(arrays, names=list(columns))
+    if extension == '.parquet':
+        pyarrow.parquet.write_table(table, output_path)
+    elif extension in ('.arrow', '.feather'):
+        pyarrow.feather.write_feather(table, output_path)
+    else:
+        raise RuntimeError(f"Unknown output format {extension}; use .parquet, .arrow, .feather or .csv.")
+
+
+def extract_tags(input_dir, output_path, tags=None, workers=None, backend='auto'):
+    start = time.perf_counter()
+    if backend == 'auto':
+        backend = 'pydicom' if pydicom is not None else 'gdcm'
+    elif backend == 'pydicom' and pydicom is None:
+        raise RuntimeError("The pydicom backend needs pydicom (pip install pydicom).")
+
+    paths = sorted(os.path.join(root, name) for root, _, files in os.walk(input_dir) for name in files)
+    workers = workers or os.cpu_count()
+    chunk = max(1, min(256, len(paths) // (4 * workers)))
+    batches = [paths[i:i + chunk] for i in range(0, len(paths), chunk)]
+    # Forked workers inherit the loaded GDCM module
+    itk.GDCMImageIO
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        headers = [(path, header) for batch in pool.map(read_headers, batches, [tags] * len(batches), [backend] * len(batches))
+                   for path, header in batch if header is not None]
+
+    columns = build_columns(headers, tags)
+    write_columns(columns, output_path)
+    print(f"{output_path} written successfully: {len(headers)} instances of {len(paths)} files, "
+          f"{len(columns) - 1} tags, {backend} headers in {time.perf_counter() - start:.2f} s.")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Extract DICOM header tags of a directory tree into a Parquet, Arrow or CSV file.")
+    parser.add_argument("-i", "--input_dir", default="./images", help="Directory tree holding DICOM files.")
+    parser.add_argument("-o", "--output", default="./output/dicom_tags.parquet", help="Output file: .parquet, .arrow, .feather or .csv.")
+    parser.add_argument("-t", "--tags", nargs='+', help="Tags to extract, e.g. 0020|000e (default: every top-level tag).")
+    parser.add_argument("-w", "--workers", type=int, help="Processes reading headers (default: all cores).")
+    parser.add_argument("--backend", choices=BACKENDS, default='auto', help="Header parser: pydicom stops before the pixel data, gdcm needs no extra package (default: pydicom when installed).")
+
+    args = parser.parse_args()
+    tags = [tag.lower() for tag in args.tags] if args.tags else None
+    try:
+        extract_tags(args.input_dir, args.output, tags, args.workers, args.backend)
+    except Exception as e:
+        print(f"Exception caught while writing {args.output}!", str(e))
+
+
+if __name__ == "__main__":
+    main()
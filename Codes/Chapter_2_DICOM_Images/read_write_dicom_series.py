@@ -2,9 +2,16 @@
 # SetDirectory() method only gets read file name
 
 import itk
+import argparse
 import os
+import sys
 
-def convert_3d_to_2d_dicom(input_dir, output_dir):
+from dicom_series_index import add_index_arguments, index_from_args
+from parallel_series_writer import write_series_parallel
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+def convert_3d_to_2d_dicom(input_dir, output_dir, index=None, workers=None):
     # Define types
     PixelType = itk.F
     Dimension = 3
@@ -18,7 +25,8 @@ def convert_3d_to_2d_dicom(input_dir, output_dir):
     names_generator = itk.GDCMSeriesFileNames.New()
     names_generator.SetInputDirectory(input_dir)
     
-    filenames = names_generator.GetInputFileNames()
+    # The DICOM index, when given, replaces the directory scan for the input file names
+    filenames = index.file_names(input_dir) if index is not None else names_generator.GetInputFileNames()
     reader.SetImageIO(gdcm_io)
     reader.SetFileNames(filenames)
     
@@ -38,13 +46,25 @@ def convert_3d_to_2d_dicom(input_dir, output_dir):
     # Configure the ImageSeriesWriter
     series_writer.SetInput(image_3d)
     series_writer.SetImageIO(gdcm_io)
-    names_generator.SetOutputDirectory(output_dir)
-    output_filenames = names_generator.GetOutputFileNames()
+    if index is not None:
+        output_filenames = [os.path.join(output_dir, os.path.relpath(filename, os.path.abspath(input_dir))) for filename in filenames]
+    else:
+        names_generator.SetOutputDirectory(output_dir)
+        output_filenames = names_generator.GetOutputFileNames()
     series_writer.SetFileNames(output_filenames)
     
     # Copy metadata
     series_writer.SetMetaDataDictionaryArray(reader.GetMetaDataDictionaryArray())
     
+    if workers:
+        # Worker processes write the slices, each with its own dictionary from the reader
+        try:
+            write_series_parallel(image_3d, output_filenames, reader.GetMetaDataDictionaryArray(), workers)
+            print("Conversion Successful")
+        except Exception as e:
+            print(f"Exception caught while writing {output_dir}!", str(e))
+        return
+
     try:
         series_writer.Update()
         print("Conversion Successful")
@@ -53,6 +73,20 @@ def convert_3d_to_2d_dicom(input_dir, output_dir):
         print(excp)
         
 
-input_dir = "./images/OneDrive_2024-08-17/DICOM images"
-output_dir = "./images/OneDrive_2024-08-17/DICOM images/DICOM"
-convert_3d_to_2d_dicom(input_dir,output_dir)
\ No newline at end of file
+def main():
+    parser = argparse.ArgumentParser(description="Write a 3D DICOM series back out as a series of 2D DICOM slices.")
+    parser.add_argument("-i", "--input_dir", default="./images/OneDrive_2024-08-17/DICOM images", help="Directory holding the input DICOM series.")
+    parser.add_argument("-o", "--output_dir", default="./images/OneDrive_2024-08-17/DICOM images/DICOM", help="Directory for the 2D DICOM slices.")
+    parser.add_argument("-w", "--workers", type=int, help="Write the slices from this many processes.")
+    add_index_arguments(parser)
+    add_profiler_arguments(parser)
+
+    args = parser.parse_args()
+    profiler = profiler_from_args(args)
+    index = index_from_args(args, args.input_dir)
+    convert_3d_to_2d_dicom(args.input_dir, args.output_dir, index, args.workers)
+    profiler.report()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,276 @@
+# Batch DICOM header rewriting and de-identification, in place.
+#
+# update_dicom_header.py decodes the image and writes it back through
+# GDCMImageIO, which re-encodes the pixels and may change the transfer syntax.
+# Here each file is parsed with pydicom, only header elements are touched and
+# the file is written back with its own transfer syntax: the pixel data bytes
+# (compressed or not) are copied as read, never decoded. Large values are read
+# lazily from the source file while the output is written, so multi-frame
+# files are not held in memory.
+#
+# Rules, from a JSON file (-r) and/or the command line:
+#   set          {tag: value}  value of a top-level element, added if missing
+#   remove       [tag, ...]    element deleted, in nested sequences too
+#   hash         [tag, ...]    value replaced by a keyed hash (HMAC-SHA256 with
+#                              --salt, which hash rules require): UIDs become
+#                              2.25.<number> UIDs, other text 16 hex digits, so
+#                              the same input maps to the same output across
+#                              files and runs. Only text and UI elements can
+#                              hold a hash; dates are moved with shift_dates
+#   shift_dates  days          every DA and DT value moved by this many days
+# Tags are written 0010|0010 like elsewhere in this repo, or as keywords (PatientName).
+#
+# Files are rewritten in a process pool; every file gets one JSON line in the
+# change log (--log) listing what changed. With --dry_run nothing is written
+# and the log shows what would change. Original values are only logged with
+# --log_values, since they are what de-identification removes.
+#
+#   python rewrite_dicom_headers.py -i ./images --set "0010|0010=ANONYMOUS" --hash "0010|0020" "0020|000d" "0020|000e" "0008|0018" --shift_dates -30 --dry_run
+
+import argparse
+import datetime
+import hashlib
+import hmac
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import pydicom
+except ImportError:
+    pydicom = None
+
+RULE_KINDS = ['set', 'remove', 'hash', 'shift_dates']
+
+# Values larger than this are left in the file until they are written out
+DEFER_SIZE = '256 KB'
+
+# Text and UIDs can hold a hash; numbers, dates, times, ages and binary data cannot
+HASHABLE_VRS = {'AE', 'CS', 'LO', 'LT', 'PN', 'SH', 'ST', 'UC', 'UI', 'UR', 'UT'}
+
+
+def _tag(name):
+    # 'gggg|eeee' or a DICOM keyword to a pydicom tag
+    if '|' in name:
+        group, element = name.split('|')
+        return pydicom.tag.Tag(int(group, 16), int(element, 16))
+    tag = pydicom.datadict.tag_for_keyword(name)
+    if tag is None:
+        raise ValueError(f"Unknown DICOM tag or keyword {name}.")
+    return pydicom.tag.Tag(tag)
+
+
+def _tag_name(tag):
+    return f"{tag.group:04x}|{tag.element:04x}"
+
+
+def load_rules(rules_file=None, set_values=(), remove=(), hash_tags=(), shift_dates=None):
+    # Rules of the JSON file, extended and overridden by the command line ones
+    rules = {'set': {}, 'remove': [], 'hash': [], 'shift_dates': 0}
+    if rules_file is not None:
+        with open(rules_file) as f:
+            loaded = json.load(f)
+        unknown = set(loaded) - set(RULE_KINDS)
+        if unknown:
+            raise ValueError(f"Unknown rule(s) {', '.join(sorted(unknown))} in {rules_file}; rules are {', '.join(RULE_KINDS)}.")
+        rules.update(loaded)
+    for assignment in set_values:
+        tag, separator, value = assignment.partition('=')
+        if not separator:
+            raise ValueError(f"--set expects TAG=VALUE, not {assignment}.")
+        rules['set'][tag] = value
+    rules['remove'] = list(rules['remove']) + list(remove)
+    rules['hash'] = list(rules['hash']) + list(hash_tags)
+    if shift_dates is not None:
+        rules['shift_dates'] = shift_dates
+    return rules
+
+
+def check_hash_rules(rules, salt):
+    # Hash rules on elements that cannot hold a hash, or without a key, fail before any file is touched
+    if rules['hash'] and not salt:
+        raise ValueError("Hash rules need a secret --salt (or DICOM_HASH_SALT): without a key anyone can rebuild "
+                         "the mapping of low-entropy IDs such as PatientID by hashing candidate values.")
+    for name in rules['hash']:
+        tag = _tag(name)
+        vr = pydicom.datadict.dictionary_VR(tag) if pydicom.datadict.dictionary_has_tag(tag) else None
+        if vr is not None and vr not in HASHABLE_VRS:
+            hint = " Move dates with shift_dates instead." if vr in ('DA', 'DT', 'TM') else ""
+            raise ValueError(f"Cannot hash {name}: its {vr} values cannot hold a hash, only text and UI values can.{hint}")
+
+
+def _hash_value(value, vr, salt):
+    digest = hmac.new(salt.encode(), str(value).encode(), hashlib.sha256).digest()
+    if vr == 'UI':
+        # UUID-derived UIDs (PS3.5 B.2) keep a valid UID of at most 64 characters
+        return '2.25.' + str(int.from_bytes(digest[:16], 'big'))
+    return digest.hex().upper()[:16]
+
+
+def _shift_date(value, vr, days):
+    # DA is YYYYMMDD; DT starts with it and may carry a time and an offset after
+    if len(value) < 8 or not value[:8].isdigit():
+        return value
+    shifted = datetime.datetime.strptime(value[:8], '%Y%m%d') + datetime.timedelta(days=days)
+    return shifted.strftime('%Y%m%d') + (value[8:] if vr == 'DT' else '')
+
+
+def _text(value):
+    if isinstance(value, (list, tuple, pydicom.multival.MultiValue)):
+        return '\\'.join(str(v) for v in value)
+    return str(value)
+
+
+def apply_rules(dataset, rules, salt=''):
+    # Changes the dataset in place; returns [(tag, action, old, new)]
+    changes = []
+    remove = {_tag(name) for name in rules['remove']}
+    hash_tags = {_tag(name) for name in rules['hash']}
+    days = int(rules['shift_dates'])
+
+    def visit(data, element):
+        if element.tag in remove:
+            changes.append((element.tag, 'remove', _text(element.value), None))
+            del data[element.tag]
+        elif element.tag in hash_tags and element.value not in (None, ''):
+            # Private tags are only checked here, once their VR is known
+            if element.VR not in HASHABLE_VRS:
+                raise ValueError(f"Cannot hash {_tag_name(element.tag)}: its {element.VR} values cannot hold a hash.")
+            values = element.value if element.VM > 1 else [element.value]
+            new = [_hash_value(value, element.VR, salt) for value in values]
+            changes.append((element.tag, 'hash', _text(element.value), _text(new)))
+            element.value = new if element.VM > 1 else new[0]
+        elif days and element.VR in ('DA', 'DT') and element.value not in (None, ''):
+            values = element.value if element.VM > 1 else [element.value]
+            new = [_shift_date(str(value), element.VR, days) for value in values]
+            if new != [str(value) for value in values]:
+                changes.append((element.tag, 'shift_dates', _text(element.value), _text(new)))
+                element.value = new if element.VM > 1 else new[0]
+
+    # walk() also visits the items of sequences
+    dataset.walk(visit)
+
+    for name, value in rules['set'].items():
+        tag = _tag(name)
+        if tag in dataset:
+            old = _text(dataset[tag].value)
+            if old == str(value):
+                continue
+            dataset[tag].value = value
+        else:
+            old = None
+            vr = pydicom.datadict.dictionary_VR(tag) if pydicom.datadict.dictionary_has_tag(tag) else None
+            if vr is None:
+                raise ValueError(f"Cannot add {name}: its value representation is not in the DICOM dictionary.")
+            dataset.add_new(tag, vr, value)
+        changes.append((tag, 'set', old, str(value)))
+
+    # The file meta information repeats the instance UID
+    meta = getattr(dataset, 'file_meta', None)
+    if meta is not None and 'SOPInstanceUID' in dataset and meta.get('MediaStorageSOPInstanceUID') != dataset.SOPInstanceUID:
+        changes.append((pydicom.tag.Tag(0x0002, 0x0003), 'set', _text(meta.get('MediaStorageSOPInstanceUID', '')), str(dataset.SOPInstanceUID)))
+        meta.MediaStorageSOPInstanceUID = dataset.SOPInstanceUID
+    return changes
+
+
+def rewrite_file(path, output_path, rules, salt='', dry_run=False, log_values=False):
+    # One change log entry; the output is written next to its final name and renamed over it
+    entry = {'path': path, 'output': output_path}
+    try:
+        dataset = pydicom.dcmread(path, defer_size=DEFER_SIZE)
+    except (pydicom.errors.InvalidDicomError, OSError) as e:
+        entry['skipped'] = str(e)
+        return entry
+    except Exception as e:
+        # A damaged header fails this file only, logged with its message
+        entry['error'] = str(e)
+        return entry
+    try:
+        changes = apply_rules(dataset, rules, salt)
+        entry['changes'] = [{'tag': _tag_name(tag), 'keyword': pydicom.datadict.keyword_for_tag(tag), 'action': action,
+                             **({'old': old} if log_values else {}), 'new': new}
+                            for tag, action, old, new in changes]
+        if not dry_run and (changes or output_path != path):
+            os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+            temporary = output_path + '.rewriting'
+            try:
+                # Deferred values are read from the source file while the copy is written
+                dataset.save_as(temporary)
+                os.replace(temporary, output_path)
+            finally:
+                if os.path.exists(temporary):
+                    os.remove(temporary)
+    except Exception as e:
+        entry['error'] = str(e)
+    return entry
+
+
+def rewrite_files(pairs, rules, salt, dry_run, log_values):
+    return [rewrite_file(path, output_path, rules, salt, dry_run, log_values) for path, output_path in pairs]
+
+
+def rewrite_headers(input_dir, rules, output_dir=None, salt='', dry_run=False, log_path=None, log_values=False, workers=None):
+    start = time.perf_counter()
+    if pydicom is None:
+        raise RuntimeError("Rewriting DICOM headers without decoding the pixels needs pydicom (pip install pydicom).")
+    # Unknown tags fail here rather than once per file
+    for name in list(rules['set']) + list(rules['remove']) + list(rules['hash']):
+        _tag(name)
+    check_hash_rules(rules, salt)
+
+    paths = sorted(os.path.join(root, name) for root, _, files in os.walk(input_dir) for name in files)
+    if output_dir is None:
+        pairs = [(path, path) for path in paths]
+    else:
+        pairs = [(path, os.path.join(output_dir, os.path.relpath(path, input_dir))) for path in paths]
+    workers = workers or os.cpu_count()
+    chunk = max(1, min(64, len(pairs) // (4 * workers)))
+    batches = [pairs[i:i + chunk] for i in range(0, len(pairs), chunk)]
+    n = len(batches)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        entries = [entry for batch in pool.map(rewrite_files, batches, [rules] * n, [salt] * n, [dry_run] * n, [log_values] * n)
+                   for entry in batch]
+
+    if log_path is not None:
+        os.makedirs(os.path.dirname(log_path) or '.', exist_ok=True)
+        with open(log_path, 'w') as f:
+            for entry in entries:
+                f.write(json.dumps(entry) + '\n')
+        print(f"{log_path} written successfully.")
+
+    changed = sum(1 for entry in entries if entry.get('changes'))
+    skipped = sum(1 for entry in entries if 'skipped' in entry)
+    errors = [entry for entry in entries if 'error' in entry]
+    for entry in errors:
+        print(f"Exception caught while rewriting {entry['path']}!", entry['error'])
+    print(f"{'Would change' if dry_run else 'Changed'} {changed} of {len(entries) - skipped} DICOM files "
+          f"({skipped} other files, {len(errors)} errors) in {time.perf_counter() - start:.2f} s.")
+    return entries
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Rewrite or de-identify the headers of the DICOM files in a directory tree without touching the pixel data.")
+    parser.add_argument("-i", "--input_dir", default="./images", help="Directory tree holding DICOM files.")
+    parser.add_argument("-o", "--output_dir", help="Write the rewritten files under this directory (default: rewrite in place).")
+    parser.add_argument("-r", "--rules", help="JSON file with set, remove, hash and shift_dates rules.")
+    parser.add_argument("--set", nargs='+', default=[], metavar="TAG=VALUE", help="Set (or add) top-level elements.")
+    parser.add_argument("--remove", nargs='+', default=[], metavar="TAG", help="Remove elements.")
+    parser.add_argument("--hash", nargs='+', default=[], metavar="TAG", help="Replace values by keyed hashes.")
+    parser.add_argument("--shift_dates", type=int, help="Move every date by this many days.")
+    parser.add_argument("--salt", default=os.environ.get('DICOM_HASH_SALT', ''), help="Secret key of the hashes, required by hash rules (default: the DICOM_HASH_SALT environment variable).")
+    parser.add_argument("--dry_run", action="store_true", help="Only log the changes, write nothing.")
+    parser.add_argument("--log", default="./output/dicom_header_changes.jsonl", help="Change log, one JSON line per file.")
+    parser.add_argument("--log_values", action="store_true", help="Also log the original values.")
+    parser.add_argument("-w", "--workers", type=int, help="Processes rewriting files (default: all cores).")
+
+    args = parser.parse_args()
+    try:
+        rules = load_rules(args.rules, args.set, args.remove, args.hash, args.shift_dates)
+        rewrite_headers(args.input_dir, rules, args.output_dir, args.salt, args.dry_run, args.log, args.log_values, args.workers)
+    except Exception as e:
+        print(f"Exception caught while rewriting {args.input_dir}!", str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+# Bounded-memory conversion of a DICOM series into one volume file.
+#
+# ImageSeriesReader only decodes the slices inside the region requested from
+# it, so the series is pulled in slabs of whole slices sized to fit
+# --memory_budget, and every slab is appended to the output before the next
+# one is read. The geometry comes from the reader's output information, the
+# same as when the whole series is read at once.
+#
+# NRRD and MHA: the header is written first, the same as ITK writes it, and
+# the slabs are deflated on several threads as they arrive
+# (common/compressed_writer.py). MHD: ITK's MetaImage writer streams itself;
+# the writer requests the slabs and the data is written uncompressed, since
+# ITK cannot stream compressed MetaImage data.
+
+import math
+import os
+import sys
+
+import itk
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from compressed_writer import DEFAULT_LEVEL, VolumeFileWriter
+
+# The reader's slab, its extracted copy and the bytes handed to the compressor
+BUFFER_COPIES = 3
+
+
+def slab_slices(size, bytes_per_pixel, memory_budget_mb):
+    slice_bytes = bytes_per_pixel * math.prod(size[:-1])
+    slices = int(memory_budget_mb * 2**20 // (BUFFER_COPIES * slice_bytes))
+    if slices < 1:
+        print(f"Memory budget of {memory_budget_mb} MB is below one slice; streaming single slices.")
+    return max(1, min(slices, size[-1]))
+
+
+def _stream_volume(reader, output_path, slices, compression, level, threads):
+    image = reader.GetOutput()
+    region = image.GetLargestPossibleRegion()
+    index, size = list(region.GetIndex()), list(region.GetSize())
+    # A NumPy view of the reader's own output would update its largest possible region, i.e. the
+    # whole series; the extract's largest possible region is the slab, and the reader only decodes that
+    extract = itk.ExtractImageFilter[type(image), type(image)].New()
+    extract.SetInput(image)
+    extract.SetDirectionCollapseToSubmatrix()
+    with VolumeFileWriter(image, output_path, compression, level, threads) as writer:
+        for first in range(0, size[-1], slices):
+            slab = itk.ImageRegion[len(size)]()
+            slab.SetIndex(index[:-1] + [index[-1] + first])
+            slab.SetSize(size[:-1] + [min(slices, size[-1] - first)])
+            extract.SetExtractionRegion(slab)
+            extract.UpdateLargestPossibleRegion()
+            writer.write(itk.array_view_from_image(extract.GetOutput()))
+
+
+def stream_series_to_volume(reader, output_path, memory_budget_mb, compression='deflate', level=DEFAULT_LEVEL, threads=None):
+    """Write the series of a configured ImageSeriesReader to a .nrrd, .mha or .mhd file slab by slab."""
+    reader.UpdateOutputInformation()
+    image = reader.GetOutput()
+    size = list(image.GetLargestPossibleRegion().GetSize())
+    bytes_per_pixel = itk.template(image)[1][0].dtype.itemsize
+    slices = slab_slices(size, bytes_per_pixel, memory_budget_mb)
+    print(f"Streaming {size[-1]} slices in slabs of {slices}.")
+
+    extension = os.path.splitext(output_path)[1].lower()
+    if extension in ('.nrrd', '.mha'):
+        _stream_volume(reader, output_path, slices, compression, level, threads)
+    elif extension == '.mhd':
+        writer = itk.ImageFileWriter[type(image)].New()
+        writer.SetFileName(output_path)
+        writer.SetInput(image)
+        writer.SetNumberOfStreamDivisions(math.ceil(size[-1] / slices))
+        writer.Update()
+    else:
+        raise RuntimeError(f"Streaming conversion writes .nrrd, .mha or .mhd files, not {extension}.")
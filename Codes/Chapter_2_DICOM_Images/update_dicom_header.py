@@ -1,6 +1,17 @@
 import itk
 
+from rewrite_dicom_headers import load_rules, pydicom, rewrite_file
+
 def update_header(input_file,output_file,entry_id,value):
+    if pydicom is not None:
+        # Only the header is rewritten; the pixel data and transfer syntax are kept as they are
+        entry = rewrite_file(input_file, output_file, load_rules(set_values=[entry_id + "=" + value]), log_values=True)
+        for change in entry.get('changes', []):
+            print(change['keyword'] + " (" + change['tag'] + ") changed from: " + str(change['old']) + " to: " + change['new'])
+        if 'error' in entry or 'skipped' in entry:
+            print(f"Exception caught while writing {output_file}!", entry.get('error', entry.get('skipped')))
+        return
+
     InputPixelType = itk.SS  # short
     Dimension = 2
     InputImageType = itk.Image[InputPixelType, Dimension]
@@ -0,0 +1,186 @@
+# Cache of converted DICOM series as raw, memory-mapped volumes.
+#
+# Compressed NRRD volumes are decompressed in full every time they are read.
+# The cache keeps each converted series as an uncompressed raw payload (the
+# voxels in NumPy order, starting at offset 0 so the mapping is page aligned)
+# and a small JSON sidecar with its pixel type, size, geometry and string
+# metadata. get() maps the payload with np.memmap and wraps it as an itk.Image
+# view, so only the pages a job touches are read and nothing is copied. The
+# mapping is copy-on-write: a filter running in place changes its own pages,
+# never the cached file.
+#
+# Entries are keyed by the series identifier together with the path, size and
+# mtime of every source file, so a changed or added slice is a miss rather than
+# a stale volume. The sidecar's mtime records when an entry was last used;
+# once the payloads exceed the disk quota the least recently used entries are
+# removed. A payload is written under a temporary name and its sidecar last,
+# so readers never see a half-written entry.
+#
+#   python volume_cache.py --cache ./cache/volumes --quota 20
+
+import argparse
+import hashlib
+import json
+import os
+import time
+
+import itk
+import numpy as np
+
+DEFAULT_CACHE = './cache/volumes'
+DEFAULT_QUOTA_GB = 20.0
+
+# Bumped whenever the payload or sidecar layout changes; older entries are misses
+CACHE_VERSION = 1
+
+
+def fingerprint(series_identifier, file_names):
+    # Key of a series: its identifier and the path, size and mtime of every file, in series order
+    digest = hashlib.sha256(f"{CACHE_VERSION}\n{series_identifier}\n".encode())
+    for file_name in file_names:
+        stat = os.stat(file_name)
+        digest.update(f"{os.path.abspath(file_name)}\0{stat.st_size}\0{stat.st_mtime_ns}\n".encode())
+    return digest.hexdigest()
+
+
+def _string_metadata(image):
+    metadata = image.GetMetaDataDictionary()
+    entries = {}
+    for key in metadata.GetKeys():
+        try:
+            value = metadata[key]
+        except RuntimeError:
+            continue
+        if isinstance(value, str):
+            entries[key] = value
+    return entries
+
+
+class VolumeCache:
+    def __init__(self, cache_dir=DEFAULT_CACHE, quota_gb=DEFAULT_QUOTA_GB):
+        self.cache_dir = cache_dir
+        self.quota_bytes = int(quota_gb * 2**30)
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, key):
+        return os.path.join(self.cache_dir, key + '.raw'), os.path.join(self.cache_dir, key + '.json')
+
+    def get(self, series_identifier, file_names):
+        """The cached volume of the series as an itk.Image over a memory map, or None."""
+        payload_path, sidecar_path = self._paths(fingerprint(series_identifier, file_names))
+        try:
+            with open(sidecar_path) as f:
+                sidecar = json.load(f)
+            volume = np.memmap(payload_path, dtype=np.dtype(sidecar['dtype']), mode='c', shape=tuple(sidecar['shape']))
+        except (OSError, ValueError, KeyError):
+            return None
+        # Marks the entry as recently used for eviction
+        os.utime(sidecar_path)
+
+        image = itk.image_view_from_array(volume)
+        image.SetOrigin(sidecar['origin'])
+        image.SetSpacing(sidecar['spacing'])
+        image.SetDirection(itk.matrix_from_array(np.array(sidecar['direction'])))
+        metadata = image.GetMetaDataDictionary()
+        for key, value in sidecar['metadata'].items():
+            metadata[key] = value
+        return image
+
+    def put(self, series_identifier, file_names, image):
+        """Store a volume read from the given files, then evict down to the quota."""
+        key = fingerprint(series_identifier, file_names)
+        payload_path, sidecar_path = self._paths(key)
+        array = itk.array_view_from_image(image)
+        if array.nbytes > self.quota_bytes:
+            print(f"Volume of {array.nbytes / 2**20:.1f} MB exceeds the cache quota; not cached.")
+            return
+        # Room for the new payload is made first, so the quota holds while it is written
+        self.evict(self.quota_bytes - array.nbytes)
+        sidecar = {
+            'version': CACHE_VERSION,
+            'series_identifier': series_identifier,
+            'files': len(file_names),
+            'dtype': array.dtype.str,
+            'shape': list(array.shape),
+            'origin': list(image.GetOrigin()),
+            'spacing': list(image.GetSpacing()),
+            'direction': itk.array_from_matrix(image.GetDirection()).tolist(),
+            'metadata': _string_metadata(image),
+        }
+        temporary = payload_path + f'.{os.getpid()}.tmp'
+        try:
+            np.ascontiguousarray(array).tofile(temporary)
+            os.replace(temporary, payload_path)
+            with open(temporary, 'w') as f:
+                json.dump(sidecar, f)
+            os.replace(temporary, sidecar_path)
+        finally:
+            if os.path.exists(temporary):
+                os.remove(temporary)
+        print(f"Cached {series_identifier} ({array.nbytes / 2**20:.1f} MB) as {key}.")
+
+    def entries(self):
+        # [(last used, payload bytes, key)], least recently used first
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            key, extension = os.path.splitext(name)
+            if extension != '.raw':
+                continue
+            payload_path, sidecar_path = self._paths(key)
+            try:
+                last_used = os.stat(sidecar_path).st_mtime
+            except OSError:
+                # A payload without its sidecar is left over from an interrupted put()
+                last_used = 0
+            entries.append((last_used, os.stat(payload_path).st_size, key))
+        return sorted(entries)
+
+    def evict(self, limit_bytes=None):
+        """Remove least recently used entries until the payloads fit in limit_bytes (default: the quota)."""
+        limit_bytes = self.quota_bytes if limit_bytes is None else limit_bytes
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        removed = 0
+        for _, size, key in entries:
+            if total <= limit_bytes:
+                break
+            # The sidecar goes first, so the entry is a miss before its payload disappears;
+            # volumes mapped by running jobs stay readable until they are closed
+            for path in reversed(self._paths(key)):
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            total -= size
+            removed += 1
+        return removed
+
+
+def add_cache_arguments(parser):
+    parser.add_argument("--cache", nargs='?', const=DEFAULT_CACHE, help=f"Reuse series volumes from a memory-mapped cache, adding missing ones (default directory: {DEFAULT_CACHE}).")
+    parser.add_argument("--cache_quota", type=float, default=DEFAULT_QUOTA_GB, help="Disk quota of the volume cache in GB.")
+
+
+def cache_from_args(args):
+    # None when --cache is not given
+    if args.cache is None:
+        return None
+    return VolumeCache(args.cache, args.cache_quota)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="List the volume cache and evict it down to its quota.")
+    parser.add_argument("--cache", default=DEFAULT_CACHE, help="Cache directory.")
+    parser.add_argument("--quota", type=float, default=DEFAULT_QUOTA_GB, help="Disk quota in GB.")
+
+    args = parser.parse_args()
+    cache = VolumeCache(args.cache, args.quota)
+    removed = cache.evict()
+    entries = cache.entries()
+    for last_used, size, key in entries:
+        print(f"{key}  {size / 2**20:10.1f} MB  last used {time.strftime('%Y-%m-%d %H:%M', time.localtime(last_used))}")
+    print(f"{len(entries)} volumes, {sum(size for _, size, _ in entries) / 2**30:.2f} GB of {args.quota} GB; {removed} evicted.")
+
+
+if __name__ == "__main__":
+    main()
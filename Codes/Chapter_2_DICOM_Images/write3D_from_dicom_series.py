@@ -1,23 +1,40 @@
 import itk
+import argparse
 import os
+import sys
 
+from dicom_series_index import add_index_arguments, index_from_args
+from parallel_series_reader import read_series_parallel
+from series_streaming import stream_series_to_volume
+from volume_cache import add_cache_arguments, cache_from_args
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from compressed_writer import add_compression_arguments, compression_from_args, write_volume
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
 
-def convert_2d_3d(input_dir,series=0,dim=3):
+
+def convert_2d_3d(input_dir,series=0,dim=3,index=None,memory_budget=None,output_format='nrrd',workers=None,cache=None,compression=None):
+    # Keyword arguments of write_volume(): compression, level and threads
+    compression = compression or {}
     # Define the pixel type and dimension
     pixel_type = itk.ctype("signed short")
 
     # Create the image type
     img_type = itk.Image[pixel_type, dim]
 
-    # Create a GDCM series file names generator
-    name_generator = itk.GDCMSeriesFileNames.New()
-    name_generator.SetUseSeriesDetails(True)
-    name_generator.AddSeriesRestriction("0008|0021")
-    name_generator.SetGlobalWarningDisplay(False)
-    name_generator.SetDirectory(input_dir)
+    if index is not None:
+        # Series and their file order come from the DICOM index instead of a directory scan
+        series_files = index.series(input_dir, restrictions=["0008|0021"])
+        series_UID = tuple(series_files)
+    else:
+        # Create a GDCM series file names generator
+        name_generator = itk.GDCMSeriesFileNames.New()
+        name_generator.SetUseSeriesDetails(True)
+        name_generator.AddSeriesRestriction("0008|0021")
+        name_generator.SetGlobalWarningDisplay(False)
+        name_generator.SetDirectory(input_dir)
 
-    # Get the series UIDs
-    series_UID = name_generator.GetSeriesUIDs()
+        # Get the series UIDs
+        series_UID = name_generator.GetSeriesUIDs()
  
 
     if len(series_UID) < 1:
@@ -29,7 +46,7 @@ def convert_2d_3d(input_dir,series=0,dim=3):
         series_identifier = series_UID[series]
 
         # Get the file names for the series
-        file_names = name_generator.GetFileNames(series_identifier)
+        file_names = series_files[series_identifier] if index is not None else name_generator.GetFileNames(series_identifier)
         print(file_names)
 
         # Create the series reader
@@ -41,24 +58,67 @@ def convert_2d_3d(input_dir,series=0,dim=3):
         series_reader.SetImageIO(dicomIO)
         series_reader.ForceOrthogonalDirectionOff()
 
-        try:
-            # Update the reader to load the image
-            series_reader.Update()
-            image = series_reader.GetOutput()
-            print(f"Successfully read DICOM series into 3D image with size: {image.GetLargestPossibleRegion().GetSize()}")
-        except Exception as e:
-            print("Error reading DICOM series:", e)
+        outFileName = os.path.join(input_dir, series_identifier + "." + output_format)
+        if memory_budget:
+            # Slabs of slices are decoded and appended to the output one at a time
+            print("Writing: " + outFileName)
+            try:
+                stream_series_to_volume(series_reader, outFileName, memory_budget, **compression)
+            except Exception as e:
+                print(f"Exception caught while writing {outFileName}!", str(e))
+            return
+
+        # A cached volume of the same files is memory-mapped instead of decoding the slices again
+        image = cache.get(series_identifier, file_names) if cache is not None else None
+        if image is not None:
+            print(f"Read {series_identifier} from the volume cache with size: {image.GetLargestPossibleRegion().GetSize()}")
+        else:
+            try:
+                if workers:
+                    # Slices are decoded by worker processes straight into one preallocated volume;
+                    # the file names are already in series order
+                    image = read_series_parallel(file_names, pixel_type, workers, sort=False)
+                else:
+                    # Update the reader to load the image
+                    series_reader.Update()
+                    image = series_reader.GetOutput()
+                print(f"Successfully read DICOM series into 3D image with size: {image.GetLargestPossibleRegion().GetSize()}")
+                if cache is not None:
+                    cache.put(series_identifier, file_names, image)
+            except Exception as e:
+                print("Error reading DICOM series:", e)
+                image = series_reader.GetOutput()
 
 
-        writer = itk.ImageFileWriter[img_type].New()
-        outFileName = os.path.join(input_dir, series_identifier + ".nrrd")
-        writer.SetFileName(outFileName)
-        writer.UseCompressionOn()
-        writer.SetInput(series_reader.GetOutput())
+        # .nrrd and .mha outputs are deflated on several threads
         print("Writing: " + outFileName)
-        writer.Update()
+        write_volume(image, outFileName, **compression)
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a DICOM series into a single 3D NRRD volume.")
+    parser.add_argument("-i", "--input_dir", default="./images/DICOMSeries", help="Directory holding the DICOM series.")
+    parser.add_argument("-s", "--series", type=int, default=0, help="Index of the series UID to convert.")
+    parser.add_argument("-d", "--dimension", type=int, default=3, help="Dimension of the output image.")
+    parser.add_argument("-f", "--format", choices=['nrrd', 'mha'], default='nrrd', help="Output file format.")
+    parser.add_argument("--memory_budget", type=float, help="Decode and write the series in slabs of slices that fit this many MB.")
+    parser.add_argument("-w", "--workers", type=int, help="Decode the slices in this many processes into one preallocated volume.")
+    add_index_arguments(parser)
+    add_cache_arguments(parser)
+    add_compression_arguments(parser)
+    add_profiler_arguments(parser)
+
+    args = parser.parse_args()
+    if args.workers and (args.memory_budget or args.dimension != 3):
+        parser.error("--workers reads whole 3D volumes; it cannot be combined with --memory_budget or another --dimension.")
+    if args.cache and (args.memory_budget or args.dimension != 3):
+        parser.error("--cache keeps whole 3D volumes; it cannot be combined with --memory_budget or another --dimension.")
+    profiler = profiler_from_args(args)
+    index = index_from_args(args, args.input_dir)
+    convert_2d_3d(input_dir=args.input_dir, series=args.series, dim=args.dimension, index=index,
+                  memory_budget=args.memory_budget, output_format=args.format, workers=args.workers,
+                  cache=cache_from_args(args), compression=compression_from_args(args))
+    profiler.report()
+
 
-input_dir= "./images/DICOMSeries"
-series = 0
-dim = 3
-convert_2d_3d(input_dir=input_dir,series=series,dim=dim)
\ No newline at end of file
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+# Single-level against multi-resolution registration of the demo image pairs.
+#
+# Every preset of registration_pipeline runs on its demo's pair twice: at the
+# full resolution only, as the demo did, and over PYRAMID_LEVELS. For both
+# runs the table lists the time (fastest of --repeat runs), the iterations
+# per level, the final metric value and the mean squared difference between
+# the fixed image and the resampled moving image. The last column is the mean
+# distance between the points of the fixed grid mapped by the two transforms,
+# i.e. how far apart the two solutions are. D6 has no bundled volume pair, so
+# it registers a synthetic blob volume to a rotated and shifted copy of
+# itself.
+#
+#   python registration_benchmark.py --presets D3 D4 D7 --repeat 3 -o ./output/registration_benchmark.jsonl
+
+import argparse
+import json
+import math
+import os
+
+import itk
+import numpy as np
+
+from registration_pipeline import PRESETS, load_config, register, resample
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIXED = 'BrainProtonDensitySliceBorder20.png'
+# The fixed and moving images of every demo
+PAIRS = {
+    'D1': (FIXED, 'BrainProtonDensitySliceShifted13x17y.png'),
+    'D2': ('BrainT1SliceBorder20.png', 'BrainProtonDensitySliceShifted13x17y.png'),
+    'D3': (FIXED, 'BrainProtonDensitySliceRotated10.png'),
+    'D4': (FIXED, 'BrainProtonDensitySliceR10X13Y17.png'),
+    'D5': (FIXED, 'BrainProtonDensitySliceR10X13Y17S12.png'),
+    'D6': None,
+    'D7': (FIXED, 'BrainProtonDensitySliceR10X13Y17.png'),
+}
+DEFAULT_VOLUME_SIZE = [48, 64, 64]
+# Grid points per axis at which the two transforms are compared
+COMPARISON_POINTS = 16
+
+
+def make_volume_pair(size):
+    """A volume of smooth blobs and a copy rotated by 8 degrees about z and shifted by (5, -3, 2) mm."""
+    rng = np.random.default_rng(0)
+    grid = np.meshgrid(*[np.arange(n, dtype=np.float64) for n in size], indexing='ij')
+    array = np.zeros(size)
+    for _ in range(12):
+        center = rng.uniform(0.2, 0.8, 3) * size
+        width = rng.uniform(3, 8)
+        array += rng.uniform(50, 200) * np.exp(-sum((g - c) ** 2 for g, c in zip(grid, center)) / (2 * width ** 2))
+    fixed_image = itk.image_from_array(array.astype(np.float32))
+
+    transform = itk.VersorRigid3DTransform[itk.D].New()
+    center = [(n - 1) / 2.0 for n in size[::-1]]
+    transform.SetCenter(center)
+    transform.SetRotation(itk.Vector[itk.D, 3]([0.0, 0.0, 1.0]), math.radians(8))
+    transform.SetTranslation([5.0, -3.0, 2.0])
+    return fixed_image, resample(fixed_image, fixed_image, transform)
+
+
+def _fastest(run, repeat):
+    best = None
+    for _ in range(repeat):
+        result = run()
+        if best is None or result['seconds'] < best['seconds']:
+            best = result
+    return best
+
+
+def mean_squared_difference(fixed_image, moving_image, transform):
+    fixed = itk.array_view_from_image(fixed_image).astype(np.float64)
+    moved = itk.array_view_from_image(resample(moving_image, fixed_image, transform)).astype(np.float64)
+    return float(np.mean((fixed - moved) ** 2))
+
+
+def transform_distance(fixed_image, transform1, transform2):
+    """Mean distance between the images of a regular subset of the fixed grid's points under the two transforms."""
+    size = itk.size(fixed_image)
+    axes = [np.unique(np.linspace(0, n - 1, COMPARISON_POINTS).round().astype(int)) for n in size]
+    distances = []
+    for index in np.stack(np.meshgrid(*axes, indexing='ij'), axis=-1).reshape(-1, len(size)):
+        point = fixed_image.TransformIndexToPhysicalPoint([int(i) for i in index])
+        distances.append(np.linalg.norm(np.array(transform1.TransformPoint(point)) - np.array(transform2.TransformPoint(point))))
+    return float(np.mean(distances))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark single-level against multi-resolution registration of the demo pairs.")
+    parser.add_argument("--presets", nargs='+', choices=list(PRESETS), default=list(PRESETS), help="Presets to run.")
+    parser.add_argument("--volume_size", type=int, nargs=3, default=DEFAULT_VOLUME_SIZE, metavar=("Z", "Y", "X"), help="Size of the synthetic D6 volume.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest counts.")
+    parser.add_argument("-o", "--output", help="Also write the results as JSON lines.")
+
+    args = parser.parse_args()
+    results = []
+    print(f"{'preset':<7} {'levels':<7} {'seconds':>8} {'speedup':>8} {'iterations':<16} {'metric':>10} {'mse':>10} {'distance':>9}")
+    for preset in args.presets:
+        if PAIRS[preset] is None:
+            fixed_image, moving_image = make_volume_pair(args.volume_size)
+        else:
+            fixed_image, moving_image = [itk.imread(os.path.join(DIRECTORY, name), itk.F) for name in PAIRS[preset]]
+        # The warm-up loads the preset's registration classes
+        register(fixed_image, moving_image, load_config(preset=preset), verbose=False)
+
+        runs = {}
+        for name, pyramid in [('single', False), ('pyramid', True)]:
+            config = load_config(preset=preset, pyramid=pyramid)
+            runs[name] = _fastest(lambda: register(fixed_image, moving_image, config, verbose=False), args.repeat)
+        distance = transform_distance(fixed_image, runs['single']['transform'], runs['pyramid']['transform'])
+
+        for name, run in runs.items():
+            result = {
+                'preset': preset, 'levels': name, 'seconds': run['seconds'],
+                'speedup': round(runs['single']['seconds'] / run['seconds'], 2),
+                'iterations': [entry['iterations'] for entry in run['levels']],
+                'metric_value': run['metric_value'],
+                'mean_squared_difference': round(mean_squared_difference(fixed_image, moving_image, run['transform']), 3),
+                'transform_distance': round(distance, 4),
+                'parameters': run['parameters'],
+            }
+            results.append(result)
+            iterations = '+'.join(str(n) for n in result['iterations'])
+            print(f"{preset:<7} {name:<7} {result['seconds']:8.3f} {result['speedup']:8.2f} {iterations:<16} "
+                  f"{result['metric_value']:10.4f} {result['mean_squared_difference']:10.2f} {distance:9.3f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print(f"{args.output} written successfully.")
+
+
+if __name__ == "__main__":
+    main()
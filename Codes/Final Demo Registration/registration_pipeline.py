@@ -0,0 +1,333 @@
+# Multi-resolution image registration from a declarative configuration.
+#
+# The D1-D7 demos each build ImageRegistrationMethodv4 by hand and register
+# at the full resolution only. Here a configuration (a dict, or a JSON file
+# of the same shape) names the transform, the metric, the optimizer, the
+# initializer and one entry per resolution level:
+#
+#     {
+#       "transform": "euler2d",
+#       "initializer": "moments",
+#       "metric": {"type": "mattes", "bins": 50, "sampling": "random", "sampling_percentage": 0.25},
+#       "optimizer": {"type": "regular_step", "learning_rate": 1.0, "minimum_step_length": 0.001,
+#                     "relaxation_factor": 0.5, "iterations": 200, "scales": [1.0, 0.1, 0.1]},
+#       "levels": [{"shrink_factor": 4, "smoothing_sigma": 2},
+#                  {"shrink_factor": 2, "smoothing_sigma": 1, "learning_rate_scale": 0.25, "iterations": 100},
+#                  {"shrink_factor": 1, "smoothing_sigma": 0, "learning_rate_scale": 0.0625, "iterations": 50}]
+#     }
+#
+# Early levels run on shrunken, smoothed images, where every iteration is
+# cheap and the capture range is wide. Each later level starts from the
+# previous level's transform, so the full-resolution level only refines it.
+# A level may override the optimizer's iterations and learning_rate, or
+# scale the learning rate with learning_rate_scale: once the transform is
+# close, smaller first steps spare the full-resolution level the iterations
+# it would spend oscillating back down from the coarse levels' step length.
+# register() reports, for every level, the iterations, the final metric
+# value, the stop condition and the time taken. PRESETS holds the settings of
+# the demos (single level, as they were) to start from:
+#
+#   python registration_pipeline.py -f BrainProtonDensitySliceBorder20.png -m BrainProtonDensitySliceR10X13Y17.png --preset D4 --pyramid
+#   python registration_pipeline.py -f fixed.nrrd -m moving.nrrd -c rigid3d.json -o ./output/registered.nrrd --transform_output ./output/rigid.tfm
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import itk
+
+TRANSFORMS = ['translation', 'euler2d', 'similarity2d', 'euler3d', 'versor_rigid3d', 'similarity3d', 'affine']
+METRICS = ['mattes', 'mean_squares', 'correlation']
+OPTIMIZERS = ['regular_step', 'gradient_descent']
+INITIALIZERS = ['none', 'geometry', 'moments']
+SAMPLINGS = ['none', 'random', 'regular']
+
+DEFAULT_CONFIG = {
+    'transform': 'euler2d',
+    'initializer': 'moments',
+    'metric': {'type': 'mattes', 'bins': 50, 'sampling': 'none', 'sampling_percentage': 1.0, 'seed': 121212},
+    'optimizer': {'type': 'regular_step', 'learning_rate': 1.0, 'minimum_step_length': 0.001, 'relaxation_factor': 0.5,
+                  'iterations': 200, 'scales': None},
+    'levels': [{'shrink_factor': 1, 'smoothing_sigma': 0}],
+    # Sigmas in pixels of the level, as the demos' single level used
+    'smoothing_sigmas_in_physical_units': False,
+}
+
+# Three levels, 4x to full resolution, each starting with a quarter of the previous step
+PYRAMID_LEVELS = [
+    {'shrink_factor': 4, 'smoothing_sigma': 2},
+    {'shrink_factor': 2, 'smoothing_sigma': 1, 'learning_rate_scale': 0.25, 'iterations': 100},
+    {'shrink_factor': 1, 'smoothing_sigma': 0, 'learning_rate_scale': 0.0625, 'iterations': 50},
+]
+
+# The settings of the Final Demo Registration notebooks, at their single level
+PRESETS = {
+    'D1': {'transform': 'translation', 'initializer': 'none', 'metric': {'type': 'mean_squares'},
+           'optimizer': {'learning_rate': 4, 'iterations': 20}},
+    'D2': {'transform': 'translation', 'initializer': 'none', 'metric': {'type': 'mattes', 'bins': 50},
+           'optimizer': {'learning_rate': 4, 'iterations': 20}},
+    'D3': {'transform': 'euler2d', 'initializer': 'geometry', 'optimizer': {'scales': [1.0, 0.1, 0.1]}},
+    'D4': {'transform': 'euler2d', 'initializer': 'moments', 'optimizer': {'scales': [1.0, 0.1, 0.1]}},
+    'D5': {'transform': 'similarity2d', 'initializer': 'moments', 'optimizer': {'scales': [1.0, 1.0, 1.0, 1.0]}},
+    'D6': {'transform': 'versor_rigid3d', 'initializer': 'moments'},
+    'D7': {'transform': 'affine', 'initializer': 'moments',
+           'optimizer': {'minimum_step_length': 0.0001, 'scales': [1.0, 1.0, 1.0, 1.0, 0.1, 0.1]}},
+}
+
+
+def _merge(base, update):
+    # Nested dicts are merged, everything else (levels included) replaced
+    merged = copy.deepcopy(base)
+    for key, value in update.items():
+        if isinstance(value, dict) and isinstance(merged.get(key), dict):
+            merged[key] = _merge(merged[key], value)
+        else:
+            merged[key] = copy.deepcopy(value)
+    return merged
+
+
+def load_config(config=None, preset=None, pyramid=False):
+    """The default configuration updated by a preset, then by a config dict or JSON file; pyramid=True uses PYRAMID_LEVELS."""
+    merged = copy.deepcopy(DEFAULT_CONFIG)
+    if preset is not None:
+        if preset not in PRESETS:
+            raise ValueError(f"Unknown preset {preset}; presets are {', '.join(PRESETS)}.")
+        merged = _merge(merged, PRESETS[preset])
+    if isinstance(config, str):
+        with open(config) as f:
+            config = json.load(f)
+    if config:
+        unknown = set(config) - set(DEFAULT_CONFIG)
+        if unknown:
+            raise ValueError(f"Unknown setting(s) {', '.join(sorted(unknown))}; settings are {', '.join(DEFAULT_CONFIG)}.")
+        merged = _merge(merged, config)
+    if pyramid:
+        merged['levels'] = copy.deepcopy(PYRAMID_LEVELS)
+    for name, choices in [('transform', TRANSFORMS), ('initializer', INITIALIZERS)]:
+        if merged[name] not in choices:
+            raise ValueError(f"Unknown {name} {merged[name]}; expected one of {', '.join(choices)}.")
+    for name, choices in [('metric', METRICS), ('optimizer', OPTIMIZERS)]:
+        if merged[name]['type'] not in choices:
+            raise ValueError(f"Unknown {name} {merged[name]['type']}; expected one of {', '.join(choices)}.")
+    if merged['metric']['sampling'] not in SAMPLINGS:
+        raise ValueError(f"Unknown sampling {merged['metric']['sampling']}; expected one of {', '.join(SAMPLINGS)}.")
+    if not merged['levels']:
+        raise ValueError("At least one level is needed.")
+    return merged
+
+
+def _new_transform(name, dimension):
+    if name in ('euler2d', 'similarity2d') and dimension != 2 or name in ('euler3d', 'versor_rigid3d', 'similarity3d') and dimension != 3:
+        raise ValueError(f"A {name} transform does not fit {dimension}D images.")
+    if name == 'translation':
+        return itk.TranslationTransform[itk.D, dimension].New()
+    if name == 'affine':
+        return itk.AffineTransform[itk.D, dimension].New()
+    return {
+        'euler2d': itk.Euler2DTransform, 'similarity2d': itk.Similarity2DTransform, 'euler3d': itk.Euler3DTransform,
+        'versor_rigid3d': itk.VersorRigid3DTransform, 'similarity3d': itk.Similarity3DTransform,
+    }[name][itk.D].New()
+
+
+def _center(image, initializer):
+    # Physical center of the image grid, or its intensity center of gravity
+    if initializer == 'moments':
+        moments = itk.ImageMomentsCalculator[type(image)].New()
+        moments.SetImage(image)
+        moments.Compute()
+        return [float(value) for value in moments.GetCenterOfGravity()]
+    region = image.GetLargestPossibleRegion()
+    dimension = image.GetImageDimension()
+    center_index = itk.ContinuousIndex[itk.D, dimension]()
+    for i in range(dimension):
+        center_index[i] = region.GetIndex()[i] + (region.GetSize()[i] - 1) / 2.0
+    return list(image.TransformContinuousIndexToPhysicalPoint(center_index))
+
+
+def initialize_transform(transform, fixed_image, moving_image, initializer):
+    """Center the transform on the fixed image and translate it onto the moving one, like the demos' initializers."""
+    if initializer == 'none':
+        return transform
+    fixed_center = _center(fixed_image, initializer)
+    moving_center = _center(moving_image, initializer)
+    offset = [moving - fixed for moving, fixed in zip(moving_center, fixed_center)]
+    if hasattr(transform, 'SetCenter'):
+        transform.SetCenter(fixed_center)
+        transform.SetTranslation(offset)
+    else:
+        # A TranslationTransform's parameters are its offset
+        parameters = transform.GetParameters()
+        for i, value in enumerate(offset):
+            parameters[i] = value
+        transform.SetParameters(parameters)
+    return transform
+
+
+def _new_metric(settings, image_type):
+    if settings['type'] == 'mattes':
+        metric = itk.MattesMutualInformationImageToImageMetricv4[image_type, image_type].New()
+        metric.SetNumberOfHistogramBins(settings['bins'])
+        return metric
+    if settings['type'] == 'mean_squares':
+        return itk.MeanSquaresImageToImageMetricv4[image_type, image_type].New()
+    return itk.CorrelationImageToImageMetricv4[image_type, image_type].New()
+
+
+def _new_optimizer(settings, metric):
+    if settings['type'] == 'regular_step':
+        optimizer = itk.RegularStepGradientDescentOptimizerv4.New(
+            LearningRate=settings['learning_rate'],
+            MinimumStepLength=settings['minimum_step_length'],
+            RelaxationFactor=settings['relaxation_factor'],
+            NumberOfIterations=settings['iterations'],
+        )
+    else:
+        optimizer = itk.GradientDescentOptimizerv4.New(
+            LearningRate=settings['learning_rate'],
+            NumberOfIterations=settings['iterations'],
+        )
+    if settings['scales'] == 'physical_shift':
+        scales_estimator = itk.RegistrationParameterScalesFromPhysicalShift[type(metric)].New()
+        scales_estimator.SetMetric(metric)
+        optimizer.SetScalesEstimator(scales_estimator)
+    elif settings['scales'] is not None:
+        optimizer.SetScales(itk.OptimizerParameters[itk.D](settings['scales']))
+    return optimizer
+
+
+def register(fixed_image, moving_image, config=None, verbose=True):
+    """Register moving_image to fixed_image (both float images) level by level; returns the transform and per-level report."""
+    config = config if config is not None else load_config()
+    dimension = fixed_image.GetImageDimension()
+    image_type = type(fixed_image)
+    levels = config['levels']
+
+    transform = initialize_transform(_new_transform(config['transform'], dimension), fixed_image, moving_image,
+                                     config['initializer'])
+    metric = _new_metric(config['metric'], image_type)
+    optimizer = _new_optimizer(config['optimizer'], metric)
+    registration = itk.ImageRegistrationMethodv4[image_type, image_type].New(
+        FixedImage=fixed_image,
+        MovingImage=moving_image,
+        Metric=metric,
+        Optimizer=optimizer,
+        InitialTransform=transform,
+    )
+    registration.SetNumberOfLevels(len(levels))
+    registration.SetShrinkFactorsPerLevel([level['shrink_factor'] for level in levels])
+    registration.SetSmoothingSigmasPerLevel([level['smoothing_sigma'] for level in levels])
+    registration.SetSmoothingSigmasAreSpecifiedInPhysicalUnits(config['smoothing_sigmas_in_physical_units'])
+    sampling = config['metric']['sampling']
+    if sampling != 'none':
+        registration.SetMetricSamplingStrategy(getattr(itk.ImageRegistrationMethodv4Enums, f'MetricSamplingStrategy_{sampling.upper()}'))
+        registration.SetMetricSamplingPercentage(config['metric']['sampling_percentage'])
+        registration.MetricSamplingReinitializeSeed(config['metric']['seed'])
+
+    report = []
+    clock = {'start': None}
+
+    def finish_level():
+        # Called when the next level starts and once after the last one
+        level = levels[len(report)]
+        seconds = time.perf_counter() - clock['start']
+        report.append({
+            'level': len(report) + 1,
+            'shrink_factor': level['shrink_factor'],
+            'smoothing_sigma': level['smoothing_sigma'],
+            'iterations': int(optimizer.GetCurrentIteration()),
+            'metric_value': float(optimizer.GetValue()),
+            'seconds': round(seconds, 4),
+            'stop_condition': optimizer.GetStopConditionDescription(),
+        })
+        if verbose:
+            entry = report[-1]
+            print(f"Level {entry['level']}/{len(levels)} (shrink {entry['shrink_factor']}, sigma {entry['smoothing_sigma']}): "
+                  f"{entry['iterations']} iterations, metric {entry['metric_value']:.6f}, {seconds:.3f} s")
+
+    def start_level():
+        if clock['start'] is not None:
+            finish_level()
+        level = levels[registration.GetCurrentLevel()]
+        # Per-level optimizer overrides, falling back to the optimizer's settings
+        learning_rate = level.get('learning_rate', config['optimizer']['learning_rate'])
+        optimizer.SetLearningRate(learning_rate * level.get('learning_rate_scale', 1.0))
+        optimizer.SetNumberOfIterations(level.get('iterations', config['optimizer']['iterations']))
+        clock['start'] = time.perf_counter()
+
+    registration.AddObserver(itk.MultiResolutionIterationEvent(), start_level)
+    start = time.perf_counter()
+    registration.Update()
+    finish_level()
+    seconds = time.perf_counter() - start
+
+    final_transform = registration.GetTransform()
+    if verbose:
+        print(f"{sum(entry['iterations'] for entry in report)} iterations over {len(levels)} levels in {seconds:.3f} s; "
+              f"parameters {[round(value, 6) for value in final_transform.GetParameters()]}")
+    return {
+        'transform': final_transform,
+        'parameters': list(final_transform.GetParameters()),
+        'fixed_parameters': list(final_transform.GetFixedParameters()),
+        'metric_value': report[-1]['metric_value'],
+        'iterations': sum(entry['iterations'] for entry in report),
+        'seconds': round(seconds, 4),
+        'levels': report,
+    }
+
+
+def resample(moving_image, fixed_image, transform):
+    """The moving image on the fixed image's grid through the transform, linearly interpolated."""
+    resampler = itk.ResampleImageFilter.New(Input=moving_image, Transform=transform, UseReferenceImage=True)
+    resampler.SetReferenceImage(fixed_image)
+    resampler.SetInterpolator(itk.LinearInterpolateImageFunction.New(moving_image))
+    resampler.Update()
+    return resampler.GetOutput()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-resolution registration of a moving image to a fixed image.")
+    parser.add_argument("-f", "--fixed", required=True, help="Fixed image.")
+    parser.add_argument("-m", "--moving", required=True, help="Moving image.")
+    parser.add_argument("-c", "--config", help="JSON configuration (see the top of this file).")
+    parser.add_argument("--preset", choices=list(PRESETS), help="Start from the settings of a demo notebook.")
+    parser.add_argument("--pyramid", action="store_true", help="Register over shrink factors 4, 2, 1 with sigmas 2, 1, 0 (PYRAMID_LEVELS).")
+    parser.add_argument("--shrink_factors", type=int, nargs='+', help="Shrink factor of every level.")
+    parser.add_argument("--smoothing_sigmas", type=float, nargs='+', help="Smoothing sigma of every level.")
+    parser.add_argument("-o", "--output", help="Write the moving image resampled onto the fixed grid.")
+    parser.add_argument("--transform_output", help="Write the final transform (.tfm or .h5).")
+    parser.add_argument("--report", help="Write the per-level report as JSON.")
+
+    args = parser.parse_args()
+    if (args.shrink_factors is None) != (args.smoothing_sigmas is None) or \
+            args.shrink_factors and len(args.shrink_factors) != len(args.smoothing_sigmas):
+        parser.error("--shrink_factors and --smoothing_sigmas need one value per level each.")
+    config = load_config(args.config, args.preset, args.pyramid)
+    if args.shrink_factors:
+        config['levels'] = [{'shrink_factor': shrink, 'smoothing_sigma': sigma}
+                            for shrink, sigma in zip(args.shrink_factors, args.smoothing_sigmas)]
+
+    fixed_image = itk.imread(args.fixed, itk.F)
+    moving_image = itk.imread(args.moving, itk.F)
+    result = register(fixed_image, moving_image, config)
+
+    if args.report:
+        os.makedirs(os.path.dirname(args.report) or '.', exist_ok=True)
+        with open(args.report, 'w') as f:
+            json.dump({'config': config, **{key: value for key, value in result.items() if key != 'transform'}}, f, indent=2)
+        print(f"{args.report} written successfully.")
+    for path, write in [(args.transform_output, lambda path: itk.transformwrite([result['transform']], path)),
+                        (args.output, lambda path: itk.imwrite(resample(moving_image, fixed_image, result['transform']), path))]:
+        if path is None:
+            continue
+        try:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            write(path)
+            print(f"{path} written successfully.")
+        except Exception as e:
+            print(f"Exception caught while writing {path}!", str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,294 @@
+# Volume writing with a selectable compression level and multithreaded deflate.
+#
+# ITK's NRRD and MetaImage writers compress the whole buffer with one zlib
+# call on one thread, and UseCompressionOn() leaves the level at the ImageIO's
+# default. With more than one compression thread, .nrrd and .mha files are
+# written here with the same headers ITK writes, but the data is deflated in
+# chunks on a thread pool (zlib releases the GIL), the way pigz does it: every
+# chunk is primed with the 32 KB before it and ends on a byte boundary, so the
+# chunks join into one ordinary deflate stream, inside a gzip member for NRRD
+# and a zlib stream for MetaImage, which any reader of these formats inflates
+# as usual. Chunks are handed out as the data arrives, so a volume can also be
+# written slab by slab (series_streaming.py) with only a few chunks in flight.
+#
+# ITK deflates with its bundled zlib-ng, several times faster per thread than
+# the zlib Python uses (and, at level 1, for a lower ratio), so a single
+# thread goes through ImageFileWriter with the level set on its ImageIO; the
+# threaded path wins once there are enough cores to make up for it
+# (compression_benchmark.py measures where). The ITK build here reads deflate,
+# and nothing else, in NRRD, MetaImage and NIfTI files, so --compression
+# chooses between deflate and none; the level runs from 1 (fastest) to 9
+# (smallest). Without a level ImageFileWriter keeps its ImageIO's default
+# (2), and the threaded path deflates at that level too. Other formats and images with vector pixels always go through
+# ImageFileWriter.
+
+import os
+import struct
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+
+COMPRESSIONS = ['deflate', 'none']
+# None keeps the ImageIO's own level, ITK_DEFAULT_LEVEL for NrrdImageIO and MetaImageIO
+DEFAULT_LEVEL = None
+ITK_DEFAULT_LEVEL = 2
+
+# Uncompressed bytes per chunk; each chunk costs a little ratio, since its first match only sees 32 KB back
+CHUNK_BYTES = 1 << 20
+# Deflate's window, which primes the next chunk
+WINDOW_BYTES = 32 * 1024
+
+NRRD_TYPES = {
+    'int8': 'signed char', 'uint8': 'uchar', 'int16': 'short', 'uint16': 'ushort',
+    'int32': 'int', 'uint32': 'uint', 'int64': 'longlong', 'uint64': 'ulonglong',
+    'float32': 'float', 'float64': 'double',
+}
+
+MET_TYPES = {
+    'int8': 'MET_CHAR', 'uint8': 'MET_UCHAR', 'int16': 'MET_SHORT', 'uint16': 'MET_USHORT',
+    'int32': 'MET_INT', 'uint32': 'MET_UINT', 'int64': 'MET_LONG_LONG', 'uint64': 'MET_ULONG_LONG',
+    'float32': 'MET_FLOAT', 'float64': 'MET_DOUBLE',
+}
+
+# Width reserved for the MetaImage CompressedDataSize, filled in once the data is written
+_SIZE_FIELD = 20
+
+
+def _deflate_chunk(data, dictionary, level, last):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=dictionary) if dictionary \
+        else zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    return compressor.compress(data) + compressor.flush(zlib.Z_FINISH if last else zlib.Z_SYNC_FLUSH)
+
+
+class DeflateStream:
+    """File-like writer deflating in parallel chunks into a gzip ('gzip') or zlib ('zlib') container."""
+
+    def __init__(self, f, container='gzip', level=DEFAULT_LEVEL, threads=None):
+        self._f = f
+        self._container = container
+        self._level = ITK_DEFAULT_LEVEL if level is None else level
+        self._pool = ThreadPoolExecutor(max_workers=threads or os.cpu_count())
+        self._threads = self._pool._max_workers
+        self._pending = deque()
+        self._buffer = bytearray()
+        self._window = b''
+        self._check = zlib.crc32(b'') if container == 'gzip' else zlib.adler32(b'')
+        self._size = 0
+        self.compressed_bytes = 0
+        if container == 'gzip':
+            # No name, mtime 0 like the gzip writes elsewhere in the repo, unknown OS
+            self._emit(b'\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff')
+        else:
+            self._emit(b'\x78\x9c')
+
+    def _emit(self, data):
+        self._f.write(data)
+        self.compressed_bytes += len(data)
+
+    def _submit(self, data, last):
+        self._check = zlib.crc32(data, self._check) if self._container == 'gzip' else zlib.adler32(data, self._check)
+        self._size += len(data)
+        self._pending.append(self._pool.submit(_deflate_chunk, data, self._window, self._level, last))
+        self._window = bytes(data[-WINDOW_BYTES:])
+        # Chunks are written in order; a few stay queued per thread so memory stays bounded
+        while len(self._pending) > 2 * self._threads:
+            self._emit(self._pending.popleft().result())
+
+    def write(self, data):
+        view = memoryview(data).cast('B')
+        if self._buffer:
+            # Top up the partial chunk left by the previous write first
+            take = CHUNK_BYTES - len(self._buffer)
+            self._buffer += view[:take]
+            view = view[take:]
+            if len(self._buffer) < CHUNK_BYTES:
+                return
+            self._submit(bytes(self._buffer), False)
+            self._buffer = bytearray()
+        # Chunks are copied: callers may reuse their buffer (e.g. the next slab) once write() returns
+        while len(view) >= CHUNK_BYTES:
+            self._submit(view[:CHUNK_BYTES].tobytes(), False)
+            view = view[CHUNK_BYTES:]
+        self._buffer += view
+
+    def close(self):
+        self._submit(bytes(self._buffer), True)
+        self._buffer = bytearray()
+        while self._pending:
+            self._emit(self._pending.popleft().result())
+        self._pool.shutdown()
+        if self._container == 'gzip':
+            self._emit(struct.pack('<II', self._check, self._size & 0xffffffff))
+        else:
+            self._emit(struct.pack('>I', self._check))
+        return self.compressed_bytes
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            self._pool.shutdown(cancel_futures=True)
+
+
+def _number(value):
+    # Same formatting as teem, which NrrdImageIO writes with
+    return format(float(value), '.17g')
+
+
+def _vector(values):
+    return '(' + ','.join(_number(value) for value in values) + ')'
+
+
+def _dtype(image):
+    return itk.template(image)[1][0].dtype
+
+
+def nrrd_header(image, encoding='gzip'):
+    size = list(image.GetLargestPossibleRegion().GetSize())
+    dimension = len(size)
+    spacing = list(image.GetSpacing())
+    direction = itk.array_from_matrix(image.GetDirection())
+    lines = [
+        'NRRD0004',
+        '# Complete NRRD file format specification at:',
+        '# http://teem.sourceforge.net/nrrd/format.html',
+        f'type: {NRRD_TYPES[_dtype(image).name]}',
+        f'dimension: {dimension}',
+    ]
+    if dimension == 3:
+        lines.append('space: left-posterior-superior')
+    else:
+        lines.append(f'space dimension: {dimension}')
+    lines += [
+        'sizes: ' + ' '.join(str(s) for s in size),
+        'space directions: ' + ' '.join(_vector(direction[:, axis] * spacing[axis]) for axis in range(dimension)),
+        'kinds: ' + ' '.join(['domain'] * dimension),
+        'endian: little',
+        f'encoding: {encoding}',
+        'space origin: ' + _vector(image.GetOrigin()),
+    ]
+    # String entries of the metadata dictionary, written as key/value pairs like NrrdImageIO does
+    metadata = image.GetMetaDataDictionary()
+    for key in metadata.GetKeys():
+        try:
+            value = metadata[key]
+        except RuntimeError:
+            continue
+        if isinstance(value, str) and not key.startswith('NRRD_') and '\n' not in value:
+            lines.append(f'{key}:={value}')
+    return ('\n'.join(lines) + '\n\n').encode()
+
+
+def _orientation(direction):
+    # MetaImageIO's AnatomicalOrientation: the closest axis of every direction column
+    letters = []
+    for axis in range(direction.shape[1]):
+        column = direction[:, axis]
+        k = int(abs(column).argmax())
+        letters.append(('RAI' if column[k] > 0 else 'LPS')[k] if k < 3 else '?')
+    return ''.join(letters)
+
+
+def mha_header(image, compressed):
+    size = list(image.GetLargestPossibleRegion().GetSize())
+    direction = itk.array_from_matrix(image.GetDirection())
+    lines = [
+        'ObjectType = Image',
+        f'NDims = {len(size)}',
+        'BinaryData = True',
+        'BinaryDataByteOrderMSB = False',
+        f'CompressedData = {compressed}',
+    ]
+    if compressed:
+        lines.append('CompressedDataSize = ' + ' ' * _SIZE_FIELD)
+    lines += [
+        # Written column by column, like MetaImageIO
+        'TransformMatrix = ' + ' '.join(_number(value) for value in direction.T.flatten()),
+        'Offset = ' + ' '.join(_number(value) for value in image.GetOrigin()),
+        'CenterOfRotation = ' + ' '.join(['0'] * len(size)),
+        f'AnatomicalOrientation = {_orientation(direction)}',
+        'ElementSpacing = ' + ' '.join(_number(value) for value in image.GetSpacing()),
+        'DimSize = ' + ' '.join(str(s) for s in size),
+        f'ElementType = {MET_TYPES[_dtype(image).name]}',
+        'ElementDataFile = LOCAL',
+    ]
+    return ('\n'.join(lines) + '\n').encode()
+
+
+class VolumeFileWriter:
+    """Writes the voxels of an image to a .nrrd or .mha file in one or more slabs along the slowest axis."""
+
+    def __init__(self, image, output_path, compression='deflate', level=DEFAULT_LEVEL, threads=None):
+        self.extension = os.path.splitext(output_path)[1].lower()
+        if self.extension not in ('.nrrd', '.mha'):
+            raise RuntimeError(f"VolumeFileWriter writes .nrrd or .mha files, not {self.extension}.")
+        self.compressed = compression == 'deflate'
+        self._dtype = _dtype(image).newbyteorder('<')
+        self._f = open(output_path, 'wb')
+        if self.extension == '.nrrd':
+            self._f.write(nrrd_header(image, 'gzip' if self.compressed else 'raw'))
+        else:
+            header = mha_header(image, self.compressed)
+            self._size_offset = header.find(b'CompressedDataSize = ') + len(b'CompressedDataSize = ')
+            self._f.write(header)
+        self._stream = DeflateStream(self._f, 'gzip' if self.extension == '.nrrd' else 'zlib', level, threads) \
+            if self.compressed else None
+
+    def write(self, array):
+        # x runs fastest in both NumPy and file order
+        data = array.astype(self._dtype, copy=False)
+        if not data.flags.c_contiguous:
+            data = data.copy()
+        (self._stream or self._f).write(data.data)
+
+    def close(self):
+        if self._stream is not None:
+            size = self._stream.close()
+            if self.extension == '.mha':
+                self._f.seek(self._size_offset)
+                self._f.write(str(size).ljust(_SIZE_FIELD).encode())
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        if exc_info[0] is None:
+            self.close()
+        else:
+            if self._stream is not None:
+                self._stream.__exit__(*exc_info)
+            self._f.close()
+
+
+def write_volume(image, output_path, compression='deflate', level=DEFAULT_LEVEL, threads=None):
+    """Write an image with the chosen compression; with several threads .nrrd and .mha files are deflated in chunks."""
+    extension = os.path.splitext(output_path)[1].lower()
+    if compression == 'deflate' and (threads or 1) > 1 and extension in ('.nrrd', '.mha') \
+            and image.GetNumberOfComponentsPerPixel() == 1 and _dtype(image).name in NRRD_TYPES:
+        with VolumeFileWriter(image, output_path, compression, level, threads) as writer:
+            writer.write(itk.array_view_from_image(image))
+        return
+    writer = itk.ImageFileWriter[type(image)].New()
+    writer.SetFileName(output_path)
+    writer.SetInput(image)
+    writer.SetUseCompression(compression == 'deflate')
+    if level is not None:
+        writer.SetCompressionLevel(level)
+    writer.Update()
+
+
+def add_compression_arguments(parser):
+    parser.add_argument("--compression", choices=COMPRESSIONS, default='deflate', help="Compression of the output volume.")
+    parser.add_argument("--compression_level", type=int, default=DEFAULT_LEVEL, choices=range(1, 10), metavar="{1..9}", help=f"Deflate level: 1 is fastest, 9 smallest (default: the writer's own, {ITK_DEFAULT_LEVEL}).")
+    parser.add_argument("--compression_threads", type=int, help="Threads deflating .nrrd and .mha outputs in chunks (default: 1, ITK's own single-threaded writer).")
+
+
+def compression_from_args(args):
+    # Keyword arguments of write_volume()
+    return {'compression': args.compression, 'level': args.compression_level, 'threads': args.compression_threads}
@@ -0,0 +1,142 @@
+# Write time, read time and compression ratio of the volume codecs.
+#
+# Every volume is written as .nrrd and .mha with ITK's own writer at each
+# compression level (one thread, the level set on its ImageIO), with the
+# chunked deflate of compressed_writer.VolumeFileWriter at the same levels on
+# the chosen numbers of threads, and uncompressed; each file is then read back
+# with itk.imread. The default volumes are deterministic phantoms of the three
+# kinds of data the pipelines write: a CT (int16 Hounsfield units with noise),
+# an MR (uint16 with a smooth bias field and noise) and a label map (uint8).
+# Real volumes can be given with -i instead.
+#
+#   python compression_benchmark.py --levels 1 2 6 9 --threads 1 4 8
+
+import argparse
+import json
+import os
+import tempfile
+import time
+
+import itk
+import numpy as np
+
+from compressed_writer import VolumeFileWriter
+
+DEFAULT_SIZE = [128, 256, 256]
+
+
+def _ellipsoid(shape, center, radii):
+    grids = np.ogrid[tuple(slice(0, n) for n in shape)]
+    return sum(((g - c) / r) ** 2 for g, c, r in zip(grids, center, radii)) <= 1.0
+
+
+def make_phantoms(size):
+    rng = np.random.default_rng(0)
+    z, y, x = size
+    body = _ellipsoid(size, (z / 2, y / 2, x / 2), (z * 0.48, y * 0.4, x * 0.45))
+    lungs = _ellipsoid(size, (z / 2, y / 2, x * 0.32), (z * 0.35, y * 0.25, x * 0.12)) | \
+        _ellipsoid(size, (z / 2, y / 2, x * 0.68), (z * 0.35, y * 0.25, x * 0.12))
+    bone = body & ~_ellipsoid(size, (z / 2, y / 2, x / 2), (z * 0.46, y * 0.37, x * 0.42))
+
+    ct = np.full(size, -1000.0)
+    ct[body] = 40.0
+    ct[lungs] = -820.0
+    ct[bone] = 700.0
+    ct = (ct + rng.normal(0.0, 12.0, size)).astype(np.int16)
+
+    bias = 1.0 + 0.3 * np.sin(np.linspace(0, np.pi, x))[None, None, :] * np.cos(np.linspace(0, np.pi / 2, y))[None, :, None]
+    mr = np.zeros(size)
+    mr[body] = 600.0
+    mr[lungs] = 150.0
+    mr[bone] = 1100.0
+    mr = np.clip(mr * bias + np.abs(rng.normal(0.0, 25.0, size)), 0, 65535).astype(np.uint16)
+
+    labels = np.zeros(size, dtype=np.uint8)
+    labels[body] = 1
+    labels[lungs] = 2
+    labels[bone] = 3
+
+    phantoms = {}
+    for name, array in [('ct', ct), ('mr', mr), ('labels', labels)]:
+        image = itk.image_from_array(array)
+        image.SetSpacing([0.8, 0.8, 2.0])
+        phantoms[name] = image
+    return phantoms
+
+
+def _itk_write(image, path, level):
+    writer = itk.ImageFileWriter[type(image)].New()
+    writer.SetFileName(path)
+    writer.SetInput(image)
+    writer.SetUseCompression(level is not None)
+    if level is not None:
+        writer.SetCompressionLevel(level)
+    writer.Update()
+
+
+def run_case(image, path, codec, level, threads, repeat):
+    # Fastest of the repeats for the write and the read
+    writes, reads = [], []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        if codec == 'itk':
+            _itk_write(image, path, level)
+        elif codec == 'threaded':
+            with VolumeFileWriter(image, path, 'deflate', level, threads) as writer:
+                writer.write(itk.array_view_from_image(image))
+        else:
+            _itk_write(image, path, None)
+        writes.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        itk.imread(path)
+        reads.append(time.perf_counter() - start)
+    raw_bytes = itk.array_view_from_image(image).nbytes
+    file_bytes = os.path.getsize(path)
+    return {'write_seconds': round(min(writes), 4), 'read_seconds': round(min(reads), 4), 'file_bytes': file_bytes,
+            'ratio': round(raw_bytes / file_bytes, 3), 'write_mb_per_second': round(raw_bytes / 2**20 / min(writes), 1)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark write time, read time and ratio of the volume compression codecs.")
+    parser.add_argument("-i", "--inputs", nargs='+', help="Volumes to benchmark (default: CT, MR and label phantoms).")
+    parser.add_argument("--size", type=int, nargs=3, default=DEFAULT_SIZE, metavar=("Z", "Y", "X"), help="Size of the phantoms.")
+    parser.add_argument("--formats", nargs='+', choices=['nrrd', 'mha'], default=['nrrd', 'mha'], help="Output formats.")
+    parser.add_argument("--levels", type=int, nargs='+', default=[1, 2, 6, 9], help="Deflate levels (2 is the writers' default).")
+    parser.add_argument("--threads", type=int, nargs='+', default=[os.cpu_count()], help="Thread counts of the threaded codec.")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per case; the fastest counts.")
+    parser.add_argument("-o", "--output", help="Also write the results as JSON lines.")
+
+    args = parser.parse_args()
+    if args.inputs:
+        volumes = {os.path.basename(path): itk.imread(path) for path in args.inputs}
+    else:
+        volumes = make_phantoms(args.size)
+
+    cases = [('none', None, None)] + [('itk', level, 1) for level in args.levels] + \
+        [('threaded', level, threads) for level in args.levels for threads in args.threads]
+    results = []
+    print(f"{'volume':<10} {'format':<6} {'codec':<9} {'level':>5} {'threads':>7} {'write s':>9} {'MB/s':>8} {'read s':>8} {'ratio':>7}")
+    with tempfile.TemporaryDirectory() as workdir:
+        for name, image in volumes.items():
+            for extension in args.formats:
+                path = os.path.join(workdir, f'volume.{extension}')
+                # The warm-up loads the writer and reader templates
+                _itk_write(image, path, None)
+                itk.imread(path)
+                for codec, level, threads in cases:
+                    result = {'volume': name, 'format': extension, 'codec': codec, 'level': level, 'threads': threads,
+                              **run_case(image, path, codec, level, threads, args.repeat)}
+                    results.append(result)
+                    print(f"{name:<10} {extension:<6} {codec:<9} {level if level is not None else '-':>5} {threads or '-':>7} "
+                          f"{result['write_seconds']:9.3f} {result['write_mb_per_second']:8.1f} {result['read_seconds']:8.3f} {result['ratio']:7.2f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print(f"{args.output} written successfully.")
+
+
+if __name__ == "__main__":
+    main()
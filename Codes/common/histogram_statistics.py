@@ -0,0 +1,250 @@
+# Histograms, entropy and mutual information of images and volumes.
+#
+# np.histogram and np.histogram2d convert every voxel to float and search the
+# bin edges for it, and the joint histogram of two volumes is usually built
+# from float copies of both. Here the arrays (e.g. itk.array_view_from_image
+# views) are read in chunks on a thread pool and never copied whole:
+#
+# - integer pixels are counted per value with np.bincount, and the value
+#   counts are then put into bins once, so the bins cost one pass over at most
+#   a few thousand values instead of the volume;
+# - a joint histogram maps each chunk to bin numbers (through a per-value
+#   lookup table for integer pixels) and counts bin pairs with np.bincount;
+# - coarser histograms are sums of neighbouring bins of one fine histogram
+#   (coarsen()), so 256, 128, 64 and 4 bins need a single pass.
+#
+# Bins follow np.histogram (np.histogram2d for joint histograms, down to the
+# dtype of the edges): `bins` equal bins over `value_range`, the last one
+# closed, voxels outside ignored; without a range, the minimum and maximum of
+# the data. Entropies are in bits.
+#
+#   python histogram_statistics.py -i fixed.nrrd moving.nrrd
+#   python histogram_statistics.py --pairs pairs.csv -o ./output/mutual_information.jsonl
+
+import argparse
+import json
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+import numpy as np
+
+DEFAULT_BINS = 256
+
+# Voxels per chunk; each thread holds a few temporaries of this many 8-byte numbers
+CHUNK_VOXELS = 1 << 20
+
+# Integer pixels spanning more values than this are binned like floats
+MAX_LOOKUP_VALUES = 1 << 24
+
+
+def _flat(array):
+    if hasattr(array, 'GetBufferedRegion'):
+        array = itk.array_view_from_image(array)
+    # A view for contiguous arrays
+    return np.asarray(array).reshape(-1)
+
+
+def _map_chunks(function, arrays, threads):
+    # function(*chunks) for every chunk of the flattened arrays, on a thread pool
+    size = arrays[0].size
+    starts = range(0, size, CHUNK_VOXELS)
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        return list(pool.map(lambda start: function(*(a[start:start + CHUNK_VOXELS] for a in arrays)), starts))
+
+
+def _is_integer(array):
+    return np.issubdtype(array.dtype, np.integer) or array.dtype == np.bool_
+
+
+def data_range(array, threads=None):
+    """Minimum and maximum of an array or image."""
+    flat = _flat(array)
+    if flat.size == 0:
+        raise ValueError("Empty array.")
+    ranges = _map_chunks(lambda chunk: (chunk.min(), chunk.max()), [flat], threads)
+    return min(low for low, _ in ranges).item(), max(high for _, high in ranges).item()
+
+
+def bin_edges(value_range, bins=DEFAULT_BINS, dtype=np.float64):
+    """The bins + 1 edges np.histogram uses for equal bins over value_range (in the data's dtype for float data)."""
+    # The ends keep their type: NumPy steps float32 ends in float32
+    low, high = value_range
+    if low > high:
+        raise ValueError(f"Range {value_range} runs backwards.")
+    if low == high:
+        low, high = low - 0.5, high + 0.5
+    return np.linspace(low, high, bins + 1, dtype=dtype)
+
+
+def _value_bins(values, edges):
+    # Bin number of every value; -1 outside the edges, the last edge belonging to the last bin
+    bins = len(edges) - 1
+    numbers = np.searchsorted(edges, values, side='right') - 1
+    numbers[values == edges[-1]] = bins - 1
+    numbers[(values < edges[0]) | (values > edges[-1])] = -1
+    return numbers
+
+
+class _Binning:
+    # Edges of one array's bins and the bin number of every voxel: through a lookup table over
+    # its values for integer pixels, by searching the edges otherwise. The edges are float64 or,
+    # by default, the dtype of float data, as np.histogram builds them
+    def __init__(self, flat, bins, value_range, threads, edge_dtype=None):
+        self.low = None
+        if _is_integer(flat) or value_range is None:
+            low, high = data_range(flat, threads)
+            if _is_integer(flat) and high - low < MAX_LOOKUP_VALUES:
+                self.low, self.high = low, high
+        if edge_dtype is None:
+            edge_dtype = flat.dtype if np.issubdtype(flat.dtype, np.floating) else np.float64
+        # The data's range in the edges' dtype, as NumPy takes it from the data
+        self.value_range = value_range if value_range is not None else tuple(np.dtype(edge_dtype).type(v) for v in (low, high))
+        self.edges = bin_edges(self.value_range, bins, edge_dtype)
+        if self.low is not None:
+            self.table = _value_bins(np.arange(self.low, self.high + 1, dtype=np.float64), self.edges)
+
+    def __call__(self, chunk):
+        if self.low is not None:
+            return self.table[chunk.astype(np.intp) - self.low]
+        return _value_bins(chunk.astype(self.edges.dtype, copy=False), self.edges)
+
+
+def histogram(array, bins=DEFAULT_BINS, value_range=None, threads=None):
+    """Counts (int64) and edges of the histogram of an array or image, like np.histogram."""
+    flat = _flat(array)
+    binning = _Binning(flat, bins, value_range, threads)
+    edges = binning.edges
+    if binning.low is not None:
+        # Counts per value, then per bin
+        low, high = binning.low, binning.high
+        value_counts = sum(_map_chunks(
+            lambda chunk: np.bincount(chunk.astype(np.intp) - low, minlength=high - low + 1), [flat], threads))
+        inside = binning.table >= 0
+        counts = np.bincount(binning.table[inside], weights=value_counts[inside], minlength=bins)
+        return counts.astype(np.int64), edges
+    # The range, not the edges rounded to the data's dtype, decides which voxels fall outside
+    counts = sum(_map_chunks(lambda chunk: np.histogram(chunk, bins, binning.value_range)[0], [flat], threads))
+    return counts.astype(np.int64), edges
+
+
+def coarsen(counts, bins):
+    """A histogram with fewer bins from a finer one over the same range; bins must divide every axis."""
+    counts = np.asarray(counts)
+    bins = [bins] * counts.ndim if np.isscalar(bins) else list(bins)
+    shape = []
+    for fine, coarse in zip(counts.shape, bins):
+        if fine % coarse:
+            raise ValueError(f"{fine} bins do not split into {coarse} equal groups.")
+        shape += [coarse, fine // coarse]
+    return counts.reshape(shape).sum(axis=tuple(range(1, 2 * counts.ndim, 2)))
+
+
+def joint_histogram(array1, array2, bins=DEFAULT_BINS, value_ranges=None, threads=None):
+    """Joint counts (bins1 x bins2, int64) and both edges of two arrays or images of the same size, like np.histogram2d."""
+    flat1, flat2 = _flat(array1), _flat(array2)
+    if flat1.size != flat2.size:
+        raise ValueError(f"Arrays of {flat1.size} and {flat2.size} voxels.")
+    bins1, bins2 = (bins, bins) if np.isscalar(bins) else bins
+    range1, range2 = value_ranges or (None, None)
+    # np.histogram2d stacks both arrays in their common dtype and builds the edges in it from the
+    # data's range, but in float64 from a given range
+    sample_dtype = np.result_type(flat1.dtype, flat2.dtype)
+    edge_dtypes = [sample_dtype if np.issubdtype(sample_dtype, np.floating) and value_range is None else np.float64
+                   for value_range in (range1, range2)]
+    binning1 = _Binning(flat1, bins1, range1, threads, edge_dtypes[0])
+    binning2 = _Binning(flat2, bins2, range2, threads, edge_dtypes[1])
+
+    def count(chunk1, chunk2):
+        numbers1, numbers2 = binning1(chunk1), binning2(chunk2)
+        pairs = numbers1 * bins2 + numbers2
+        inside = (numbers1 >= 0) & (numbers2 >= 0)
+        if not inside.all():
+            pairs = pairs[inside]
+        return np.bincount(pairs, minlength=bins1 * bins2)
+
+    counts = sum(_map_chunks(count, [flat1, flat2], threads))
+    return counts.reshape(bins1, bins2).astype(np.int64), binning1.edges, binning2.edges
+
+
+def entropy(counts):
+    """Shannon entropy in bits of a histogram of any dimension (counts or probabilities)."""
+    counts = np.asarray(counts, dtype=np.float64).reshape(-1)
+    probabilities = counts[counts > 0] / counts.sum()
+    return float(-np.sum(probabilities * np.log2(probabilities)))
+
+
+def joint_entropy(joint_counts):
+    return entropy(joint_counts)
+
+
+def mutual_information_from_histogram(joint_counts):
+    """Mutual information and both normalizations of a joint histogram, as a dict of bits and ratios."""
+    joint_counts = np.asarray(joint_counts)
+    entropy1 = entropy(joint_counts.sum(axis=1))
+    entropy2 = entropy(joint_counts.sum(axis=0))
+    entropy12 = entropy(joint_counts)
+    mutual_information = entropy1 + entropy2 - entropy12
+    return {
+        'entropy1': entropy1,
+        'entropy2': entropy2,
+        'joint_entropy': entropy12,
+        'mutual_information': mutual_information,
+        # 2 MI / (H1 + H2), 1 for identical images
+        'normalized_mutual_information': 2 * mutual_information / (entropy1 + entropy2) if entropy1 + entropy2 else 0.0,
+        # (H1 + H2) / H12, Studholme's NMI, 2 for identical images
+        'studholme_nmi': (entropy1 + entropy2) / entropy12 if entropy12 else 0.0,
+    }
+
+
+def mutual_information(array1, array2, bins=DEFAULT_BINS, value_ranges=None, threads=None):
+    """Mutual information and both normalizations of two arrays or images of the same size."""
+    counts, _, _ = joint_histogram(array1, array2, bins, value_ranges, threads)
+    return mutual_information_from_histogram(counts)
+
+
+def _read_pairs(path):
+    # One "fixed,moving" pair per line; blank lines and # comments are skipped
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            line = line.strip()
+            if line and not line.startswith('#'):
+                pairs.append([part.strip() for part in line.split(',')][:2])
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mutual information between pairs of images or volumes.")
+    parser.add_argument("-i", "--inputs", nargs=2, metavar=("FIXED", "MOVING"), help="A single pair of images.")
+    parser.add_argument("--pairs", help="File with one 'fixed,moving' pair of paths per line.")
+    parser.add_argument("-b", "--bins", type=int, default=DEFAULT_BINS, help="Bins per image.")
+    parser.add_argument("-t", "--threads", type=int, help="Threads counting each pair (default: all cores).")
+    parser.add_argument("-o", "--output", help="Also write the results as JSON lines.")
+
+    args = parser.parse_args()
+    pairs = ([args.inputs] if args.inputs else []) + (_read_pairs(args.pairs) if args.pairs else [])
+    if not pairs:
+        parser.error("Give a pair with -i or a list of pairs with --pairs.")
+
+    results = []
+    for fixed_path, moving_path in pairs:
+        try:
+            result = mutual_information(itk.imread(fixed_path), itk.imread(moving_path), args.bins, threads=args.threads)
+        except (RuntimeError, ValueError) as e:
+            print(f"Exception caught while comparing {fixed_path} and {moving_path}!", str(e))
+            continue
+        results.append({'fixed': fixed_path, 'moving': moving_path, 'bins': args.bins, **result})
+        print(f"{fixed_path} / {moving_path}: MI = {result['mutual_information']:.6f} bits, "
+              f"NMI = {result['normalized_mutual_information']:.6f}, (H1 + H2) / H12 = {result['studholme_nmi']:.6f}")
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            for result in results:
+                f.write(json.dumps(result) + '\n')
+        print(f"{args.output} written successfully.")
+
+
+if __name__ == "__main__":
+    main()
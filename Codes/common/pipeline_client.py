@@ -0,0 +1,87 @@
+# Thin client for pipeline_daemon.py.
+#
+#   python pipeline_client.py threshold -x 81 -y 112 -l 210 -u 250 -d 5.0
+#
+# takes the same arguments as the script it names and runs it in one of the
+# daemon's warm workers, so the job skips ITK's import and template loading.
+# The client's stdin, stdout and stderr are handed to the worker over the Unix
+# socket, the job runs in the client's working directory, and the client exits
+# with the job's exit status. This module does not import ITK; when no daemon
+# is listening the script is run locally instead.
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+
+CODES_DIR = os.path.abspath(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+# Scripts the daemon runs, relative to Codes/
+SCRIPTS = {
+    'fast_marching_filter': 'level_set_segmentation/fast_marching_filter.py',
+    'shape_detection_segmentation': 'level_set_segmentation/shape_detection_segmentation.py',
+    'geodesic_active_contours': 'level_set_segmentation/geodesic_active_contours.py',
+    'threshold': 'level_set_segmentation/threshold.py',
+    'laplacian': 'level_set_segmentation/laplacian.py',
+    'write3D_from_dicom_series': 'Chapter_2_DICOM_Images/write3D_from_dicom_series.py',
+    'read_write_dicom_series': 'Chapter_2_DICOM_Images/read_write_dicom_series.py',
+}
+
+DEFAULT_SOCKET = os.environ.get('ITK_PIPELINE_SOCKET', os.path.join(tempfile.gettempdir(), f"itk-pipeline-{os.getuid()}.sock"))
+
+# Requests and replies are single JSON lines
+MAX_MESSAGE_BYTES = 1 << 16
+
+
+def script_path(script):
+    return os.path.join(CODES_DIR, SCRIPTS[script])
+
+
+def submit(script, argv, socket_path=DEFAULT_SOCKET):
+    # Raises OSError when no daemon is listening on socket_path
+    request = json.dumps({'script': script, 'argv': argv, 'cwd': os.getcwd()}).encode() + b'\n'
+    if len(request) > MAX_MESSAGE_BYTES:
+        raise ValueError(f"Job arguments exceed {MAX_MESSAGE_BYTES} bytes.")
+
+    sys.stdout.flush()
+    sys.stderr.flush()
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+        connection.connect(socket_path)
+        socket.send_fds(connection, [request], [sys.stdin.fileno(), sys.stdout.fileno(), sys.stderr.fileno()])
+        reply = connection.makefile('rb').readline()
+    if not reply:
+        # The worker died before it could answer
+        print(f"The daemon on {socket_path} closed the connection without a reply.", file=sys.stderr)
+        return 1
+    return json.loads(reply)['exit_code']
+
+
+def run_locally(script, argv):
+    # Replaces this process, so the script sees the same stdio and exit status
+    path = script_path(script)
+    os.execv(sys.executable, [sys.executable, path] + argv)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run a pipeline script in a warm pipeline_daemon.py worker.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket of the daemon.")
+    parser.add_argument("--no_fallback", action="store_true", help="Fail instead of running the script locally when no daemon is listening.")
+    parser.add_argument("script", choices=sorted(SCRIPTS), help="Script to run.")
+    parser.add_argument("script_args", nargs=argparse.REMAINDER, help="Arguments passed on to the script.")
+
+    args = parser.parse_args()
+    try:
+        exit_code = submit(args.script, args.script_args, args.socket)
+    except (FileNotFoundError, ConnectionRefusedError) as e:
+        if args.no_fallback:
+            print(f"No daemon listening on {args.socket}!", str(e), file=sys.stderr)
+            sys.exit(1)
+        print(f"No daemon listening on {args.socket}, running {args.script} locally.", file=sys.stderr)
+        run_locally(args.script, args.script_args)
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
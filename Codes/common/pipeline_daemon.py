@@ -0,0 +1,247 @@
+# Warm worker daemon for the pipeline scripts.
+#
+# Every script start pays ITK's lazy module loading and template
+# instantiation, which takes seconds before the first pixel is read and
+# dominates short jobs on small images. The daemon pays it once: it loads the
+# templates the pipelines use for each --dimensions, imports the scripts of
+# pipeline_client.SCRIPTS, and then forks --workers processes that inherit the
+# loaded modules. Workers take jobs from pipeline_client.py over a Unix socket
+# and run the script's main() with the client's arguments, working directory
+# and stdio. A worker exits after --max_jobs jobs, so state left behind by a
+# job cannot build up, and the daemon forks a fresh one from the warm parent.
+#
+# Jobs run one at a time per worker. ITK's thread pool is created in each
+# worker on its first job, never in the parent, so forking stays safe.
+# --threads sets the per-filter thread budget of jobs that do not pass their
+# own --threads; it defaults to the cores divided among the workers.
+#
+#   python pipeline_daemon.py -w 8 &
+#   python pipeline_client.py threshold -x 81 -y 112 -l 210 -u 250 -d 5.0
+
+import argparse
+import contextlib
+import importlib
+import json
+import os
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import itk
+
+from pipeline_client import DEFAULT_SOCKET, MAX_MESSAGE_BYTES, SCRIPTS, script_path
+from pipeline_profiler import set_thread_count
+
+
+def preload_templates(dimensions):
+    # Looking up a template loads its ITK module; nothing is updated here, so no ITK threads start
+    templates = [itk.GDCMImageIO, itk.GDCMSeriesFileNames, itk.ImageIOFactory, itk.MultiThreaderBase]
+    for dimension in dimensions:
+        F = itk.Image[itk.F, dimension]
+        UC = itk.Image[itk.UC, dimension]
+        SS = itk.Image[itk.SS, dimension]
+        LevelSetNode = itk.LevelSetNode[itk.F, dimension]
+        templates += [
+            itk.ImageFileReader[F], itk.ImageFileReader[UC], itk.ImageFileReader[SS],
+            itk.ImageFileWriter[F], itk.ImageFileWriter[UC], itk.ImageFileWriter[SS],
+            itk.ImageSeriesReader[F], itk.ImageSeriesReader[SS],
+            itk.CurvatureAnisotropicDiffusionImageFilter[F, F],
+            itk.GradientAnisotropicDiffusionImageFilter[F, F],
+            itk.GradientMagnitudeRecursiveGaussianImageFilter[F, F],
+            itk.SigmoidImageFilter[F, F],
+            LevelSetNode, itk.VectorContainer[itk.UI, LevelSetNode],
+            itk.FastMarchingImageFilter[F, F],
+            itk.ShapeDetectionLevelSetImageFilter[F, F, itk.F],
+            itk.GeodesicActiveContourLevelSetImageFilter[F, F, itk.F],
+            itk.ThresholdSegmentationLevelSetImageFilter[F, F, itk.F],
+            itk.LaplacianSegmentationLevelSetImageFilter[F, F, itk.F],
+            itk.BinaryThresholdImageFilter[F, UC],
+            itk.RescaleIntensityImageFilter[F, UC],
+            itk.ExtractImageFilter[F, F],
+            itk.ImageDuplicator[F], itk.ImageDuplicator[UC],
+            itk.BinShrinkImageFilter[F, F],
+            itk.ResampleImageFilter[F, F],
+            itk.ShiftScaleImageFilter[F, F],
+            itk.PyBuffer[F], itk.PyBuffer[UC],
+        ]
+        if dimension == 3:
+            templates.append(itk.ImageSeriesWriter[F, itk.Image[itk.F, 2]])
+    return templates
+
+
+def preload_scripts():
+    # Imported under their own names, so the scripts' sibling imports resolve as they do when run directly
+    modules = {}
+    for script in SCRIPTS:
+        script_dir = os.path.dirname(script_path(script))
+        if script_dir not in sys.path:
+            sys.path.insert(0, script_dir)
+        modules[script] = importlib.import_module(script)
+    return modules
+
+
+@contextlib.contextmanager
+def redirected_stdio(fds):
+    # The client's stdin, stdout and stderr replace this process's for the duration of a job
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = [os.dup(target) for target in (0, 1, 2)]
+    for fd, target in zip(fds, (0, 1, 2)):
+        os.dup2(fd, target)
+    try:
+        yield
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        for fd, target in zip(saved, (0, 1, 2)):
+            os.dup2(fd, target)
+            os.close(fd)
+
+
+def run_job(module, script, argv, cwd, threads):
+    saved_argv, saved_cwd, saved_pipeline = sys.argv, os.getcwd(), itk.auto_pipeline.current
+    sys.argv = [script_path(script)] + argv
+    try:
+        os.chdir(cwd)
+        module.main()
+        return 0
+    except SystemExit as e:
+        # argparse errors and sys.exit() calls end the job, not the worker
+        if e.code is None or isinstance(e.code, int):
+            return e.code or 0
+        print(e.code, file=sys.stderr)
+        return 1
+    except Exception:
+        traceback.print_exc()
+        return 1
+    finally:
+        # --threads and --profile change process-wide state, which the next job must not inherit
+        sys.argv = saved_argv
+        os.chdir(saved_cwd)
+        itk.auto_pipeline.current = saved_pipeline
+        set_thread_count(threads)
+
+
+def handle_job(connection, modules, threads):
+    message, fds, _, _ = socket.recv_fds(connection, MAX_MESSAGE_BYTES, 3)
+    start = time.perf_counter()
+    script = None
+    try:
+        request = json.loads(message)
+        script = request['script']
+        if script not in modules or len(fds) != 3:
+            raise ValueError(f"Unknown script {script!r} or missing stdio.")
+        with redirected_stdio(fds):
+            exit_code = run_job(modules[script], script, request['argv'], request['cwd'], threads)
+    except (ValueError, KeyError) as e:
+        print(f"Rejected job {message[:200]!r}:", str(e), file=sys.stderr)
+        exit_code = 2
+    finally:
+        for fd in fds:
+            os.close(fd)
+    connection.sendall(json.dumps({'exit_code': exit_code}).encode() + b'\n')
+    print(f"[worker {os.getpid()}] {script} exited with {exit_code} after {time.perf_counter() - start:.3f} s.", file=sys.stderr)
+
+
+def worker_loop(listener, modules, max_jobs, threads):
+    for _ in range(max_jobs):
+        connection, _ = listener.accept()
+        with connection:
+            try:
+                handle_job(connection, modules, threads)
+            except OSError as e:
+                # The client went away; the worker carries on with the next job
+                print(f"[worker {os.getpid()}] Exception caught while answering a job!", str(e), file=sys.stderr)
+
+
+def start_worker(listener, modules, max_jobs, threads):
+    pid = os.fork()
+    if pid:
+        return pid
+    # The child never returns into the parent's supervision loop
+    status = 1
+    try:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        worker_loop(listener, modules, max_jobs, threads)
+        status = 0
+    except KeyboardInterrupt:
+        status = 0
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(status)
+
+
+def bind_listener(socket_path):
+    if os.path.exists(socket_path):
+        # A socket nobody answers on is left over from a daemon that did not shut down cleanly
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+                raise RuntimeError(f"A daemon is already listening on {socket_path}.")
+            except (ConnectionRefusedError, FileNotFoundError):
+                os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    # Jobs run with this user's rights, so nobody else may submit them
+    os.chmod(socket_path, 0o600)
+    listener.listen(128)
+    return listener
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Keep ITK templates loaded in pre-forked workers that run pipeline_client.py jobs.")
+    parser.add_argument("--socket", default=DEFAULT_SOCKET, help="Unix socket to listen on.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Worker processes, each running one job at a time.")
+    parser.add_argument("--max_jobs", type=int, default=200, help="Jobs a worker runs before it is replaced by a fresh fork.")
+    parser.add_argument("--dimensions", type=int, nargs='+', default=[2, 3], help="Image dimensions whose templates are preloaded.")
+    parser.add_argument("--threads", type=int, help="ITK threads per filter for jobs without their own --threads (default: cores / workers).")
+
+    args = parser.parse_args()
+    threads = args.threads or max(1, os.cpu_count() // args.workers)
+    set_thread_count(threads)
+
+    start = time.perf_counter()
+    templates = preload_templates(args.dimensions)
+    modules = preload_scripts()
+    print(f"Preloaded {len(templates)} templates and {len(modules)} scripts in {time.perf_counter() - start:.1f} s.")
+
+    try:
+        listener = bind_listener(args.socket)
+    except RuntimeError as e:
+        print(str(e))
+        sys.exit(1)
+
+    # SIGTERM unwinds through the finally below like Ctrl-C does
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    workers = set()
+    try:
+        for _ in range(args.workers):
+            workers.add(start_worker(listener, modules, args.max_jobs, threads))
+        print(f"Listening on {args.socket} with {args.workers} workers, {threads} ITK threads per filter.")
+        sys.stdout.flush()
+        while True:
+            pid, status = os.wait()
+            workers.discard(pid)
+            if os.waitstatus_to_exitcode(status) != 0:
+                print(f"Worker {pid} exited with status {os.waitstatus_to_exitcode(status)}, starting a new one.", file=sys.stderr)
+            workers.add(start_worker(listener, modules, args.max_jobs, threads))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for pid in workers:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(pid, signal.SIGTERM)
+        for pid in workers:
+            with contextlib.suppress(ChildProcessError):
+                os.waitpid(pid, 0)
+        listener.close()
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(args.socket)
+        print("Daemon stopped.")
+
+
+if __name__ == "__main__":
+    main()
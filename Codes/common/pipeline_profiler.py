@@ -0,0 +1,187 @@
+# Thread-count control and per-filter profiling shared by the pipeline scripts.
+#
+# --threads sets ITK's global default thread count before any filter is
+# created, so several jobs packed onto one node each stay within their own
+# budget. --profile hooks every ITK filter created through New() after the
+# profiler starts and records each execution between its StartEvent and
+# EndEvent: wall time, process CPU time, the filter's thread count and the
+# size of its output buffer. The per-filter table is printed at the end and
+# --profile_trace also writes the executions as a Chrome trace
+# (chrome://tracing or https://ui.perfetto.dev).
+#
+# The table counts the time of each filter without the upstream filters it
+# updated itself (writers run their whole pipeline); the trace shows them
+# nested. CPU time is process-wide, so filters overlapping with background
+# writes include their CPU time too. Filters created inside other filters
+# (e.g. the mini-pipelines of composite filters) are not seen on their own and
+# count towards their parent.
+
+import json
+import os
+import threading
+import time
+import weakref
+
+import itk
+
+
+def set_thread_count(threads):
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+    # Processes started with spawn re-import ITK and read the budget from here
+    os.environ['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(threads)
+
+
+def _component_bytes(pixel_type):
+    # Scalar pixel types carry a dtype, vector pixels are templated over their component type
+    if hasattr(pixel_type, 'dtype'):
+        return pixel_type.dtype.itemsize
+    return _component_bytes(itk.template(pixel_type)[1][0])
+
+
+def _output_bytes(process_object):
+    # Only filters with an image output; the buffer is not touched
+    try:
+        output = process_object.GetOutput()
+        pixels = output.GetBufferedRegion().GetNumberOfPixels()
+        return int(pixels * output.GetNumberOfComponentsPerPixel() * _component_bytes(itk.template(output)[1][0]))
+    except Exception:
+        return 0
+
+
+def _thread_count(process_object):
+    try:
+        return process_object.GetMultiThreader().GetMaximumNumberOfThreads()
+    except AttributeError:
+        return itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads()
+
+
+class PipelineProfiler:
+    def __init__(self, trace_path=None):
+        self.trace_path = trace_path
+        self.executions = []
+        self._counts = {}
+        self._running = {}
+        self._previous_hook = None
+        self._origin = time.perf_counter()
+
+    def start(self):
+        # itk.auto_pipeline.current is called with every object created by New()
+        self._previous_hook = itk.auto_pipeline.current
+        itk.auto_pipeline.current = self
+        return self
+
+    def stop(self):
+        if itk.auto_pipeline.current is self:
+            itk.auto_pipeline.current = self._previous_hook
+
+    def connect(self, itk_object):
+        if self._previous_hook is not None:
+            self._previous_hook.connect(itk_object)
+        if isinstance(itk_object, itk.ProcessObject):
+            self.watch(itk_object)
+
+    def watch(self, process_object, name=None):
+        # Instances of the same filter class are numbered in creation order
+        name = name or type(process_object).__name__
+        self._counts[name] = self._counts.get(name, 0) + 1
+        label = f"{name}#{self._counts[name]}"
+        # A weak reference, so the observer does not keep its own filter alive
+        process_object_ref = weakref.ref(process_object)
+        process_object.AddObserver(itk.StartEvent(), lambda: self._on_start(label))
+        process_object.AddObserver(itk.EndEvent(), lambda: self._on_end(label, process_object_ref()))
+        return process_object
+
+    def _on_start(self, label):
+        stack = self._running.setdefault(threading.get_ident(), [])
+        stack.append({'label': label, 'wall': time.perf_counter(), 'cpu': time.process_time(),
+                      'child_wall': 0.0, 'child_cpu': 0.0})
+
+    def _on_end(self, label, process_object):
+        stack = self._running.get(threading.get_ident())
+        if not stack or stack[-1]['label'] != label or process_object is None:
+            return
+        frame = stack.pop()
+        wall = time.perf_counter() - frame['wall']
+        cpu = time.process_time() - frame['cpu']
+        if stack:
+            # Writers update their upstream filters between their own Start and End events
+            stack[-1]['child_wall'] += wall
+            stack[-1]['child_cpu'] += cpu
+        self.executions.append({
+            'filter': label,
+            'start': frame['wall'] - self._origin,
+            'inclusive_seconds': wall,
+            'seconds': wall - frame['child_wall'],
+            'cpu_seconds': cpu - frame['child_cpu'],
+            'threads': _thread_count(process_object),
+            'output_bytes': _output_bytes(process_object),
+            'thread_id': threading.get_ident(),
+        })
+
+    def table(self):
+        rows = {}
+        for execution in self.executions:
+            row = rows.setdefault(execution['filter'], {
+                'filter': execution['filter'], 'calls': 0, 'seconds': 0.0, 'cpu_seconds': 0.0,
+                'threads': execution['threads'], 'output_bytes': 0})
+            row['calls'] += 1
+            row['seconds'] += execution['seconds']
+            row['cpu_seconds'] += execution['cpu_seconds']
+            row['output_bytes'] = max(row['output_bytes'], execution['output_bytes'])
+        for row in rows.values():
+            # Share of the thread budget the filter kept busy: 1.0 is perfect scaling
+            budget = row['seconds'] * row['threads']
+            row['efficiency'] = row['cpu_seconds'] / budget if budget > 0 else None
+        return sorted(rows.values(), key=lambda row: row['seconds'], reverse=True)
+
+    def print_table(self):
+        rows = self.table()
+        total = sum(row['seconds'] for row in rows)
+        print(f"{'filter':<60} {'calls':>5} {'wall s':>9} {'cpu s':>9} {'threads':>7} {'cpu/(wall*threads)':>18} {'output MB':>10}")
+        for row in rows:
+            efficiency = f"{row['efficiency']:.2f}" if row['efficiency'] is not None else "n/a"
+            print(f"{row['filter']:<60} {row['calls']:>5} {row['seconds']:>9.4f} {row['cpu_seconds']:>9.4f} "
+                  f"{row['threads']:>7} {efficiency:>18} {row['output_bytes'] / 2**20:>10.2f}")
+        print(f"{len(rows)} filters, {total:.4f} s inside ITK filters.")
+
+    def write_chrome_trace(self, path):
+        events = [{
+            'name': execution['filter'],
+            'cat': 'itk',
+            'ph': 'X',
+            'ts': execution['start'] * 1e6,
+            'dur': execution['inclusive_seconds'] * 1e6,
+            'pid': os.getpid(),
+            'tid': execution['thread_id'],
+            'args': {key: execution[key] for key in ('cpu_seconds', 'threads', 'output_bytes')},
+        } for execution in self.executions]
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+        print(f"{path} written successfully.")
+
+    def report(self):
+        self.stop()
+        self.print_table()
+        if self.trace_path:
+            self.write_chrome_trace(self.trace_path)
+
+
+class _DisabledProfiler:
+    def report(self):
+        pass
+
+
+def add_profiler_arguments(parser):
+    parser.add_argument("--threads", type=int, help="ITK threads per filter (default: all cores).")
+    parser.add_argument("--profile", action="store_true", help="Print a per-filter table of wall time, CPU time, thread use and output buffer size.")
+    parser.add_argument("--profile_trace", help="Also write the filter executions as a Chrome trace JSON file (implies --profile).")
+
+
+def profiler_from_args(args):
+    # Called right after parsing, before the pipeline is built, so every filter sees the thread budget
+    if args.threads:
+        set_thread_count(args.threads)
+    if args.profile or args.profile_trace:
+        return PipelineProfiler(args.profile_trace).start()
+    return _DisabledProfiler()
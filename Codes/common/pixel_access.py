@@ -0,0 +1,100 @@
+# Vectorized pixel access and index <-> physical point mapping.
+#
+# image.GetPixel(), SetPixel() and TransformIndexToPhysicalPoint() cross from
+# Python into ITK once per pixel. These helpers do the same for a whole
+# (N, D) array of indices, or for every pixel of a boolean mask, in a few NumPy
+# operations on a view of the image buffer (itk.array_view_from_image), so no
+# pixel data is copied.
+#
+# Indices are ITK indices: x first, absolute (the region's start index
+# included), the same as itk.Index. Physical points follow ITK's
+#     point = origin + direction * diag(spacing) * index
+# and points are mapped back to the nearest index the way
+# TransformPhysicalPointToIndex rounds (half up).
+
+import itk
+import numpy as np
+
+
+def _view(image):
+    # NumPy view of the buffer (z, y, x order) and the start index of the buffered region
+    return itk.array_view_from_image(image), np.array(image.GetBufferedRegion().GetIndex())
+
+
+def _positions(image, view, start, indices):
+    # Tuple of NumPy index arrays of ITK indices, checked against the buffered region
+    indices = np.asarray(indices)
+    dimension = image.GetImageDimension()
+    if indices.ndim != 2 or indices.shape[1] != dimension:
+        raise ValueError(f"Expected an (N, {dimension}) array of indices, got shape {indices.shape}.")
+    outside = ~inside_buffered_region(image, indices)
+    if outside.any():
+        raise IndexError(f"{int(outside.sum())} indices lie outside the buffered region, e.g. {indices[outside][0].tolist()}.")
+    offsets = indices - start
+    return tuple(offsets[:, axis] for axis in reversed(range(dimension)))
+
+
+def _mask_array(mask):
+    if hasattr(mask, 'GetBufferedRegion'):
+        mask = itk.array_view_from_image(mask)
+    return np.asarray(mask).astype(bool, copy=False)
+
+
+def get_pixels(image, indices=None, mask=None):
+    """Values at an (N, D) array of indices, or at the pixels of a boolean mask (array or image) in buffer order."""
+    view, start = _view(image)
+    if mask is not None:
+        return view[_mask_array(mask)]
+    return view[_positions(image, view, start, indices)]
+
+
+def set_pixels(image, values, indices=None, mask=None):
+    """Scatter values (one per index or mask pixel, or a single value) into the image in place."""
+    view, start = _view(image)
+    if mask is not None:
+        view[_mask_array(mask)] = values
+    else:
+        view[_positions(image, view, start, indices)] = values
+    # Downstream filters see the new pixels
+    image.Modified()
+
+
+def mask_to_indices(image, mask=None):
+    """(N, D) ITK indices of the pixels of a boolean mask, or of every buffered pixel without one, in buffer order."""
+    view, start = _view(image)
+    dimension = image.GetImageDimension()
+    if mask is None:
+        shape = view.shape[:dimension]
+        grid = np.indices(shape).reshape(dimension, -1).T
+    else:
+        grid = np.argwhere(_mask_array(mask))
+    return grid[:, ::-1] + start
+
+
+def _index_to_point_matrix(image):
+    direction = itk.array_from_matrix(image.GetDirection())
+    return direction @ np.diag(np.array(image.GetSpacing())), np.array(image.GetOrigin())
+
+
+def index_to_physical_points(image, indices):
+    """Physical points (N, D) of an (N, D) array of indices, continuous indices included."""
+    matrix, origin = _index_to_point_matrix(image)
+    return np.asarray(indices, dtype=float) @ matrix.T + origin
+
+
+def physical_points_to_index(image, points, continuous=False):
+    """Indices (N, D) of an (N, D) array of physical points: rounded like TransformPhysicalPointToIndex, or continuous."""
+    matrix, origin = _index_to_point_matrix(image)
+    continuous_indices = np.linalg.solve(matrix, (np.asarray(points, dtype=float) - origin).T).T
+    if continuous:
+        return continuous_indices
+    return np.floor(continuous_indices + 0.5).astype(np.int64)
+
+
+def inside_buffered_region(image, indices):
+    """Boolean (N,) array telling which indices lie inside the buffered region."""
+    region = image.GetBufferedRegion()
+    start = np.array(region.GetIndex())
+    size = np.array(region.GetSize())
+    offsets = np.asarray(indices) - start
+    return np.all((offsets >= 0) & (offsets < size), axis=1)
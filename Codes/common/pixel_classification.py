@@ -0,0 +1,309 @@
+# Pixel classification with k-means and Gaussian mixtures.
+#
+# Every voxel is a feature vector: its intensity, the components of a vector
+# pixel, or the intensities of several co-registered images (e.g. T1 and T2).
+# The model is fitted to a random sample of the voxels inside an optional
+# mask, drawn slab by slab so the features of the whole volume are never
+# built. KMeans runs Lloyd's iterations on the sample or, with a batch size,
+# minibatch k-means (Sculley 2010) on random batches of it. GaussianMixture
+# runs EM with full covariances, starting from k-means. Distances and log
+# likelihoods are evaluated for all vectors and classes at once with matrix
+# products (a Cholesky factor per class for the Gaussians, no per-voxel
+# scipy.stats calls). classify() then labels every voxel slab by slab on a
+# thread pool (NumPy's matrix products release the GIL) and returns a label
+# image with the geometry of the input: 0 outside the mask and 1..K for the
+# classes, ordered by their mean in the first feature, so for T1 data 1 is
+# the darkest tissue.
+#
+# Features are standardized with the sample's mean and standard deviation
+# before fitting, so channels with different ranges weigh alike.
+#
+#   python pixel_classification.py -i t1.nrrd t2.nrrd -m brain_mask.nrrd -k 3 --method gmm -o ./output/tissue_labels.nrrd
+
+import argparse
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+import numpy as np
+
+METHODS = ['kmeans', 'gmm']
+DEFAULT_SAMPLES = 200000
+
+# Voxels per slab labelled at once
+CHUNK_VOXELS = 1 << 18
+
+
+def _views(images):
+    if not isinstance(images, (list, tuple)):
+        images = [images]
+    return images, [itk.array_view_from_image(image) for image in images], images[0].GetImageDimension()
+
+
+def _features(parts, dimension):
+    # (n, D) float64 features of matching slabs of every image; vector pixels give several columns
+    columns = [part.reshape(-1, 1) if part.ndim == dimension else part.reshape(-1, part.shape[-1]) for part in parts]
+    return np.hstack(columns).astype(np.float64, copy=False)
+
+
+def _slab_size(view, dimension):
+    per_slice = max(1, int(np.prod(view.shape[1:dimension])))
+    return max(1, CHUNK_VOXELS // per_slice)
+
+
+def sample_features(images, mask=None, max_samples=DEFAULT_SAMPLES, seed=0):
+    """(n, D) features of about max_samples random voxels (all of them if fewer) inside the mask."""
+    images, views, dimension = _views(images)
+    mask_view = itk.array_view_from_image(mask) if mask is not None else None
+    candidates = int(np.count_nonzero(mask_view)) if mask_view is not None else int(np.prod(views[0].shape[:dimension]))
+    if candidates == 0:
+        raise ValueError("The mask is empty.")
+    fraction = min(1.0, max_samples / candidates)
+    rng = np.random.default_rng(seed)
+    slab = _slab_size(views[0], dimension)
+    samples = []
+    for k in range(0, views[0].shape[0], slab):
+        features = _features([view[k:k + slab] for view in views], dimension)
+        keep = mask_view[k:k + slab].reshape(-1) != 0 if mask_view is not None else np.ones(len(features), dtype=bool)
+        if fraction < 1.0:
+            keep &= rng.random(len(features)) < fraction
+        samples.append(features[keep])
+    return np.vstack(samples)
+
+
+def _squared_distances(x, centers):
+    # ||x - c||^2 for every vector and center, as one matrix product
+    distances = (x * x).sum(axis=1)[:, None] - 2.0 * x @ centers.T + (centers * centers).sum(axis=1)[None, :]
+    return np.maximum(distances, 0.0)
+
+
+def _logsumexp(values):
+    peak = values.max(axis=1, keepdims=True)
+    return (peak + np.log(np.exp(values - peak).sum(axis=1, keepdims=True)))[:, 0]
+
+
+class _Classifier:
+    # Standardization of the features and the ordering of the classes, shared by both models
+    def __init__(self, classes, iterations, tolerance, seed):
+        self.classes = classes
+        self.iterations = iterations
+        self.tolerance = tolerance
+        self.seed = seed
+        self.iterations_run = 0
+
+    def _standardize(self, x):
+        return (x - self.offset) / self.scale
+
+    def fit(self, features):
+        features = np.asarray(features, dtype=np.float64)
+        if features.ndim == 1:
+            features = features[:, None]
+        if len(features) < self.classes:
+            raise ValueError(f"{len(features)} samples for {self.classes} classes.")
+        self.offset = features.mean(axis=0)
+        self.scale = features.std(axis=0)
+        self.scale[self.scale == 0] = 1.0
+        self._fit(self._standardize(features), np.random.default_rng(self.seed))
+        # Classes ordered by their mean in the first feature
+        self._reorder(np.argsort(self.means[:, 0], kind='stable'))
+        return self
+
+    def predict(self, features):
+        """Class (0..K-1) of every row of an (n, D) feature array."""
+        return np.argmax(self._scores(self._standardize(np.asarray(features, dtype=np.float64))), axis=1)
+
+    @property
+    def means(self):
+        # Class centers in the units of the features
+        return self._centers * self.scale + self.offset
+
+
+def _kmeans_plus_plus(x, classes, rng):
+    centers = [x[rng.integers(len(x))]]
+    distances = _squared_distances(x, np.array(centers))[:, 0]
+    for _ in range(1, classes):
+        total = distances.sum()
+        chosen = rng.choice(len(x), p=distances / total) if total > 0 else rng.integers(len(x))
+        centers.append(x[chosen])
+        distances = np.minimum(distances, _squared_distances(x, x[chosen][None, :])[:, 0])
+    return np.array(centers)
+
+
+class KMeans(_Classifier):
+    """k-means on the sample, or minibatch k-means with a batch size."""
+
+    def __init__(self, classes=3, iterations=100, tolerance=1e-4, batch_size=None, seed=0):
+        super().__init__(classes, iterations, tolerance, seed)
+        self.batch_size = batch_size
+
+    def _fit(self, x, rng):
+        centers = _kmeans_plus_plus(x, self.classes, rng)
+        counts = np.zeros(self.classes)
+        for iteration in range(self.iterations):
+            batch = x[rng.integers(len(x), size=self.batch_size)] if self.batch_size else x
+            labels = np.argmin(_squared_distances(batch, centers), axis=1)
+            sizes = np.bincount(labels, minlength=self.classes).astype(np.float64)
+            sums = np.stack([np.bincount(labels, weights=batch[:, d], minlength=self.classes) for d in range(x.shape[1])], axis=1)
+            filled = sizes > 0
+            updated = centers.copy()
+            if self.batch_size:
+                # Every center moves towards its batch members at a rate of 1 / (vectors it has seen)
+                counts += sizes
+                updated[filled] += (sums[filled] - sizes[filled, None] * centers[filled]) / counts[filled, None]
+            else:
+                updated[filled] = sums[filled] / sizes[filled, None]
+                # An empty class restarts at the vector farthest from its center
+                for empty in np.flatnonzero(~filled):
+                    updated[empty] = batch[np.argmax(_squared_distances(batch, updated).min(axis=1))]
+            shift = np.abs(updated - centers).max()
+            centers = updated
+            self.iterations_run = iteration + 1
+            if shift < self.tolerance:
+                break
+        self._centers = centers
+
+    def _reorder(self, order):
+        self._centers = self._centers[order]
+
+    def _scores(self, x):
+        return -_squared_distances(x, self._centers)
+
+
+class GaussianMixture(_Classifier):
+    """Gaussian mixture with full covariances fitted by EM, started from k-means."""
+
+    def __init__(self, classes=3, iterations=100, tolerance=1e-4, regularization=1e-6, seed=0):
+        super().__init__(classes, iterations, tolerance, seed)
+        self.regularization = regularization
+
+    def _log_densities(self, x):
+        # log N(x | mean_k, cov_k) for every vector and class: with cov_k = L L^T,
+        # -(D log 2 pi + log det cov_k + |L^-1 (x - mean_k)|^2) / 2
+        dimension = x.shape[1]
+        densities = np.empty((len(x), self.classes))
+        for k in range(self.classes):
+            factor = np.linalg.cholesky(self._covariances[k])
+            whitened = (x - self._centers[k]) @ np.linalg.inv(factor).T
+            log_determinant = 2.0 * np.log(np.diag(factor)).sum()
+            densities[:, k] = -0.5 * (dimension * np.log(2 * np.pi) + log_determinant + (whitened * whitened).sum(axis=1))
+        return densities
+
+    def _scores(self, x):
+        return self._log_densities(x) + np.log(self.weights)
+
+    def _fit(self, x, rng):
+        start = KMeans(self.classes, seed=self.seed)
+        start._fit(x, rng)
+        labels = np.argmin(_squared_distances(x, start._centers), axis=1)
+        responsibilities = np.eye(self.classes)[labels]
+        self.log_likelihood = -np.inf
+        for iteration in range(self.iterations):
+            # M step
+            totals = responsibilities.sum(axis=0) + 10 * np.finfo(float).eps
+            self.weights = totals / totals.sum()
+            self._centers = responsibilities.T @ x / totals[:, None]
+            self._covariances = np.empty((self.classes, x.shape[1], x.shape[1]))
+            for k in range(self.classes):
+                centered = x - self._centers[k]
+                self._covariances[k] = (responsibilities[:, k, None] * centered).T @ centered / totals[k] \
+                    + self.regularization * np.eye(x.shape[1])
+            # E step
+            scores = self._scores(x)
+            normalizers = _logsumexp(scores)
+            responsibilities = np.exp(scores - normalizers[:, None])
+            log_likelihood = float(normalizers.mean())
+            self.iterations_run = iteration + 1
+            converged = abs(log_likelihood - self.log_likelihood) < self.tolerance
+            self.log_likelihood = log_likelihood
+            if converged:
+                break
+
+    def _reorder(self, order):
+        self._centers = self._centers[order]
+        self._covariances = self._covariances[order]
+        self.weights = self.weights[order]
+
+    @property
+    def covariances(self):
+        # Class covariances in the units of the features
+        return self._covariances * np.outer(self.scale, self.scale)
+
+    def predict_proba(self, features):
+        """Posterior probability of every class for every row of an (n, D) feature array."""
+        scores = self._scores(self._standardize(np.asarray(features, dtype=np.float64)))
+        return np.exp(scores - _logsumexp(scores)[:, None])
+
+
+def fit_classifier(images, classes=3, method='kmeans', mask=None, max_samples=DEFAULT_SAMPLES, batch_size=None,
+                   iterations=100, seed=0):
+    """A KMeans or GaussianMixture fitted to a random sample of the voxels of one or more images."""
+    features = sample_features(images, mask, max_samples, seed)
+    if method == 'kmeans':
+        model = KMeans(classes, iterations, batch_size=batch_size, seed=seed)
+    elif method == 'gmm':
+        model = GaussianMixture(classes, iterations, seed=seed)
+    else:
+        raise ValueError(f"Unknown method {method}; expected one of {METHODS}.")
+    return model.fit(features)
+
+
+def classify(images, model, mask=None, threads=None):
+    """Label image of every voxel (1..K, 0 outside the mask) with the geometry of the first image."""
+    images, views, dimension = _views(images)
+    mask_view = itk.array_view_from_image(mask) if mask is not None else None
+    shape = views[0].shape[:dimension]
+    labels = np.zeros(shape, dtype=np.uint8 if model.classes < 256 else np.uint16)
+    slab = _slab_size(views[0], dimension)
+
+    def label_slab(k):
+        features = _features([view[k:k + slab] for view in views], dimension)
+        slab_labels = labels[k:k + slab].reshape(-1)
+        if mask_view is not None:
+            keep = mask_view[k:k + slab].reshape(-1) != 0
+            slab_labels[keep] = model.predict(features[keep]) + 1
+        else:
+            slab_labels[:] = model.predict(features) + 1
+
+    # Slabs are disjoint, so the threads write to separate parts of the labels
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count()) as pool:
+        list(pool.map(label_slab, range(0, shape[0], slab)))
+
+    label_image = itk.image_from_array(labels)
+    label_image.SetOrigin(images[0].GetOrigin())
+    label_image.SetSpacing(images[0].GetSpacing())
+    label_image.SetDirection(images[0].GetDirection())
+    return label_image
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Label the voxels of one or more co-registered images with k-means or a Gaussian mixture.")
+    parser.add_argument("-i", "--inputs", nargs='+', required=True, help="Images whose intensities form the feature vector of every voxel.")
+    parser.add_argument("-m", "--mask", help="Only voxels inside this mask are fitted and labelled.")
+    parser.add_argument("-k", "--classes", type=int, default=3, help="Number of classes.")
+    parser.add_argument("--method", choices=METHODS, default='kmeans', help="Classifier.")
+    parser.add_argument("--max_samples", type=int, default=DEFAULT_SAMPLES, help="Voxels sampled to fit the model.")
+    parser.add_argument("--batch_size", type=int, help="Minibatch k-means with batches of this size.")
+    parser.add_argument("--iterations", type=int, default=100, help="Maximum iterations.")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the sampling and initialization.")
+    parser.add_argument("-t", "--threads", type=int, help="Threads labelling the volume (default: all cores).")
+    parser.add_argument("-o", "--output", default="./output/labels.nrrd", help="Label image to write.")
+
+    args = parser.parse_args()
+    images = [itk.imread(path) for path in args.inputs]
+    mask = itk.imread(args.mask) if args.mask else None
+    model = fit_classifier(images, args.classes, args.method, mask, args.max_samples, args.batch_size, args.iterations, args.seed)
+    print(f"{args.method} converged after {model.iterations_run} iterations.")
+    for k, mean in enumerate(model.means):
+        print(f"Class {k + 1}: mean = {np.round(mean, 3).tolist()}" + (f", weight = {model.weights[k]:.3f}" if args.method == 'gmm' else ''))
+    label_image = classify(images, model, mask, args.threads)
+
+    try:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        itk.imwrite(label_image, args.output, compression=True)
+        print(f"{args.output} written successfully.")
+    except Exception as e:
+        print(f"Exception caught while writing {args.output}!", str(e))
+
+
+if __name__ == "__main__":
+    main()
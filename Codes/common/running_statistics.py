@@ -0,0 +1,230 @@
+# Streaming (optionally weighted) mean and covariance of measurement vectors.
+#
+# np.mean and np.cov need the whole (N, D) sample in memory, and building it
+# from every voxel of a cohort of volumes does not fit. RunningCovariance
+# keeps only the total weight, the mean and the D x D matrix of summed
+# centered products. Each chunk of vectors is reduced with NumPy, and the
+# chunk's statistics are folded in with Chan et al.'s pairwise update, the
+# same update that merges the accumulators of parallel workers:
+#
+#     W = Wa + Wb,  mean = mean_a + d Wb / W,  M2 = M2a + M2b + d d^T Wa Wb / W
+#
+# with d = mean_b - mean_a. This stays accurate where summing x and x x^T
+# loses the covariance to cancellation. covariance(ddof) matches np.cov with
+# the same aweights and ddof: ddof=1 (the default) is np.cov, ddof=0 divides
+# by the total weight.
+#
+# Samples can come from arrays, from images (scalar or vector pixels, or
+# several co-registered images as the components of one vector, within an
+# optional mask or region and with an optional weight image), read slab by
+# slab from views, and from the points or point data of an itk.PointSet.
+#
+#   python running_statistics.py -i t1_01.nrrd,t2_01.nrrd t1_02.nrrd,t2_02.nrrd -m mask_01.nrrd mask_02.nrrd -w 4
+
+import argparse
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import itk
+import numpy as np
+
+# Vectors per chunk reduced at once
+CHUNK_VECTORS = 1 << 20
+
+
+def _view(image):
+    if hasattr(image, 'GetBufferedRegion'):
+        return itk.array_view_from_image(image)
+    return np.asarray(image)
+
+
+class RunningCovariance:
+    """Mergeable accumulator of the (weighted) mean and covariance of D-dimensional measurement vectors."""
+
+    def __init__(self, dimension=None):
+        self.dimension = dimension
+        self.count = 0
+        self.weight_sum = 0.0
+        # Sum of squared weights, for the unbiased weighted covariance
+        self.weight_square_sum = 0.0
+        self._mean = None
+        self._m2 = None
+        if dimension is not None:
+            self._reset(dimension)
+
+    def _reset(self, dimension):
+        self.dimension = dimension
+        self._mean = np.zeros(dimension)
+        self._m2 = np.zeros((dimension, dimension))
+
+    def _combine(self, count, weight_sum, weight_square_sum, mean, m2):
+        if self._mean is None:
+            self._reset(len(mean))
+        elif len(mean) != self.dimension:
+            raise ValueError(f"Vectors of dimension {len(mean)} added to statistics of dimension {self.dimension}.")
+        if weight_sum == 0:
+            self.count += count
+            return
+        total = self.weight_sum + weight_sum
+        delta = mean - self._mean
+        self._m2 += m2 + np.outer(delta, delta) * (self.weight_sum * weight_sum / total)
+        self._mean += delta * (weight_sum / total)
+        self.count += count
+        self.weight_sum = total
+        self.weight_square_sum += weight_square_sum
+
+    def update(self, sample, weights=None):
+        """Add an (N, D) array of vectors (or N scalars), with optional non-negative weights (N,)."""
+        sample = np.asarray(sample, dtype=np.float64)
+        if sample.ndim == 1:
+            sample = sample[:, None]
+        if weights is not None:
+            weights = np.asarray(weights, dtype=np.float64).reshape(-1)
+            if len(weights) != len(sample):
+                raise ValueError(f"{len(weights)} weights for {len(sample)} vectors.")
+        for start in range(0, len(sample), CHUNK_VECTORS):
+            chunk = sample[start:start + CHUNK_VECTORS]
+            if weights is None:
+                mean = chunk.mean(axis=0)
+                centered = chunk - mean
+                self._combine(len(chunk), float(len(chunk)), float(len(chunk)), mean, centered.T @ centered)
+            else:
+                chunk_weights = weights[start:start + CHUNK_VECTORS]
+                weight_sum = float(chunk_weights.sum())
+                if weight_sum == 0:
+                    self._combine(len(chunk), 0.0, 0.0, np.zeros(chunk.shape[1]), None)
+                    continue
+                mean = chunk_weights @ chunk / weight_sum
+                centered = chunk - mean
+                self._combine(len(chunk), weight_sum, float(chunk_weights @ chunk_weights), mean,
+                              (centered * chunk_weights[:, None]).T @ centered)
+        return self
+
+    def merge(self, other):
+        """Fold in the statistics of another accumulator, e.g. one filled by a parallel worker."""
+        if other._mean is not None:
+            self._combine(other.count, other.weight_sum, other.weight_square_sum, other._mean, other._m2)
+        return self
+
+    def __iadd__(self, other):
+        return self.merge(other)
+
+    def update_from_images(self, images, mask=None, weights=None, region=None):
+        """Add the pixels of one image, or of several same-sized images as the components of one vector.
+
+        mask (image or array) keeps the nonzero pixels, weights (image or array) weighs every pixel,
+        and region (an itk.ImageRegion of the first image) limits the pixels to that region.
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        views = [_view(image) for image in images]
+        dimension = images[0].GetImageDimension() if hasattr(images[0], 'GetImageDimension') else views[0].ndim
+        mask_view = _view(mask) if mask is not None else None
+        weight_view = _view(weights) if weights is not None else None
+        if region is not None:
+            start = np.array(region.GetIndex()) - np.array(images[0].GetBufferedRegion().GetIndex())
+            size = np.array(region.GetSize())
+            window = tuple(slice(int(s), int(s + n)) for s, n in zip(start[::-1], size[::-1]))
+            views = [view[window] for view in views]
+            mask_view = mask_view[window] if mask_view is not None else None
+            weight_view = weight_view[window] if weight_view is not None else None
+
+        # Slabs along the slowest axis of about CHUNK_VECTORS pixels each
+        depth = views[0].shape[0]
+        per_slice = max(1, int(np.prod(views[0].shape[1:dimension])))
+        slab = max(1, CHUNK_VECTORS // per_slice)
+        for k in range(0, depth, slab):
+            parts = [view[k:k + slab] for view in views]
+            # Scalar pixels are one component, vector pixels several
+            columns = [part.reshape(-1, 1) if part.ndim == dimension else part.reshape(-1, part.shape[-1]) for part in parts]
+            sample = columns[0] if len(columns) == 1 else np.hstack(columns)
+            slab_weights = weight_view[k:k + slab].reshape(-1) if weight_view is not None else None
+            if mask_view is not None:
+                keep = mask_view[k:k + slab].reshape(-1) != 0
+                sample = sample[keep]
+                slab_weights = slab_weights[keep] if slab_weights is not None else None
+            if len(sample):
+                self.update(sample, slab_weights)
+        return self
+
+    def update_from_point_set(self, point_set, point_data=False, weights=None):
+        """Add the points of an itk.PointSet, or with point_data=True its point data, read as views."""
+        container = point_set.GetPointData() if point_data else point_set.GetPoints()
+        if container.Size() == 0:
+            return self
+        return self.update(itk.array_view_from_vector_container(container), weights)
+
+    @property
+    def mean(self):
+        if self._mean is None or self.weight_sum == 0:
+            raise ValueError("No vectors with weight have been added.")
+        return self._mean.copy()
+
+    def covariance(self, ddof=1):
+        """Covariance like np.cov(sample, rowvar=False, aweights=weights, ddof=ddof)."""
+        if self._m2 is None or self.weight_sum == 0:
+            raise ValueError("No vectors with weight have been added.")
+        factor = self.weight_sum - ddof * self.weight_square_sum / self.weight_sum
+        if factor <= 0:
+            raise ValueError(f"Too few vectors for a covariance with ddof={ddof}.")
+        return self._m2 / factor
+
+    def to_dict(self):
+        return {'count': self.count, 'weight_sum': self.weight_sum, 'weight_square_sum': self.weight_square_sum,
+                'mean': None if self._mean is None else self._mean.tolist(),
+                'm2': None if self._m2 is None else self._m2.tolist()}
+
+
+def _subject_statistics(subject):
+    # One subject of a cohort, in a worker process: its channel volumes, mask and weight image
+    channel_paths, mask_path, weight_path = subject
+    images = [itk.imread(path) for path in channel_paths]
+    mask = itk.imread(mask_path) if mask_path else None
+    weights = itk.imread(weight_path) if weight_path else None
+    return RunningCovariance().update_from_images(images, mask, weights)
+
+
+def cohort_statistics(subjects, workers=None):
+    """Merged statistics of [(channel paths, mask path or None, weight path or None)], one subject per worker task."""
+    statistics = RunningCovariance()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for subject, partial in zip(subjects, pool.map(_subject_statistics, subjects)):
+            print(f"{', '.join(subject[0])}: {partial.count} voxels.")
+            statistics.merge(partial)
+    return statistics
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Mean and covariance of the voxels of a cohort of volumes, streamed and merged across workers.")
+    parser.add_argument("-i", "--inputs", nargs='+', required=True, help="One entry per subject: a volume, or comma-separated co-registered channel volumes.")
+    parser.add_argument("-m", "--masks", nargs='+', help="One mask per subject; only nonzero voxels are counted.")
+    parser.add_argument("--weights", nargs='+', help="One weight volume per subject.")
+    parser.add_argument("--ddof", type=int, default=1, help="Delta degrees of freedom of the covariance (1 like np.cov, 0 divides by the total weight).")
+    parser.add_argument("-w", "--workers", type=int, help="Worker processes (default: all cores).")
+    parser.add_argument("-o", "--output", help="Also write the statistics as JSON.")
+
+    args = parser.parse_args()
+    for name in ('masks', 'weights'):
+        if getattr(args, name) and len(getattr(args, name)) != len(args.inputs):
+            parser.error(f"Give one of --{name} per input.")
+    subjects = [(entry.split(','), args.masks[k] if args.masks else None, args.weights[k] if args.weights else None)
+                for k, entry in enumerate(args.inputs)]
+
+    statistics = cohort_statistics(subjects, args.workers)
+    np.set_printoptions(precision=6, suppress=True)
+    print(f"{statistics.count} voxels, total weight {statistics.weight_sum:g}.")
+    print("Mean = ", statistics.mean)
+    print("Covariance = ")
+    print(statistics.covariance(args.ddof))
+
+    if args.output:
+        os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+        with open(args.output, 'w') as f:
+            json.dump({'mean': statistics.mean.tolist(), 'covariance': statistics.covariance(args.ddof).tolist(),
+                       'ddof': args.ddof, **statistics.to_dict()}, f, indent=2)
+        print(f"{args.output} written successfully.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,453 @@
+# Benchmark suite for the level-set pipelines on synthetic phantoms.
+#
+# Every pipeline of fast_marching_filter.py, shape_detection_segmentation.py,
+# geodesic_active_contours.py, threshold.py and laplacian.py is rebuilt here
+# from the same filter functions and run with fixed parameters on
+# deterministic 2D and 3D phantoms, so no image data is needed. Each case runs
+# in a fresh process after a small warm-up run (ITK loads its templates
+# lazily), and every stage records wall time, CPU time, peak RSS (of the
+# process, and on Linux also the part the stage added) and the number of live
+# threads.
+#
+# Results are appended to a JSON-lines history. Each new run is compared with
+# the median of the previous runs on the same host and thread count, and
+# stages that got slower or bigger than the thresholds are reported as
+# regressions (exit status 1).
+#
+# Before the cases, the streamed (--memory_budget) speed-image stages and
+# Laplacian diffusion are checked against their whole-volume results on a 3D
+# phantom, at a budget that splits it into several slabs. Diffusion has to
+# match exactly; the recursive Gaussian only up to its tail beyond the halo.
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, timezone
+
+import numpy as np
+import itk
+
+from fast_marching_filter import segment_seed_group
+from geodesic_active_contours import geodesic_active_contour_filter
+from laplacian import gradient_diffusion, laplacian_filter
+from parameter_sweep import initial_level_set
+from shape_detection_segmentation import shape_detection_filter
+from speed_image_cache import (StageCache, compute_speed_image, compute_speed_image_streamed, gradient_stage,
+                               sigmoid_stage, smoothing_stage)
+from threshold import threshold_segmentation_filter
+from volume_streaming import DEFAULT_BUFFER_COPIES, gaussian_halo, stream_diffusion
+
+DEFAULT_HISTORY = './output/Benchmarks/history.jsonl'
+DEFAULT_SIZES = {2: [128, 256, 512], 3: [32, 64, 96]}
+WARMUP_SIZE = 24
+
+# Fixed parameters, taken from the run_*.sh examples
+SPEED_PARAMETERS = {'sigma': 1.0, 'alpha': -0.5, 'beta': 3.0}
+FAST_MARCHING_PARAMETERS = {'time_threshold': 100, 'stopping_value': 100}
+INITIAL_DISTANCE = 5.0
+SHAPE_DETECTION_PARAMETERS = {'propagation_scaling': 1.0, 'curvature_scaling': 0.05, 'number_of_iterations': 200}
+GEODESIC_PARAMETERS = {'propagation_scaling': 2.0, 'curvature_scaling': 1.0, 'number_of_iterations': 200}
+THRESHOLD_PARAMETERS = {'lower_threshold': 210, 'upper_threshold': 250, 'number_of_iterations': 200}
+LAPLACIAN_PARAMETERS = {'diffusion_iterations': 10, 'conductance': 2.0, 'propagation_weight': 1.0,
+                        'isovalue': 127.5, 'number_of_iterations': 15}
+
+# Phantom edge length of the streaming check, and the largest difference from
+# the whole-volume result allowed per stage, relative to that result's range
+STREAMING_CHECK_SIZE = 48
+STREAMING_TOLERANCES = {'smoothing': 1e-6, 'gradient': 1e-3, 'sigmoid': 1e-3, 'laplacian_diffusion': 1e-6}
+
+# Phantom intensities, close to the BrainProtonDensitySlice tissue values
+BACKGROUND, TISSUE, VENTRICLE, NOISE = 20.0, 165.0, 230.0, 8.0
+
+
+def make_phantom(dimension, size, seed=0):
+    """Return (image, model, seed index): an ellipsoidal "brain" around a bright "ventricle"."""
+    grid = np.meshgrid(*[np.linspace(-1.0, 1.0, size)] * dimension, indexing='ij')
+    brain = sum((axis / radius) ** 2 for axis, radius in zip(grid, [0.85, 0.75, 0.8])) <= 1.0
+    centre = [0.15, -0.1, 0.0][:dimension]
+    radii = [0.25, 0.35, 0.3][:dimension]
+    ventricle = sum(((axis - c) / r) ** 2 for axis, c, r in zip(grid, centre, radii)) <= 1.0
+    inner = sum(((axis - c) / (0.6 * r)) ** 2 for axis, c, r in zip(grid, centre, radii)) <= 1.0
+
+    pixels = np.full(brain.shape, BACKGROUND, dtype=np.float32)
+    pixels[brain] = TISSUE
+    pixels[ventricle] = VENTRICLE
+    pixels += np.random.default_rng(seed).normal(0.0, NOISE, pixels.shape).astype(np.float32)
+    np.clip(pixels, 0.0, 255.0, out=pixels)
+
+    # The arrays are indexed [x, y, z] above; ITK views them as [z, y, x]
+    image = itk.image_from_array(np.ascontiguousarray(pixels.T))
+    model = itk.image_from_array(np.ascontiguousarray(np.where(inner, 255.0, 0.0).astype(np.float32).T))
+    seed_index = [int(round((c + 1.0) / 2.0 * (size - 1))) for c in centre]
+    return image, model, seed_index
+
+
+def _status_kb(field):
+    # Linux only: /proc/self/status values are in kB
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith(field + ':'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return None
+
+
+def _reset_peak_rss():
+    # Writing 5 to clear_refs resets VmHWM, so each stage gets its own peak
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+        return True
+    except OSError:
+        return False
+
+
+class StageRecorder:
+    def __init__(self):
+        self.stages = []
+        self._name = None
+
+    def __call__(self, name):
+        self._name = name
+        return self
+
+    def __enter__(self):
+        self._per_stage_peak = _reset_peak_rss()
+        self._start_kb = _status_kb('VmRSS')
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        # Without clear_refs the high-water mark covers the whole process so far
+        peak_kb = _status_kb('VmHWM') if self._per_stage_peak else None
+        if peak_kb is None:
+            peak_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        self.stages.append({
+            'stage': self._name,
+            'seconds': wall,
+            'cpu_seconds': cpu,
+            'peak_rss_mb': peak_kb / 1024.0,
+            # Memory the stage added on top of what was resident when it started
+            'stage_rss_mb': max(peak_kb - (self._start_kb or peak_kb), 0) / 1024.0 if self._per_stage_peak else None,
+            'threads': _status_kb('Threads') or 1,
+        })
+
+
+def _read(path, stage):
+    with stage('read'):
+        return itk.imread(path, itk.F)
+
+
+def _write(segmentation, workdir, stage):
+    with stage('write'):
+        itk.imwrite(segmentation, os.path.join(workdir, 'segmentation.mha'))
+
+
+def _binary(level_set, lower=-1000.0, upper=0.0):
+    InternalImageType = type(level_set)
+    thresholder = itk.BinaryThresholdImageFilter[InternalImageType, itk.Image[itk.UC, level_set.GetImageDimension()]].New()
+    thresholder.SetInput(level_set)
+    thresholder.SetLowerThreshold(lower)
+    thresholder.SetUpperThreshold(upper)
+    thresholder.SetOutsideValue(0)
+    thresholder.SetInsideValue(255)
+    thresholder.Update()
+    return thresholder.GetOutput()
+
+
+def _speed_image(image, stage):
+    with stage('smoothing'):
+        smoothing = smoothing_stage(image)
+    with stage('gradient'):
+        gradient = gradient_stage(smoothing, SPEED_PARAMETERS['sigma'])
+    with stage('sigmoid'):
+        return sigmoid_stage(gradient, SPEED_PARAMETERS['alpha'], SPEED_PARAMETERS['beta'])
+
+
+def run_fast_marching(paths, seed, workdir, stage):
+    speed = _speed_image(_read(paths['image'], stage), stage)
+    with stage('fast_marching'):
+        segmentation = segment_seed_group(speed, [seed], FAST_MARCHING_PARAMETERS['time_threshold'],
+                                          FAST_MARCHING_PARAMETERS['stopping_value'])[1]
+    _write(segmentation, workdir, stage)
+
+
+def _run_speed_level_set(make_filter, parameters, paths, seed, workdir, stage):
+    speed = _speed_image(_read(paths['image'], stage), stage)
+    with stage('fast_marching'):
+        initial = initial_level_set(speed, seed, INITIAL_DISTANCE)
+    with stage('level_set'):
+        level_set = make_filter(initial, speed, parameters['propagation_scaling'], parameters['curvature_scaling'],
+                                number_of_iterations=parameters['number_of_iterations'])
+        level_set.Update()
+    with stage('threshold'):
+        segmentation = _binary(level_set.GetOutput())
+    _write(segmentation, workdir, stage)
+
+
+def run_shape_detection(paths, seed, workdir, stage):
+    _run_speed_level_set(shape_detection_filter, SHAPE_DETECTION_PARAMETERS, paths, seed, workdir, stage)
+
+
+def run_geodesic_active_contours(paths, seed, workdir, stage):
+    _run_speed_level_set(geodesic_active_contour_filter, GEODESIC_PARAMETERS, paths, seed, workdir, stage)
+
+
+def run_threshold(paths, seed, workdir, stage):
+    image = _read(paths['image'], stage)
+    with stage('fast_marching'):
+        # threshold.py marches at a constant speed, having no speed image
+        initial = initial_level_set(image, seed, INITIAL_DISTANCE, use_speed=False)
+    with stage('level_set'):
+        level_set = threshold_segmentation_filter(initial, image, THRESHOLD_PARAMETERS['lower_threshold'],
+                                                  THRESHOLD_PARAMETERS['upper_threshold'],
+                                                  number_of_iterations=THRESHOLD_PARAMETERS['number_of_iterations'])
+        level_set.Update()
+    with stage('threshold'):
+        segmentation = _binary(level_set.GetOutput())
+    _write(segmentation, workdir, stage)
+
+
+def run_laplacian(paths, seed, workdir, stage):
+    image = _read(paths['image'], stage)
+    with stage('diffusion'):
+        feature = gradient_diffusion(image, LAPLACIAN_PARAMETERS['diffusion_iterations'], LAPLACIAN_PARAMETERS['conductance'])
+    with stage('read_model'):
+        model = itk.imread(paths['model'], itk.F)
+    with stage('level_set'):
+        level_set = laplacian_filter(model, feature, LAPLACIAN_PARAMETERS['propagation_weight'],
+                                     LAPLACIAN_PARAMETERS['isovalue'], LAPLACIAN_PARAMETERS['number_of_iterations'])
+        level_set.Update()
+    with stage('threshold'):
+        segmentation = _binary(level_set.GetOutput(), 0, 10)
+    _write(segmentation, workdir, stage)
+
+
+PIPELINES = {
+    'fast_marching': run_fast_marching,
+    'shape_detection': run_shape_detection,
+    'geodesic_active_contours': run_geodesic_active_contours,
+    'threshold': run_threshold,
+    'laplacian': run_laplacian,
+}
+
+
+def _write_phantom(workdir, dimension, size):
+    image, model, seed = make_phantom(dimension, size)
+    paths = {'image': os.path.join(workdir, f'phantom_{dimension}d_{size}.mha'),
+             'model': os.path.join(workdir, f'model_{dimension}d_{size}.mha')}
+    itk.imwrite(image, paths['image'])
+    itk.imwrite(model, paths['model'])
+    return paths, seed
+
+
+def run_case(pipeline, dimension, size, repeat, threads):
+    """Run one pipeline on one phantom; called in a fresh process per case."""
+    if threads:
+        itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+    run = PIPELINES[pipeline]
+    with tempfile.TemporaryDirectory() as workdir:
+        # The warm-up run loads every template the pipeline needs
+        paths, seed = _write_phantom(workdir, dimension, WARMUP_SIZE)
+        run(paths, seed, workdir, StageRecorder())
+
+        paths, seed = _write_phantom(workdir, dimension, size)
+        repeats = []
+        for _ in range(repeat):
+            recorder = StageRecorder()
+            run(paths, seed, workdir, recorder)
+            repeats.append(recorder.stages)
+
+    # Fastest repeat for the times, largest for memory and threads
+    stages = []
+    for records in zip(*repeats):
+        stages.append({
+            'stage': records[0]['stage'],
+            'seconds': round(min(r['seconds'] for r in records), 6),
+            'cpu_seconds': round(min(r['cpu_seconds'] for r in records), 6),
+            'peak_rss_mb': round(max(r['peak_rss_mb'] for r in records), 3),
+            'stage_rss_mb': None if records[0]['stage_rss_mb'] is None else round(max(r['stage_rss_mb'] for r in records), 3),
+            'threads': max(r['threads'] for r in records),
+        })
+    return {
+        'pipeline': pipeline,
+        'dimension': dimension,
+        'size': size,
+        'seconds': round(sum(s['seconds'] for s in stages), 6),
+        'stages': stages,
+    }
+
+
+def check_streaming(size=STREAMING_CHECK_SIZE):
+    """Return [(stage, max |streamed - whole|, range of the whole-volume result)] on a 3D phantom."""
+    image_type = itk.Image[itk.F, 3]
+    sigma, alpha, beta = SPEED_PARAMETERS['sigma'], SPEED_PARAMETERS['alpha'], SPEED_PARAMETERS['beta']
+    with tempfile.TemporaryDirectory() as workdir:
+        paths, _ = _write_phantom(workdir, 3, size)
+        image = itk.imread(paths['image'], itk.F)
+        # Slabs of an eighth of the volume for the widest halo, so every stage streams several slabs
+        halo = gaussian_halo(sigma, image)
+        budget_mb = 4 * DEFAULT_BUFFER_COPIES * size ** 2 * (size // 8 + 2 * halo) / 2**20
+
+        streamed = [itk.imread(path, itk.F) for path in compute_speed_image_streamed(
+            paths['image'], image_type, sigma, alpha, beta, StageCache(os.path.join(workdir, 'cache')), budget_mb)]
+        whole = list(compute_speed_image(paths['image'], image_type, sigma, alpha, beta))
+
+        def diffuse(slab, number_of_iterations, average_gradient_magnitude):
+            return gradient_diffusion(slab, number_of_iterations, LAPLACIAN_PARAMETERS['conductance'], average_gradient_magnitude)
+
+        diffusion_path = os.path.join(workdir, 'diffusion.mha')
+        stream_diffusion(paths['image'], diffusion_path, image_type, diffuse, LAPLACIAN_PARAMETERS['diffusion_iterations'], budget_mb)
+        streamed.append(itk.imread(diffusion_path, itk.F))
+        whole.append(gradient_diffusion(image, LAPLACIAN_PARAMETERS['diffusion_iterations'], LAPLACIAN_PARAMETERS['conductance']))
+
+        results = []
+        for stage, streamed_image, whole_image in zip(STREAMING_TOLERANCES, streamed, whole):
+            streamed_array = itk.array_from_image(streamed_image).astype(np.float64)
+            whole_array = itk.array_from_image(whole_image).astype(np.float64)
+            results.append((stage, float(np.abs(streamed_array - whole_array).max()), float(np.ptp(whole_array))))
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def find_regressions(record, history, baseline_runs, max_slowdown, max_rss_growth, min_seconds, min_rss_mb):
+    # Baseline: median of the last runs of the same stage on this host and thread count
+    previous = [r for r in history
+                if r['host']['name'] == record['host']['name'] and r['threads'] == record['threads']][-baseline_runs:]
+    baselines = {}
+    for run in previous:
+        for case in run['cases']:
+            for stage in case['stages']:
+                key = (case['pipeline'], case['dimension'], case['size'], stage['stage'])
+                baselines.setdefault(key, []).append(stage)
+
+    regressions = []
+    for case in record['cases']:
+        for stage in case['stages']:
+            key = (case['pipeline'], case['dimension'], case['size'], stage['stage'])
+            if key not in baselines:
+                continue
+            seconds = statistics.median(s['seconds'] for s in baselines[key])
+            if stage['seconds'] > seconds * (1.0 + max_slowdown) and stage['seconds'] - seconds > min_seconds:
+                regressions.append((key, 'seconds', seconds, stage['seconds']))
+            # The memory a stage adds is compared where it was measured, the process peak otherwise
+            metric = 'stage_rss_mb' if stage['stage_rss_mb'] is not None else 'peak_rss_mb'
+            measured = [s[metric] for s in baselines[key] if s.get(metric) is not None]
+            if measured:
+                rss = statistics.median(measured)
+                if stage[metric] > rss * (1.0 + max_rss_growth) and stage[metric] - rss > min_rss_mb:
+                    regressions.append((key, metric, rss, stage[metric]))
+    return regressions
+
+
+def print_case(case):
+    print(f"{case['pipeline']} {case['dimension']}D size {case['size']}: {case['seconds']:.3f} s")
+    for stage in case['stages']:
+        print(f"    {stage['stage']:<14} {stage['seconds']:9.4f} s  cpu {stage['cpu_seconds']:9.4f} s  "
+              f"peak {stage['peak_rss_mb']:8.1f} MB  stage {stage['stage_rss_mb'] or 0.0:7.1f} MB  threads {stage['threads']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the level-set pipelines on synthetic phantoms and track regressions.")
+    parser.add_argument("-p", "--pipelines", nargs='+', choices=sorted(PIPELINES), default=list(PIPELINES), help="Pipelines to run.")
+    parser.add_argument("--dimensions", type=int, nargs='+', choices=[2, 3], default=[2, 3], help="Phantom dimensions to run.")
+    parser.add_argument("--sizes_2d", type=int, nargs='+', default=DEFAULT_SIZES[2], help="Edge lengths of the 2D phantoms.")
+    parser.add_argument("--sizes_3d", type=int, nargs='+', default=DEFAULT_SIZES[3], help="Edge lengths of the 3D phantoms.")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="Timed repeats per case; the fastest one is kept.")
+    parser.add_argument("-t", "--threads", type=int, default=0, help="ITK threads per filter (0 keeps the ITK default).")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON-lines benchmark history to compare against and append to.")
+    parser.add_argument("--no_record", action="store_true", help="Compare against the history without appending this run.")
+    parser.add_argument("--baseline_runs", type=int, default=5, help="Previous runs whose median is the baseline.")
+    parser.add_argument("--max_slowdown", type=float, default=0.25, help="Allowed relative wall-time increase of a stage.")
+    parser.add_argument("--max_rss_growth", type=float, default=0.20, help="Allowed relative peak RSS increase of a stage.")
+    parser.add_argument("--min_seconds", type=float, default=0.05, help="Slowdowns smaller than this many seconds are ignored as noise.")
+    parser.add_argument("--min_rss_mb", type=float, default=8.0, help="Memory increases smaller than this many MB are ignored as noise.")
+    parser.add_argument("--no_streaming_check", action="store_true", help="Skip the check of streamed against whole-volume stages.")
+
+    args = parser.parse_args()
+    sizes = {2: args.sizes_2d, 3: args.sizes_3d}
+
+    record = {
+        'timestamp': datetime.now(timezone.utc).isoformat(timespec='seconds'),
+        'commit': _git_commit(),
+        'host': {'name': socket.gethostname(), 'platform': platform.platform(), 'cpus': os.cpu_count(),
+                 'python': platform.python_version(), 'itk': itk.Version.GetITKVersion()},
+        'threads': args.threads or itk.MultiThreaderBase.GetGlobalDefaultNumberOfThreads(),
+        'repeat': args.repeat,
+        'cases': [],
+    }
+
+    mismatches = []
+    if not args.no_streaming_check:
+        for stage, difference, value_range in check_streaming():
+            print(f"Streaming check: {stage:<20} max |streamed - whole| {difference:.6g} (range {value_range:.6g})")
+            if difference > STREAMING_TOLERANCES[stage] * value_range:
+                mismatches.append(stage)
+        for stage in mismatches:
+            print(f"Mismatch: streamed {stage} differs from the whole-volume result.")
+
+    # A fresh process per case keeps the peak RSS and loaded templates of one case out of the next
+    context = multiprocessing.get_context('spawn')
+    for pipeline in args.pipelines:
+        for dimension in args.dimensions:
+            for size in sizes[dimension]:
+                with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+                    try:
+                        case = pool.submit(run_case, pipeline, dimension, size, args.repeat, args.threads).result()
+                    except Exception as e:
+                        print(f"Exception caught while benchmarking {pipeline} {dimension}D size {size}!", str(e))
+                        continue
+                print_case(case)
+                record['cases'].append(case)
+
+    regressions = find_regressions(record, read_history(args.history), args.baseline_runs,
+                                   args.max_slowdown, args.max_rss_growth, args.min_seconds, args.min_rss_mb)
+    for (pipeline, dimension, size, stage), metric, baseline, value in regressions:
+        print(f"Regression: {pipeline} {dimension}D size {size} {stage} {metric} {value:.4f} (baseline {baseline:.4f})")
+
+    if not args.no_record:
+        os.makedirs(os.path.dirname(args.history) or '.', exist_ok=True)
+        with open(args.history, 'a') as f:
+            f.write(json.dumps(record) + "\n")
+        print(f"{args.history} written successfully.")
+
+    if regressions or mismatches:
+        sys.exit(1)
+    print("No regressions against the benchmark history.")
+
+
+if __name__ == "__main__":
+    main()
+
+# Run the script with the following command:
+# python benchmarks.py
+# Quick 2D check of two pipelines:
+# python benchmarks.py --pipelines fast_marching threshold --dimensions 2 --sizes_2d 128 --repeat 1
@@ -0,0 +1,157 @@
+# Background writer for the intermediate (debug) outputs of the level-set
+# scripts: smoothing, gradient, sigmoid and fast marching images.
+#
+# write() takes a snapshot of the image buffer and returns immediately; the
+# rescale and file write run on a small thread pool while the pipeline moves
+# on to the next stage. Debug outputs can be written as rescaled 8-bit
+# images (the previous behaviour), as raw float .mha files that skip the
+# rescale, or switched off.
+#
+# The writer threads never print. The outcome of each write is reported on
+# the calling thread, in the order of the write() calls, by later write()
+# calls and by close(), which waits for every write and reports the failures,
+# so the messages do not interleave with the script's own output.
+
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import itk
+
+DEBUG_FORMATS = ['png', 'raw', 'none']
+
+
+def rescaled_writer(filter_output, output_image_type, output_path, output_min=0, output_max=255):
+    rescaler = itk.RescaleIntensityImageFilter[type(filter_output), output_image_type].New()
+    rescaler.SetInput(filter_output)
+    rescaler.SetOutputMinimum(output_min)
+    rescaler.SetOutputMaximum(output_max)
+
+    writer = itk.ImageFileWriter[output_image_type].New()
+    writer.SetFileName(output_path)
+    writer.SetInput(rescaler.GetOutput())
+    # An image does not own its source filter, so the caller keeps the rescaler alive until the writer runs
+    return writer, rescaler
+
+
+def raw_writer(image, output_path):
+    writer = itk.ImageFileWriter[type(image)].New()
+    writer.SetFileName(os.path.splitext(output_path)[0] + '.mha')
+    writer.SetInput(image)
+    return writer
+
+
+def _update(writer):
+    # Returns the error message of a failed write, None on success
+    try:
+        writer.Update()
+        return None
+    except Exception as e:
+        return str(e)
+
+
+def _make_directory(output_path):
+    # Returns the error message if the output directory cannot be created, None otherwise
+    try:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        return None
+    except OSError as e:
+        return str(e)
+
+
+def _report(output_path, error):
+    if error is None:
+        print(f"{output_path} written successfully.")
+    else:
+        print(f"Exception caught while writing {output_path}!", error)
+
+
+def run_writer(writer):
+    output_path = writer.GetFileName()
+    error = _make_directory(output_path)
+    _report(output_path, error if error is not None else _update(writer))
+
+
+# Utility function for applying a rescaler and writing output to a file
+def rescale_and_write(filter_output, output_image_type, output_path, output_min=0, output_max=255):
+    writer, rescaler = rescaled_writer(filter_output, output_image_type, output_path, output_min, output_max)
+    run_writer(writer)
+
+
+def snapshot(image):
+    # A private copy of the buffer, so later pipeline updates cannot change what is written
+    image.Update()
+    duplicator = itk.ImageDuplicator[type(image)].New()
+    duplicator.SetInputImage(image)
+    duplicator.Update()
+    return duplicator.GetOutput()
+
+
+class DebugWriter:
+    def __init__(self, debug_format='png', threads=2):
+        self.debug_format = debug_format
+        self._pool = ThreadPoolExecutor(max_workers=threads) if debug_format != 'none' and threads > 0 else None
+        self._pending = []
+        self.failures = []
+
+    def _report_finished(self, wait=False):
+        # Reports (and drops) the jobs at the front of the queue that are done, or all of them with wait=True
+        while self._pending and (wait or self._pending[0][0].done()):
+            future, output_path, _ = self._pending.pop(0)
+            error = future.result()
+            _report(output_path, error)
+            if error is not None:
+                self.failures.append((output_path, error))
+
+    def write(self, image, output_path):
+        if self.debug_format == 'none':
+            return
+        image = snapshot(image)
+        rescaler = None
+        if self.debug_format == 'raw':
+            writer = raw_writer(image, output_path)
+        else:
+            writer, rescaler = rescaled_writer(image, itk.Image[itk.UC, image.GetImageDimension()], output_path)
+
+        output_path = writer.GetFileName()
+        error = _make_directory(output_path)
+        if self._pool is None or error is not None:
+            self._report_finished(wait=True)
+            if error is None:
+                error = _update(writer)
+            _report(output_path, error)
+            if error is not None:
+                self.failures.append((output_path, error))
+        else:
+            # The filters, the ImageIO and the output directory are created
+            # here, since ITK's lazy loading and IO factory are not safe to
+            # call from several threads
+            writer.SetImageIO(itk.ImageIOFactory.CreateImageIO(output_path, itk.CommonEnums.IOFileMode_WriteMode))
+            self._report_finished()
+            # Each job holds its rescaler until the write has run
+            self._pending.append((self._pool.submit(_update, writer), output_path, rescaler))
+
+    def close(self):
+        # Waits for every queued write, reports it, and sums up the failures
+        if self._pool is not None:
+            self._report_finished(wait=True)
+            self._pool.shutdown()
+            self._pool = None
+        if self.failures:
+            print(f"{len(self.failures)} intermediate output(s) could not be written: "
+                  f"{', '.join(path for path, _ in self.failures)}.")
+            self.failures = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def add_debug_writer_arguments(parser):
+    parser.add_argument("--debug_outputs", choices=DEBUG_FORMATS, default='png', help="Intermediate outputs as rescaled 8-bit images, raw float .mha files, or none.")
+    parser.add_argument("--writer_threads", type=int, default=2, help="Background threads writing intermediate outputs (0 writes them inline).")
+
+
+def debug_writer_from_args(args):
+    return DebugWriter(args.debug_outputs, args.writer_threads)
@@ -1,129 +1,232 @@
 import itk
 import argparse
+import csv
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from debug_writer import add_debug_writer_arguments, debug_writer_from_args, rescale_and_write
+from speed_image_cache import DEFAULT_CACHE_DIR, StageCache, speed_image_margin, speed_image_stages
+from volume_streaming import (add_auto_roi_arguments, add_volume_arguments, image_geometry, paste_region, parse_region,
+                              read_image_information, seed_index, seed_region, set_fast_marching_geometry, volume_output_path)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+# Fast marching from one group of seeds over a precomputed speed image
+def segment_seed_group(speed_image, seed_positions, time_threshold, stopping_value):
+    InternalImageType = type(speed_image)
+    Dimension = speed_image.GetImageDimension()
+    OutputImageType = itk.Image[itk.UC, Dimension]
+
+    fastMarching = itk.FastMarchingImageFilter[InternalImageType, InternalImageType].New()
+    fastMarching.SetInput(speed_image)
+    set_fast_marching_geometry(fastMarching, speed_image)
+    fastMarching.SetStoppingValue(stopping_value)
+
+    # Seed points for Fast Marching
+    NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
+    seeds = NodeContainer.New()
+    seeds.Initialize()
+    for i, seedPosition in enumerate(seed_positions):
+        node = itk.LevelSetNode[itk.F, Dimension]()
+        node.SetValue(0.0)
+        node.SetIndex(seedPosition)
+        seeds.InsertElement(i, node)
+    fastMarching.SetTrialPoints(seeds)
+
+    # Thresholding filter
+    thresholder = itk.BinaryThresholdImageFilter[InternalImageType, OutputImageType].New()
+    thresholder.SetLowerThreshold(0)
+    thresholder.SetUpperThreshold(int(time_threshold))
+    thresholder.SetOutsideValue(0)
+    thresholder.SetInsideValue(255)
+    thresholder.SetInput(fastMarching.GetOutput())
+    thresholder.Update()
+
+    return fastMarching.GetOutput(), thresholder.GetOutput()
+
+
+# Seeds file: one "group,x,y[,z]" row per seed; rows sharing a group name are marched together
+def read_seeds_file(seeds_path):
+    groups = {}
+    with open(seeds_path, newline='') as f:
+        for row in csv.reader(f):
+            if not row or row[0].strip().startswith('#') or row[0].strip() == 'group':
+                continue
+            group = row[0].strip()
+            groups.setdefault(group, []).append([int(value) for value in row[1:] if value.strip()])
+    return groups
+
+
+_worker_state = {}
+
+
+def _init_worker(speed_image, geometry):
+    _worker_state.update(speed_image=speed_image, geometry=geometry)
+
+
+def paste_segmentation(arrival_times, segmentation, geometry):
+    # Outside an --auto_roi crop the front never arrived: no segmentation and the largest arrival time
+    if geometry is None:
+        return arrival_times, segmentation
+    unreached = float(itk.array_view_from_image(arrival_times).max())
+    return paste_region(arrival_times, geometry, unreached), paste_region(segmentation, geometry, 0)
+
+
+def _run_seed_group(group, seed_positions, time_threshold, stopping_value, output_dir, write_arrival_times):
+    start = time.perf_counter()
+    arrival_times, segmentation = paste_segmentation(
+        *segment_seed_group(_worker_state['speed_image'], seed_positions, time_threshold, stopping_value),
+        _worker_state['geometry'])
+    dimension = segmentation.GetImageDimension()
+    thresholded_output_path = volume_output_path(
+        os.path.join(output_dir, f"Thresholded_BrainProtonDensitySliceFastMarching_{group}.png"), dimension)
+
+    writer = itk.ImageFileWriter[type(segmentation)].New()
+    writer.SetFileName(thresholded_output_path)
+    writer.SetInput(segmentation)
+    writer.Update()
+    if write_arrival_times:
+        rescale_and_write(arrival_times, type(segmentation),
+                          volume_output_path(os.path.join(output_dir, f"BrainProtonDensitySliceFastMarching_{group}.png"), dimension))
+
+    segmented_pixels = int(itk.array_view_from_image(segmentation).astype(bool).sum())
+    return {
+        'group': group,
+        'seeds': ' '.join(':'.join(str(i) for i in position) for position in seed_positions),
+        'segmented_pixels': segmented_pixels,
+        'seconds': round(time.perf_counter() - start, 4),
+        'output': thresholded_output_path,
+    }
+
+
+def run_seed_batch(speed_image, groups, args, output_dir, geometry=None):
+    # Load the ITK modules once here so forked workers do not each pay the lazy import
+    InternalImageType = type(speed_image)
+    OutputImageType = itk.Image[itk.UC, speed_image.GetImageDimension()]
+    itk.FastMarchingImageFilter[InternalImageType, InternalImageType]
+    itk.BinaryThresholdImageFilter[InternalImageType, OutputImageType]
+    itk.ImageFileWriter[OutputImageType]
+
+    rows = []
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker, initargs=(speed_image, geometry)) as pool:
+        futures = {
+            pool.submit(_run_seed_group, group, seed_positions, args.time_threshold, args.stopping_value,
+                        output_dir, args.write_arrival_times): group
+            for group, seed_positions in groups.items()
+        }
+        for future in as_completed(futures):
+            try:
+                row = future.result()
+                print(f"{row['output']} written successfully.")
+                rows.append(row)
+            except Exception as e:
+                print(f"Exception caught while segmenting seed group {futures[future]}!", str(e))
+
+    rows.sort(key=lambda row: row['group'])
+    summary_path = os.path.join(output_dir, 'seeds_summary.csv')
+    with open(summary_path, 'w', newline='') as f:
+        summary = csv.DictWriter(f, fieldnames=['group', 'seeds', 'segmented_pixels', 'seconds', 'output'])
+        summary.writeheader()
+        summary.writerows(rows)
+    print(f"{summary_path} written successfully.")
 
-# Utility function for applying a rescaler and writing output to a file
-def rescale_and_write(filter_output, output_image_type, output_path, output_min=0, output_max=255):
-    try:
-        rescaler = itk.RescaleIntensityImageFilter[type(filter_output), output_image_type].New()
-        rescaler.SetInput(filter_output)
-        rescaler.SetOutputMinimum(output_min)
-        rescaler.SetOutputMaximum(output_max)
-        
-        rescaler.Update()
-        
-        writer = itk.ImageFileWriter[output_image_type].New()
-        writer.SetFileName(output_path)
-        writer.SetInput(rescaler.GetOutput())
-        writer.Update()
-        
-        print(f"{output_path} written successfully.")
-    except Exception as e:
-        print(f"Exception caught while writing {output_path}!", str(e))
 
 def main():
     # Argument parser setup with flags
     parser = argparse.ArgumentParser(description="ITK Fast Marching Segmentation with Smoothing, Gradient, and Sigmoid Filters.")
 
-    parser.add_argument("-x", "--seedX", type=int, required=True, help="X coordinate of the seed point.")
-    parser.add_argument("-y", "--seedY", type=int, required=True, help="Y coordinate of the seed point.")
+    parser.add_argument("-x", "--seedX", type=int, help="X coordinate of the seed point.")
+    parser.add_argument("-y", "--seedY", type=int, help="Y coordinate of the seed point.")
+    parser.add_argument("-z", "--seedZ", type=int, default=0, help="Z coordinate of the seed point (3D only).")
     parser.add_argument("-s", "--sigma", type=float, required=True, help="Sigma value for the gradient magnitude filter.")
     parser.add_argument("-a", "--alpha", type=float, required=True, help="Alpha value for the sigmoid filter.")
     parser.add_argument("-b", "--beta", type=float, required=True, help="Beta value for the sigmoid filter.")
     parser.add_argument("-t", "--time_threshold", type=float, required=True, help="Time threshold for fast marching.")
     parser.add_argument("-q", "--stopping_value", type=float, required=True, help="Stopping value for fast marching.")
+    parser.add_argument("--seeds-file", dest="seeds_file", help="CSV of group,x,y[,z] rows; segments every seed group against one speed image.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Worker processes used with --seeds-file.")
+    parser.add_argument("--write_arrival_times", action="store_true", help="Also write the rescaled arrival-time image of every seed group.")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Directory for cached smoothing, gradient and sigmoid images.")
+    parser.add_argument("--no_cache", action="store_true", help="Recompute every stage and do not write the on-disk cache.")
+    add_volume_arguments(parser)
+    add_auto_roi_arguments(parser, "Largest physical distance the front can reach from a seed with --auto_roi (default: --stopping_value).")
+    add_debug_writer_arguments(parser)
+    add_profiler_arguments(parser)
     
     args = parser.parse_args()
-
-    # Input and output paths
-    input_path = './data/BrainProtonDensitySlice.png'
-    output_path = './output/FastMarching/BrainProtonDensitySliceFastMarching.png'
-    smoothing_output_path = './output/FastMarching/BrainProtonDensitySliceSmoothing.png'
-    gradient_output_path = './output/FastMarching/BrainProtonDensitySliceGradient.png'
-    sigmoid_output_path = './output/FastMarching/BrainProtonDensitySliceSigmoid.png'
-    thresholded_output_path = './output/FastMarching/Thresholded_BrainProtonDensitySliceFastMarching.png'
+    if args.memory_budget and args.no_cache:
+        parser.error("--memory_budget streams the stages through the disk cache and cannot be combined with --no_cache.")
+    if args.seeds_file is None and (args.seedX is None or args.seedY is None):
+        parser.error("--seedX and --seedY are required unless --seeds-file is given.")
+    if args.auto_roi and (args.roi or args.memory_budget):
+        parser.error("--auto_roi picks its own region and cannot be combined with --roi or --memory_budget.")
+    profiler = profiler_from_args(args)
 
     # Internal types and setup
     InternalPixelType = itk.F
-    Dimension = 2
+    Dimension = args.dimension
     InternalImageType = itk.Image[InternalPixelType, Dimension]
     OutputPixelType = itk.UC
     OutputImageType = itk.Image[OutputPixelType, Dimension]
 
-    # Reader
-    reader = itk.ImageFileReader[InternalImageType].New()
-    reader.SetFileName(input_path)
-
-    # Thresholding filter
-    thresholder = itk.BinaryThresholdImageFilter[InternalImageType, OutputImageType].New()
-    thresholder.SetLowerThreshold(0)
-    thresholder.SetUpperThreshold(int(args.time_threshold))
-    thresholder.SetOutsideValue(0)
-    thresholder.SetInsideValue(255)
-
-    # Smoothing filter
-    smoothing = itk.CurvatureAnisotropicDiffusionImageFilter[InternalImageType, InternalImageType].New()
-    smoothing.SetInput(reader.GetOutput())
-    smoothing.SetTimeStep(0.125)
-    smoothing.SetNumberOfIterations(5)
-    smoothing.SetConductanceParameter(9.0)
-
-    # Gradient filter
-    gradientMagnitude = itk.GradientMagnitudeRecursiveGaussianImageFilter[InternalImageType, InternalImageType].New()
-    gradientMagnitude.SetInput(smoothing.GetOutput())
-    gradientMagnitude.SetSigma(args.sigma)
-
-    # Sigmoid filter
-    sigmoid = itk.SigmoidImageFilter[InternalImageType, InternalImageType].New()
-    sigmoid.SetInput(gradientMagnitude.GetOutput())
-    sigmoid.SetAlpha(args.alpha)
-    sigmoid.SetBeta(args.beta)
-    sigmoid.SetOutputMinimum(0.0)
-    sigmoid.SetOutputMaximum(1.0)
-
-    # Fast marching filter
-    fastMarching = itk.FastMarchingImageFilter[InternalImageType, InternalImageType].New()
-    fastMarching.SetInput(sigmoid.GetOutput())
-    fastMarching.SetOutputSize(reader.GetOutput().GetBufferedRegion().GetSize())
-    fastMarching.SetStoppingValue(args.stopping_value)
-
-    # Seed points for Fast Marching
-    NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
-    seeds = NodeContainer.New()
-    seedPosition = [args.seedX, args.seedY]
-
-    node = itk.LevelSetNode[itk.F, Dimension]()
-    node.SetValue(0.0)
-    node.SetIndex(seedPosition)
-    seeds.Initialize()
-    seeds.InsertElement(0, node)
-    fastMarching.SetTrialPoints(seeds)
-
-
-    thresholder.SetInput(fastMarching.GetOutput())
+    # Input and output paths
+    input_path = args.input
+    output_dir = './output/FastMarching'
+    output_path = volume_output_path('./output/FastMarching/BrainProtonDensitySliceFastMarching.png', Dimension)
+    smoothing_output_path = volume_output_path('./output/FastMarching/BrainProtonDensitySliceSmoothing.png', Dimension)
+    gradient_output_path = volume_output_path('./output/FastMarching/BrainProtonDensitySliceGradient.png', Dimension)
+    sigmoid_output_path = volume_output_path('./output/FastMarching/BrainProtonDensitySliceSigmoid.png', Dimension)
+    thresholded_output_path = volume_output_path('./output/FastMarching/Thresholded_BrainProtonDensitySliceFastMarching.png', Dimension)
+
+    groups = read_seeds_file(args.seeds_file) if args.seeds_file is not None else None
+    seeds = [position for group in groups.values() for position in group] if groups else [seed_index(args, Dimension)]
+
+    # With --auto_roi the chain only runs on a box around the seeds. The speed image is at most 1,
+    # so the front cannot travel further than the stopping value from a seed.
+    input_region = None
+    geometry = None
+    if args.auto_roi:
+        info = read_image_information(input_path, InternalImageType)
+        radius = args.roi_radius if args.roi_radius is not None else args.stopping_value
+        input_region = seed_region(info, seeds, radius, speed_image_margin(args.sigma, info))
+        geometry = image_geometry(info)
+        print(f"Auto ROI: {list(input_region.GetSize())} of {geometry['size']} pixels from index {list(input_region.GetIndex())}.")
+
+    # Smoothing, gradient and sigmoid stages, reused from the cache when their inputs are unchanged.
+    # With --memory_budget they are streamed to the cache and only the --roi region is loaded.
+    cache = StageCache(args.cache_dir, use_disk=not args.no_cache)
+    smoothing_image, gradient_image, sigmoid_image = speed_image_stages(
+        input_path, InternalImageType, args.sigma, args.alpha, args.beta, cache,
+        args.memory_budget, parse_region(args.roi, Dimension), input_region)
+
+    # Apply filters and write outputs; intermediate images are written in the background
+    debug_writer = debug_writer_from_args(args)
+    debug_writer.write(smoothing_image, smoothing_output_path)
+    debug_writer.write(gradient_image, gradient_output_path)
+    debug_writer.write(sigmoid_image, sigmoid_output_path)
+
+    if groups is not None:
+        run_seed_batch(sigmoid_image, groups, args, output_dir, geometry)
+        debug_writer.close()
+        profiler.report()
+        return
+
+    arrival_times, segmentation = paste_segmentation(
+        *segment_seed_group(sigmoid_image, seeds, args.time_threshold, args.stopping_value), geometry)
+    debug_writer.write(arrival_times, output_path)
 
     writer = itk.ImageFileWriter[OutputImageType].New()
     writer.SetFileName(thresholded_output_path)
-    writer.SetInput(thresholder.GetOutput())
-
-    # Apply filters and write outputs
-    smoothing.Update()
-    rescale_and_write(smoothing.GetOutput(), OutputImageType, smoothing_output_path)
-
-    gradientMagnitude.Update()
-    rescale_and_write(gradientMagnitude.GetOutput(), OutputImageType, gradient_output_path)
-
-    sigmoid.Update()
-    rescale_and_write(sigmoid.GetOutput(), OutputImageType, sigmoid_output_path)
-
-    fastMarching.Update()
-    rescale_and_write(fastMarching.GetOutput(), OutputImageType, output_path)
-
-    thresholder.Update()
+    writer.SetInput(segmentation)
     try:
         writer.Update()
         print(f"{thresholded_output_path} written successfully.")
     except Exception as e:
         print(f"Exception caught while writing {output_path}!", str(e))
+    debug_writer.close()
+    profiler.report()
 
 
 if __name__ == "__main__":
@@ -135,3 +238,9 @@ if __name__ == "__main__":
 # python fast_marching_filter.py --seedX 56 --seedY 92 --sigma 1.0 --alpha -0.3 --beta 3.0 --time_threshold 200 --stopping_value 100
 # python fast_marching_filter.py --seedX 40 --seedY 90 --sigma 1.0 --alpha -0.3 --beta 3.0 --time_threshold 200 --stopping_value 100
 # The output images will be saved in the output directory.
+
+# All four structures in one run, sharing one speed image (see seeds_example.csv):
+# python fast_marching_filter.py --seeds-file seeds_example.csv --sigma 1.0 --alpha -0.5 --beta 3.0 --time_threshold 100 --stopping_value 100
+
+# Only filter a box around the seed, sized from the stopping value:
+# python fast_marching_filter.py --seedX 81 --seedY 114 --sigma 1.0 --alpha -0.5 --beta 3.0 --time_threshold 30 --stopping_value 30 --auto_roi
@@ -1,23 +1,27 @@
 import itk
 import argparse
-
-def rescale_and_write(filter_output, output_image_type, output_path, output_min=0, output_max=255):
-    try:
-        rescaler = itk.RescaleIntensityImageFilter[type(filter_output), output_image_type].New()
-        rescaler.SetInput(filter_output)
-        rescaler.SetOutputMinimum(output_min)
-        rescaler.SetOutputMaximum(output_max)
-
-        rescaler.Update()
-
-        writer = itk.ImageFileWriter[output_image_type].New()
-        writer.SetFileName(output_path)
-        writer.SetInput(rescaler.GetOutput())
-        writer.Update()
-
-        print(f"{output_path} written successfully.")
-    except Exception as e:
-        print(f"Exception caught while writing {output_path}!", str(e))
+import os
+import sys
+
+from debug_writer import add_debug_writer_arguments, debug_writer_from_args
+from level_set_monitor import add_monitor_arguments, monitor_from_args, report
+from level_set_pyramid import add_pyramid_arguments, evolve_pyramid
+from speed_image_cache import DEFAULT_CACHE_DIR, StageCache, speed_image_stages
+from volume_streaming import add_volume_arguments, parse_region, seed_index, set_fast_marching_geometry, volume_output_path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+def geodesic_active_contour_filter(initial_level_set, feature_image, propagation_scaling, curvature_scaling=1.0, advection_scaling=1.0, number_of_iterations=800):
+    InternalImageType = type(feature_image)
+    geodesic_active_contour = itk.GeodesicActiveContourLevelSetImageFilter[InternalImageType, InternalImageType, itk.F].New()
+    geodesic_active_contour.SetInput(initial_level_set)
+    geodesic_active_contour.SetFeatureImage(feature_image)
+    geodesic_active_contour.SetPropagationScaling(propagation_scaling)
+    geodesic_active_contour.SetCurvatureScaling(curvature_scaling)
+    geodesic_active_contour.SetAdvectionScaling(advection_scaling)
+    geodesic_active_contour.SetMaximumRMSError(0.02)
+    geodesic_active_contour.SetNumberOfIterations(number_of_iterations)
+    return geodesic_active_contour
 
 
 # Argument parser setup with flags
@@ -27,32 +31,42 @@ def main():
 
     parser.add_argument("-x", "--seedX", type=int, required=True, help="X coordinate of the seed point.")
     parser.add_argument("-y", "--seedY", type=int, required=True, help="Y coordinate of the seed point.")
+    parser.add_argument("-z", "--seedZ", type=int, default=0, help="Z coordinate of the seed point (3D only).")
     parser.add_argument("-s", "--sigma", type=float, required=True, help="Sigma value for the gradient magnitude filter.")
     parser.add_argument("-a", "--alpha", type=float, required=True, help="Alpha value for the sigmoid filter.")
     parser.add_argument("-b", "--beta", type=float, required=True, help="Beta value for the sigmoid filter.")
     parser.add_argument("-p", "--propagation_scaling", type=float, required=True, help="Time threshold for fast marching.")
     parser.add_argument("-d", "--initial_distance", type=float, required=True, help="Stopping value for fast marching.")
+    parser.add_argument("-c", "--curvature_scaling", type=float, default=1.0, help="Curvature scaling for the geodesic active contour filter.")
+    parser.add_argument("-n", "--max_iterations", type=int, default=800, help="Iteration budget for the geodesic active contour filter.")
+    add_monitor_arguments(parser)
+    add_pyramid_arguments(parser)
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Directory for cached smoothing, gradient and sigmoid images.")
+    parser.add_argument("--no_cache", action="store_true", help="Recompute every stage and do not write the on-disk cache.")
+    add_volume_arguments(parser)
+    add_debug_writer_arguments(parser)
+    add_profiler_arguments(parser)
 
     args = parser.parse_args()
+    if args.memory_budget and args.no_cache:
+        parser.error("--memory_budget streams the stages through the disk cache and cannot be combined with --no_cache.")
+    profiler = profiler_from_args(args)
 
     # Input and output paths
-    input_path = './data/BrainProtonDensitySlice.png'
-    smoothing_output_path = './output/GeodesicActiveContour/BrainProtonDensitySliceSmoothing.png'
-    gradient_output_path = './output/GeodesicActiveContour/BrainProtonDensitySliceGradient.png'
-    sigmoid_output_path = './output/GeodesicActiveContour/BrainProtonDensitySliceSigmoid.png'
-    fast_marching_output_path = './output/GeodesicActiveContour/BrainProtonDensitySliceFastMarching.png'
-    thresholded_output_path = './output/GeodesicActiveContour/BrainProtonDensitySliceGeodesicActiveContour.png'
+    input_path = args.input
 
     #define input types
     InternalPixelType = itk.F
-    Dimension = 2
+    Dimension = args.dimension
     InternalImageType = itk.Image[InternalPixelType, Dimension]
     OutputPixelType = itk.UC
     OutputImageType = itk.Image[OutputPixelType, Dimension]
 
-    # Reader
-    reader = itk.ImageFileReader[InternalImageType].New()
-    reader.SetFileName(input_path)
+    smoothing_output_path = volume_output_path('./output/GeodesicActiveContour/BrainProtonDensitySliceSmoothing.png', Dimension)
+    gradient_output_path = volume_output_path('./output/GeodesicActiveContour/BrainProtonDensitySliceGradient.png', Dimension)
+    sigmoid_output_path = volume_output_path('./output/GeodesicActiveContour/BrainProtonDensitySliceSigmoid.png', Dimension)
+    fast_marching_output_path = volume_output_path('./output/GeodesicActiveContour/BrainProtonDensitySliceFastMarching.png', Dimension)
+    thresholded_output_path = volume_output_path('./output/GeodesicActiveContour/BrainProtonDensitySliceGeodesicActiveContour.png', Dimension)
 
     # writer
     writer = itk.ImageFileWriter[OutputImageType].New()
@@ -65,30 +79,16 @@ def main():
     thresholder.SetOutsideValue(0)
     thresholder.SetInsideValue(255)
 
-    # Smoothing filter
-    smoothing = itk.CurvatureAnisotropicDiffusionImageFilter[InternalImageType, InternalImageType].New()
-    smoothing.SetInput(reader.GetOutput())
-    smoothing.SetTimeStep(0.125)
-    smoothing.SetNumberOfIterations(5)
-    smoothing.SetConductanceParameter(9.0)
-
-    # Gradient magnitude filter
-    gradient = itk.GradientMagnitudeRecursiveGaussianImageFilter[InternalImageType, InternalImageType].New()
-    gradient.SetInput(smoothing.GetOutput())
-    gradient.SetSigma(args.sigma)
-
-    # Sigmoid filter
-    sigmoid = itk.SigmoidImageFilter[InternalImageType, InternalImageType].New()
-    sigmoid.SetInput(gradient.GetOutput())
-    sigmoid.SetAlpha(args.alpha)
-    sigmoid.SetBeta(args.beta)
-    sigmoid.SetOutputMinimum(0.0)
-    sigmoid.SetOutputMaximum(1.0)
-
+    # Smoothing, gradient and sigmoid stages, reused from the cache when their inputs are unchanged
+    # With --memory_budget they are streamed to the cache and only the --roi region is loaded.
+    cache = StageCache(args.cache_dir, use_disk=not args.no_cache)
+    smoothing_image, gradient_image, sigmoid_image = speed_image_stages(
+        input_path, InternalImageType, args.sigma, args.alpha, args.beta, cache,
+        args.memory_budget, parse_region(args.roi, Dimension))
 
     NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
     seeds = NodeContainer.New()
-    seedPosition = [args.seedX, args.seedY]
+    seedPosition = seed_index(args, Dimension)
 
     node = itk.LevelSetNode[itk.F, Dimension]()
     node.SetValue(-args.initial_distance)
@@ -98,36 +98,42 @@ def main():
 
     # Fast Marching filter
     fast_marching = itk.FastMarchingImageFilter[InternalImageType, InternalImageType].New()
-    fast_marching.SetInput(sigmoid.GetOutput())
+    fast_marching.SetInput(sigmoid_image)
     fast_marching.SetTrialPoints(seeds)
     fast_marching.SetSpeedConstant(1.0)
-    fast_marching.SetOutputSize(reader.GetOutput().GetBufferedRegion().GetSize())
+    set_fast_marching_geometry(fast_marching, sigmoid_image)
 
     # Geodesic Active Contour filter
-    geodesic_active_contour = itk.GeodesicActiveContourLevelSetImageFilter[InternalImageType, InternalImageType, InternalPixelType].New()
-    geodesic_active_contour.SetInput(fast_marching.GetOutput())
-    geodesic_active_contour.SetFeatureImage(sigmoid.GetOutput())
-    geodesic_active_contour.SetPropagationScaling(args.propagation_scaling)
-    geodesic_active_contour.SetCurvatureScaling(1.0)
-    geodesic_active_contour.SetAdvectionScaling(1.0)
-    geodesic_active_contour.SetMaximumRMSError(0.02)
-    geodesic_active_contour.SetNumberOfIterations(800)
-
-    # Set the output of the thresholding filter to the writer
-    thresholder.SetInput(geodesic_active_contour.GetOutput())
-    writer.SetInput(thresholder.GetOutput())
-
+    def make_geodesic_active_contour(initial, feature, number_of_iterations):
+        return geodesic_active_contour_filter(initial, feature, args.propagation_scaling, args.curvature_scaling,
+                                              number_of_iterations=number_of_iterations)
 
+    # Intermediate images are written in the background while the level set evolves
+    debug_writer = debug_writer_from_args(args)
     try:
-        rescale_and_write(smoothing.GetOutput(), OutputImageType, smoothing_output_path)
-        rescale_and_write(gradient.GetOutput(), OutputImageType, gradient_output_path)
-        rescale_and_write(sigmoid.GetOutput(), OutputImageType, sigmoid_output_path)
-        rescale_and_write(fast_marching.GetOutput(), OutputImageType, fast_marching_output_path)
-
+        debug_writer.write(smoothing_image, smoothing_output_path)
+        debug_writer.write(gradient_image, gradient_output_path)
+        debug_writer.write(sigmoid_image, sigmoid_output_path)
+        debug_writer.write(fast_marching.GetOutput(), fast_marching_output_path)
+
+        if args.pyramid_levels > 1:
+            geodesic_active_contour, monitor = evolve_pyramid(make_geodesic_active_contour, fast_marching.GetOutput(), sigmoid_image,
+                                                              args.pyramid_levels, args.max_iterations, args.refine_iterations,
+                                                              args, "Geodesic active contour")
+        else:
+            geodesic_active_contour = make_geodesic_active_contour(fast_marching.GetOutput(), sigmoid_image, args.max_iterations)
+            monitor = monitor_from_args(geodesic_active_contour, args)
+
+        # Set the output of the thresholding filter to the writer
+        thresholder.SetInput(geodesic_active_contour.GetOutput())
+        writer.SetInput(thresholder.GetOutput())
         writer.Update()
+        report(monitor, args, "Geodesic active contour")
         print(f"Geodesic Active Contour Segmentation Complete. Output {thresholded_output_path} written successfully.")
     except Exception as e:
         print(f"Exception caught while writing {thresholded_output_path}!", str(e))
+    debug_writer.close()
+    profiler.report()
 
 
     
@@ -1,5 +1,39 @@
 import itk
 import argparse
+import os
+import sys
+
+from level_set_monitor import add_monitor_arguments, monitor_from_args, report
+from level_set_pyramid import add_pyramid_arguments, evolve_pyramid, shift_to_zero
+from speed_image_cache import stable_time_step
+from volume_streaming import add_volume_arguments, parse_region, read_region, stream_diffusion, volume_output_path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+def gradient_diffusion(image, number_of_iterations, conductance, average_gradient_magnitude=None):
+    InternalImageType = type(image)
+    diffusion = itk.GradientAnisotropicDiffusionImageFilter[InternalImageType, InternalImageType].New()
+    diffusion.SetNumberOfIterations(number_of_iterations)
+    diffusion.SetTimeStep(stable_time_step(image))
+    diffusion.SetConductanceParameter(conductance)
+    # Streamed slabs share the average gradient magnitude of the whole image
+    if average_gradient_magnitude is not None:
+        diffusion.SetFixedAverageGradientMagnitude(average_gradient_magnitude)
+    diffusion.SetInput(image)
+    diffusion.Update()
+    return diffusion.GetOutput()
+
+def laplacian_filter(initial_model, feature_image, propagation_weight, isovalue, number_of_iterations):
+    InternalImageType = type(feature_image)
+    laplacian = itk.LaplacianSegmentationLevelSetImageFilter[InternalImageType, InternalImageType, itk.F].New()
+    laplacian.SetCurvatureScaling(1.0)
+    laplacian.SetPropagationScaling(propagation_weight)
+    laplacian.SetMaximumRMSError(0.002)
+    laplacian.SetNumberOfIterations(number_of_iterations)
+    laplacian.SetIsoSurfaceValue(isovalue)
+    laplacian.SetInput(initial_model)
+    laplacian.SetFeatureImage(feature_image)
+    return laplacian
 
 # Argument parser setup with flags
 def main():
@@ -9,27 +43,28 @@ def main():
     parser.add_argument("-p", "--propagation_weight", type=float, required=True, help="Propagation weight for the geodesic active contour filter.")
     parser.add_argument("-m", "--initial_model_isovalued", type=float, required=True, help="Isovalue for the initial model.")
     parser.add_argument("-t", "--iterations", type=int, required=True, help="Number of iterations for the geodesic active contour filter.")
+    parser.add_argument("--model", default='./data/VentricleModel.png', help="Initial model image for the level set.")
+    add_monitor_arguments(parser)
+    add_pyramid_arguments(parser)
+    add_volume_arguments(parser)
+    add_profiler_arguments(parser)
 
     args = parser.parse_args()
-
-    # Input and output paths
-    input_path = './data/BrainProtonDensitySlice.png'
-    model_path = './data/VentricleModel.png'
-    output_path = './output/Laplacian/BrainProtonDensitySliceLaplacian.png'
+    profiler = profiler_from_args(args)
 
     #define input types
     InternalPixelType = itk.F
-    Dimension = 2
+    Dimension = args.dimension
     InternalImageType = itk.Image[InternalPixelType, Dimension]
     OutputPixelType = itk.UC
     OutputImageType = itk.Image[OutputPixelType, Dimension]
 
-    # Reader
-    reader1 = itk.ImageFileReader[InternalImageType].New()
-    reader1.SetFileName(input_path)
-
-    reader2 = itk.ImageFileReader[InternalImageType].New()
-    reader2.SetFileName(model_path)
+    # Input and output paths
+    input_path = args.input
+    model_path = args.model
+    output_path = volume_output_path('./output/Laplacian/BrainProtonDensitySliceLaplacian.png', Dimension)
+    diffusion_output_path = './output/Laplacian/BrainProtonDensitySliceDiffusion.mha'
+    region = parse_region(args.roi, Dimension)
 
     # writer
     writer = itk.ImageFileWriter[OutputImageType].New()
@@ -43,30 +78,42 @@ def main():
     threshold.SetInsideValue(255)
 
     # Diffusion filter
-    diffusion = itk.GradientAnisotropicDiffusionImageFilter[InternalImageType, InternalImageType].New()
-    diffusion.SetNumberOfIterations(args.diffusion_iterations)
-    diffusion.SetTimeStep(0.125)
-    diffusion.SetConductanceParameter(args.conductance)
-    diffusion.SetInput(reader1.GetOutput())
+    def diffuse(image, number_of_iterations=args.diffusion_iterations, average_gradient_magnitude=None):
+        return gradient_diffusion(image, number_of_iterations, args.conductance, average_gradient_magnitude)
 
-    # LaplacianSegmentationLevelSetImageFilterType filter
-    laplacian = itk.LaplacianSegmentationLevelSetImageFilter[InternalImageType, InternalImageType,InternalPixelType].New()
-    laplacian.SetCurvatureScaling(1.0)
-    laplacian.SetPropagationScaling(args.propagation_weight)
-    laplacian.SetMaximumRMSError(0.002)
-    laplacian.SetNumberOfIterations(args.iterations)
-    laplacian.SetIsoSurfaceValue(args.initial_model_isovalued)
-    laplacian.SetInput(reader2.GetOutput())
-    laplacian.SetFeatureImage(diffusion.GetOutput())
+    # With --memory_budget the diffusion is streamed to disk in slabs, one iteration per pass, and only the --roi region is read back
+    if args.memory_budget:
+        os.makedirs(os.path.dirname(diffusion_output_path), exist_ok=True)
+        stream_diffusion(input_path, diffusion_output_path, InternalImageType, diffuse,
+                         args.diffusion_iterations, args.memory_budget)
+        feature_image = read_region(diffusion_output_path, InternalImageType, region)
+    else:
+        feature_image = diffuse(read_region(input_path, InternalImageType, region))
 
-    threshold.SetInput(laplacian.GetOutput())
-    writer.SetInput(threshold.GetOutput())
+    initial_model = read_region(model_path, InternalImageType, region)
 
     try:
+        # LaplacianSegmentationLevelSetImageFilterType filter
+        if args.pyramid_levels > 1:
+            # The levels hand their zero-isovalued outputs on, so the model is shifted to isovalue 0 as well
+            def make_laplacian(initial, feature, number_of_iterations):
+                return laplacian_filter(initial, feature, args.propagation_weight, 0.0, number_of_iterations)
+            laplacian, monitor = evolve_pyramid(make_laplacian, shift_to_zero(initial_model, args.initial_model_isovalued),
+                                                feature_image, args.pyramid_levels, args.iterations,
+                                                args.refine_iterations, args, "Laplacian segmentation")
+        else:
+            laplacian = laplacian_filter(initial_model, feature_image,
+                                         args.propagation_weight, args.initial_model_isovalued, args.iterations)
+            monitor = monitor_from_args(laplacian, args)
+
+        threshold.SetInput(laplacian.GetOutput())
+        writer.SetInput(threshold.GetOutput())
         writer.Update()
+        report(monitor, args, "Laplacian segmentation")
         print(f"{output_path} written successfully.")
     except Exception as e:
         print(f"Exception caught while writing {output_path}!", str(e))
+    profiler.report()
 
 
     
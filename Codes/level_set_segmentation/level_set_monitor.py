@@ -0,0 +1,120 @@
+# Progress observer shared by the *LevelSetImageFilter scripts.
+#
+# LevelSetMonitor hooks the filter's IterationEvent and records the elapsed
+# iteration count, RMS change and per-iteration wall time into compact
+# typed arrays. With a stall window it also stops the evolution once the RMS
+# change has stayed below a fraction (the tolerance) of the first
+# iteration's RMS change for that many iterations, instead of running out the
+# full iteration budget. A front still moving at a steady speed keeps a
+# steady RMS change and is not stopped.
+
+import csv
+import json
+import time
+from array import array
+
+import itk
+
+
+class LevelSetMonitor:
+    def __init__(self, stall_window=0, stall_tolerance=0.1, verbose=False):
+        self.stall_window = stall_window
+        self.stall_tolerance = stall_tolerance
+        self.verbose = verbose
+        self.iterations = array('I')
+        self.rms_changes = array('f')
+        self.seconds = array('f')
+        self.stopped_early = False
+        self._filter = None
+        self._last_time = None
+        self._iteration_budget = None
+
+    def attach(self, level_set_filter):
+        self._filter = level_set_filter
+        level_set_filter.AddObserver(itk.StartEvent(), self._on_start)
+        level_set_filter.AddObserver(itk.IterationEvent(), self._on_iteration)
+        level_set_filter.AddObserver(itk.EndEvent(), self._on_end)
+        return self
+
+    def _on_start(self):
+        del self.iterations[:], self.rms_changes[:], self.seconds[:]
+        self.stopped_early = False
+        self._iteration_budget = self._filter.GetNumberOfIterations()
+        self._last_time = time.perf_counter()
+
+    def _on_iteration(self):
+        now = time.perf_counter()
+        self.iterations.append(self._filter.GetElapsedIterations())
+        self.rms_changes.append(self._filter.GetRMSChange())
+        self.seconds.append(now - self._last_time)
+        self._last_time = now
+        if self.verbose:
+            print(f"iteration {self.iterations[-1]}: RMS change {self.rms_changes[-1]:.6f}")
+
+        if self.stall_window and self._stalled():
+            # Halt() stops the evolution once the elapsed iterations reach the budget
+            self.stopped_early = True
+            self._filter.SetNumberOfIterations(self.iterations[-1])
+
+    def _on_end(self):
+        # The budget is restored before the output is marked up to date, so
+        # it does not trigger a new run, and later runs get the full budget
+        if self.stopped_early:
+            self._filter.SetNumberOfIterations(self._iteration_budget)
+
+    def _stalled(self):
+        if len(self.rms_changes) < self.stall_window:
+            return False
+        window = self.rms_changes[-self.stall_window:]
+        return max(window) < self.stall_tolerance * self.rms_changes[0]
+
+    def summary(self):
+        total = sum(self.seconds)
+        return {
+            'iterations': self.iterations[-1] if self.iterations else 0,
+            'rms_change': self.rms_changes[-1] if self.rms_changes else None,
+            'seconds': total,
+            'seconds_per_iteration': total / len(self.seconds) if self.seconds else None,
+            'stopped_early': self.stopped_early,
+        }
+
+    def print_summary(self, name='Level set'):
+        summary = self.summary()
+        reason = "stalled" if summary['stopped_early'] else "finished"
+        rms = f"{summary['rms_change']:.6f}" if summary['rms_change'] is not None else "n/a"
+        print(f"{name} {reason} after {summary['iterations']} iterations "
+              f"(RMS change {rms}, {summary['seconds']:.3f} s).")
+
+    def write_trace(self, path):
+        # The file extension selects the format: .json, anything else is CSV
+        rows = zip(self.iterations, self.rms_changes, self.seconds)
+        if path.endswith('.json'):
+            with open(path, 'w') as f:
+                json.dump({
+                    'summary': self.summary(),
+                    'trace': [{'iteration': i, 'rms_change': r, 'seconds': s} for i, r, s in rows],
+                }, f, indent=2)
+        else:
+            with open(path, 'w', newline='') as f:
+                trace = csv.writer(f)
+                trace.writerow(['iteration', 'rms_change', 'seconds'])
+                trace.writerows(rows)
+        print(f"{path} written successfully.")
+
+
+def add_monitor_arguments(parser):
+    parser.add_argument("--stall_window", type=int, default=0, help="Stop once the RMS change has stayed below --stall_tolerance for this many iterations (0 disables).")
+    parser.add_argument("--stall_tolerance", type=float, default=0.1, help="Fraction of the first iteration's RMS change below which the evolution counts as stalled.")
+    parser.add_argument("--trace", help="Write the per-iteration trace to this .json or .csv file.")
+    parser.add_argument("--verbose", action="store_true", help="Print the RMS change of every iteration.")
+
+
+def monitor_from_args(level_set_filter, args):
+    monitor = LevelSetMonitor(args.stall_window, args.stall_tolerance, args.verbose)
+    return monitor.attach(level_set_filter)
+
+
+def report(monitor, args, name='Level set'):
+    monitor.print_summary(name)
+    if args.trace:
+        monitor.write_trace(args.trace)
@@ -0,0 +1,100 @@
+# Coarse-to-fine evolution for the segmentation level-set filters.
+#
+# The feature and initial level-set images are bin-shrunk by 2^(levels-1),
+# ..., 2, 1. On a grid shrunk by f every iteration moves the front about f
+# full-size pixels, so a coarse level gets 1/f of the iteration budget to
+# cover the same distance, at 1/f^dimension of the cost per iteration. Each
+# level's output is resampled onto the next finer grid and used as the
+# initial level set there, and the finest level only runs --refine_iterations
+# iterations to settle the contour on the full-resolution features.
+#
+# Levels on which the initial contour would enclose fewer than 3^dimension
+# pixels are skipped: the curvature term collapses such small fronts before
+# they can grow. Features thinner than the shrink factor are blurred away on
+# the coarse levels, so fronts may leak through them there.
+
+import math
+import time
+
+import itk
+
+from level_set_monitor import monitor_from_args
+
+
+def add_pyramid_arguments(parser):
+    parser.add_argument("--pyramid_levels", type=int, default=1, help="Resolution levels of the coarse-to-fine evolution (1 runs at full resolution only).")
+    parser.add_argument("--refine_iterations", type=int, default=20, help="Iterations at full resolution after the coarser levels, with --pyramid_levels > 1.")
+
+
+def shrink(image, factor):
+    if factor == 1:
+        return image
+    # Averaging the bins also low-passes the image before it is subsampled
+    ImageType = type(image)
+    shrinker = itk.BinShrinkImageFilter[ImageType, ImageType].New()
+    shrinker.SetInput(image)
+    shrinker.SetShrinkFactors(factor)
+    shrinker.Update()
+    output = shrinker.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def resample_like(level_set, reference_image):
+    # Pixels outside the coarse grid are set to the largest level-set value, i.e. outside the contour
+    ImageType = type(level_set)
+    resampler = itk.ResampleImageFilter[ImageType, ImageType].New()
+    resampler.SetInput(level_set)
+    resampler.SetReferenceImage(reference_image)
+    resampler.UseReferenceImageOn()
+    resampler.SetDefaultPixelValue(float(itk.array_view_from_image(level_set).max()))
+    resampler.Update()
+    output = resampler.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def shift_to_zero(image, isovalue):
+    # Moves the isovalue of an initial model to zero, the isovalue used on the finer levels
+    ImageType = type(image)
+    shift = itk.ShiftScaleImageFilter[ImageType, ImageType].New()
+    shift.SetInput(image)
+    shift.SetShift(-isovalue)
+    shift.Update()
+    output = shift.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def evolve_pyramid(make_filter, initial_level_set, feature_image, levels, iterations, refine_iterations, args, name='Level set'):
+    """Run make_filter(initial, feature, number_of_iterations) from the coarsest level to full resolution.
+
+    The initial level set must have its contour at zero. Returns the filter of
+    the finest level and its monitor.
+    """
+    min_inside = 3 ** initial_level_set.GetImageDimension()
+    level_set = None
+    for level in range(levels):
+        factor = 2 ** (levels - 1 - level)
+        if level_set is None:
+            initial = shrink(initial_level_set, factor)
+            if factor > 1 and (itk.array_view_from_image(initial) <= 0).sum() < min_inside:
+                print(f"{name} level {level + 1}/{levels} (shrink {factor}) skipped, the initial contour is too small.")
+                continue
+            feature = shrink(feature_image, factor)
+        else:
+            feature = shrink(feature_image, factor)
+            initial = resample_like(level_set, feature)
+
+        number_of_iterations = refine_iterations if factor == 1 else math.ceil(iterations / factor)
+        level_set_filter = make_filter(initial, feature, number_of_iterations)
+        monitor = monitor_from_args(level_set_filter, args)
+        start = time.perf_counter()
+        level_set_filter.Update()
+        seconds = time.perf_counter() - start
+
+        # The monitor only times the iterations, the wall time also covers the filter's initialization
+        size = list(feature.GetLargestPossibleRegion().GetSize())
+        monitor.print_summary(f"{name} level {level + 1}/{levels} (shrink {factor}, size {size}, {seconds:.3f} s wall)")
+        level_set = level_set_filter.GetOutput()
+    return level_set_filter, monitor
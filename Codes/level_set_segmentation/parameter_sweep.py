@@ -0,0 +1,194 @@
+# Parameter sweep driver for shape_detection_segmentation.py and
+# geodesic_active_contours.py.
+#
+# The sweep spec is a JSON file holding either a "grid" of values per
+# parameter or a "random" search over ranges (see sweep_example.json).
+# Upstream stages are computed once per distinct parameter set in this
+# process: the smoothing image once, the gradient once per sigma and the
+# sigmoid once per (sigma, alpha, beta). Like the scripts, every speed image
+# gets its own initial level set, fast marched from the seed over that speed
+# image. Only the level-set evolution runs in the worker pool.
+
+import argparse
+import csv
+import itertools
+import json
+import os
+import random
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import itk
+
+from geodesic_active_contours import geodesic_active_contour_filter
+from shape_detection_segmentation import shape_detection_filter
+from speed_image_cache import DEFAULT_CACHE_DIR, StageCache, compute_speed_image
+from volume_streaming import set_fast_marching_geometry
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+SWEPT_PARAMETERS = ['sigma', 'alpha', 'beta', 'propagation_scaling', 'curvature_scaling']
+
+METHODS = {
+    'shape_detection': shape_detection_filter,
+    'geodesic_active_contours': geodesic_active_contour_filter,
+}
+
+RESULT_FIELDS = ['run'] + SWEPT_PARAMETERS + ['seconds', 'iterations', 'rms_change', 'dice']
+
+
+def expand_spec(spec):
+    # Returns one dict of swept parameters per run
+    if 'grid' in spec:
+        grid = spec['grid']
+        names = [name for name in SWEPT_PARAMETERS if name in grid]
+        return [dict(zip(names, values)) for values in itertools.product(*(grid[name] for name in names))]
+
+    if 'random' in spec:
+        search = spec['random']
+        rng = random.Random(search.get('seed', 0))
+        ranges = search['ranges']
+        return [{name: rng.uniform(*ranges[name]) for name in SWEPT_PARAMETERS if name in ranges}
+                for _ in range(search['samples'])]
+
+    raise ValueError("Sweep spec needs either a 'grid' or a 'random' section.")
+
+
+def initial_level_set(reference_image, seed_position, initial_distance, use_speed=True):
+    # Fast marching from the seed with reference_image as the speed image, as
+    # shape_detection_segmentation.py and geodesic_active_contours.py do, or
+    # with use_speed=False at a constant speed over its grid, as threshold.py does
+    ImageType = type(reference_image)
+    Dimension = reference_image.GetImageDimension()
+
+    NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
+    seeds = NodeContainer.New()
+    node = itk.LevelSetNode[itk.F, Dimension]()
+    node.SetValue(-initial_distance)
+    node.SetIndex(seed_position)
+    seeds.Initialize()
+    seeds.InsertElement(0, node)
+
+    fast_marching = itk.FastMarchingImageFilter[ImageType, ImageType].New()
+    if use_speed:
+        fast_marching.SetInput(reference_image)
+    fast_marching.SetTrialPoints(seeds)
+    fast_marching.SetSpeedConstant(1.0)
+    set_fast_marching_geometry(fast_marching, reference_image)
+    fast_marching.Update()
+    return fast_marching.GetOutput()
+
+
+def dice_score(segmentation, reference_mask):
+    segmented = itk.array_view_from_image(segmentation) <= 0
+    reference = itk.array_view_from_image(reference_mask) > 0
+    total = segmented.sum() + reference.sum()
+    if total == 0:
+        return 1.0
+    return float(2.0 * (segmented & reference).sum() / total)
+
+
+_worker_state = {}
+
+
+def _init_worker(method, initial_level_sets, speed_images, reference_mask, threads):
+    # Runs are already spread across processes, so each filter stays single-threaded unless --threads says otherwise
+    itk.MultiThreaderBase.SetGlobalDefaultNumberOfThreads(threads)
+    _worker_state.update(method=method, initial_level_sets=initial_level_sets,
+                         speed_images=speed_images, reference_mask=reference_mask)
+
+
+def _run_combination(run, params):
+    key = (params['sigma'], params['alpha'], params['beta'])
+    level_set_filter = METHODS[_worker_state['method']](
+        _worker_state['initial_level_sets'][key], _worker_state['speed_images'][key],
+        params['propagation_scaling'], params['curvature_scaling'])
+
+    start = time.perf_counter()
+    level_set_filter.Update()
+    seconds = time.perf_counter() - start
+
+    reference_mask = _worker_state['reference_mask']
+    row = dict(params, run=run, seconds=round(seconds, 4),
+               iterations=level_set_filter.GetElapsedIterations(),
+               rms_change=level_set_filter.GetRMSChange())
+    row['dice'] = dice_score(level_set_filter.GetOutput(), reference_mask) if reference_mask is not None else ''
+    return row
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Parallel parameter sweep for the shape detection and geodesic active contour segmentations.")
+    parser.add_argument("spec", help="JSON sweep spec with a 'grid' or 'random' section.")
+    parser.add_argument("-m", "--method", choices=sorted(METHODS), help="Level-set method; overrides the spec.")
+    parser.add_argument("-r", "--reference", help="Reference mask (non-zero inside) used for the Dice overlap score.")
+    parser.add_argument("-o", "--output", default='./output/Sweep/sweep_results.csv', help="Results table to write.")
+    parser.add_argument("-w", "--workers", type=int, default=os.cpu_count(), help="Number of worker processes.")
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Directory for cached smoothing, gradient and sigmoid images.")
+    parser.add_argument("--no_cache", action="store_true", help="Recompute every stage and do not write the on-disk cache.")
+    add_profiler_arguments(parser)
+
+    args = parser.parse_args()
+    # The profile covers the shared stages computed here, not the runs in the worker processes
+    profiler = profiler_from_args(args)
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+
+    input_path = spec.get('input', './data/BrainProtonDensitySlice.png')
+    method = args.method or spec.get('method', 'shape_detection')
+    fixed = spec.get('fixed', {})
+    runs = [dict(fixed, **params) for params in expand_spec(spec)]
+    if not runs:
+        parser.error("Sweep spec expands to no runs: a grid list is empty or the random search has no samples.")
+    missing = [name for name in SWEPT_PARAMETERS if name not in runs[0]]
+    if missing:
+        parser.error("Sweep spec does not set: " + ", ".join(missing))
+
+    InternalImageType = itk.Image[itk.F, spec.get('dimension', 2)]
+
+    # Shared upstream stages, computed once per distinct (sigma, alpha, beta)
+    cache = StageCache(args.cache_dir, use_disk=not args.no_cache)
+    speed_images = {}
+    for params in runs:
+        key = (params['sigma'], params['alpha'], params['beta'])
+        if key not in speed_images:
+            speed_images[key] = compute_speed_image(input_path, InternalImageType, *key, cache)[2]
+    print(f"{len(runs)} runs share {len(speed_images)} speed images "
+          f"({cache.misses} stages computed, {cache.hits} reused).")
+
+    # One initial level set per speed image, marched over it as the scripts do
+    initial_level_sets = {key: initial_level_set(speed_image, spec['seed'], spec.get('initial_distance', 5.0))
+                          for key, speed_image in speed_images.items()}
+    reference_mask = itk.imread(args.reference, itk.UC) if args.reference else None
+
+    # Load the level-set modules once here so forked workers do not each pay the lazy import
+    key = next(iter(speed_images))
+    METHODS[method](initial_level_sets[key], speed_images[key], 1.0, 1.0)
+
+    rows = []
+    start = time.perf_counter()
+    with ProcessPoolExecutor(max_workers=args.workers, initializer=_init_worker,
+                             initargs=(method, initial_level_sets, speed_images, reference_mask, args.threads or 1)) as pool:
+        futures = [pool.submit(_run_combination, run, params) for run, params in enumerate(runs)]
+        for future in as_completed(futures):
+            try:
+                rows.append(future.result())
+            except Exception as e:
+                print("Exception caught during a sweep run!", str(e))
+
+    rows.sort(key=lambda row: row['run'])
+    os.makedirs(os.path.dirname(args.output) or '.', exist_ok=True)
+    with open(args.output, 'w', newline='') as f:
+        results = csv.DictWriter(f, fieldnames=RESULT_FIELDS, extrasaction='ignore')
+        results.writeheader()
+        results.writerows(rows)
+    print(f"{len(rows)} runs finished in {time.perf_counter() - start:.1f} s. Results written to {args.output}.")
+    profiler.report()
+
+
+if __name__ == "__main__":
+    main()
+
+# Run the script with the following command:
+# python parameter_sweep.py sweep_example.json --method geodesic_active_contours --workers 8
@@ -1,52 +1,70 @@
 import itk
 import argparse
-
-def rescale_and_write(filter_output, output_image_type, output_path, output_min=0, output_max=255):
-    try:
-        rescaler = itk.RescaleIntensityImageFilter[type(filter_output), output_image_type].New()
-        rescaler.SetInput(filter_output)
-        rescaler.SetOutputMinimum(output_min)
-        rescaler.SetOutputMaximum(output_max)
-
-        rescaler.Update()
-
-        writer = itk.ImageFileWriter[output_image_type].New()
-        writer.SetFileName(output_path)
-        writer.SetInput(rescaler.GetOutput())
-        writer.Update()
-
-        print(f"{output_path} written successfully.")
-    except Exception as e:
-        print(f"Exception caught while writing {output_path}!", str(e))
+import os
+import sys
+
+from debug_writer import add_debug_writer_arguments, debug_writer_from_args
+from level_set_monitor import add_monitor_arguments, monitor_from_args, report
+from speed_image_cache import DEFAULT_CACHE_DIR, StageCache, speed_image_margin, speed_image_stages
+from volume_streaming import (add_auto_roi_arguments, add_volume_arguments, image_geometry, paste_region, parse_region,
+                              read_image_information, seed_index, seed_region, set_fast_marching_geometry, volume_output_path)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+def shape_detection_filter(initial_level_set, feature_image, propagation_scaling, curvature_scaling, number_of_iterations=800):
+    InternalImageType = type(feature_image)
+    shape_detection = itk.ShapeDetectionLevelSetImageFilter[InternalImageType, InternalImageType, itk.F].New()
+    shape_detection.SetInput(initial_level_set)
+    shape_detection.SetFeatureImage(feature_image)  # Ensure FeatureImage is set correctly
+    shape_detection.SetPropagationScaling(propagation_scaling)
+    shape_detection.SetCurvatureScaling(curvature_scaling)
+    shape_detection.SetMaximumRMSError(0.02)
+    shape_detection.SetNumberOfIterations(number_of_iterations)
+    return shape_detection
 
 def main():
     parser = argparse.ArgumentParser(description="ITK Shape Detection Segmentation with Smoothing, Gradient, and Sigmoid Filters.")
     parser.add_argument("-x", "--seedX", type=int, required=True, help="X coordinate of the seed point.")
     parser.add_argument("-y", "--seedY", type=int, required=True, help="Y coordinate of the seed point.")
+    parser.add_argument("-z", "--seedZ", type=int, default=0, help="Z coordinate of the seed point (3D only).")
     parser.add_argument("-d", "--initial_distance", type=float, required=True, help="Initial distance for shape detection segmentation.")
     parser.add_argument("-s", "--sigma", type=float, required=True, help="Sigma value for the gradient magnitude filter.")
     parser.add_argument("-a", "--alpha", type=float, required=True, help="Alpha value for the sigmoid filter.")
     parser.add_argument("-b", "--beta", type=float, required=True, help="Beta value for the sigmoid filter.")
     parser.add_argument("-p", "--propagation_scaling", type=float, required=True, help="Propagation scaling for shape detection segmentation.")
     parser.add_argument("-c", "--curvature_scaling", type=float, required=True, help="Curvature scaling for shape detection segmentation.")
+    parser.add_argument("-n", "--max_iterations", type=int, default=800, help="Iteration budget for shape detection segmentation.")
+    add_monitor_arguments(parser)
+    parser.add_argument("--cache_dir", default=DEFAULT_CACHE_DIR, help="Directory for cached smoothing, gradient and sigmoid images.")
+    parser.add_argument("--no_cache", action="store_true", help="Recompute every stage and do not write the on-disk cache.")
+    add_volume_arguments(parser)
+    add_auto_roi_arguments(parser, "Largest physical distance the contour can reach from the seed; required with --auto_roi.")
+    add_debug_writer_arguments(parser)
+    add_profiler_arguments(parser)
 
     args = parser.parse_args()
+    if args.memory_budget and args.no_cache:
+        parser.error("--memory_budget streams the stages through the disk cache and cannot be combined with --no_cache.")
+    if args.auto_roi and (args.roi or args.memory_budget):
+        parser.error("--auto_roi picks its own region and cannot be combined with --roi or --memory_budget.")
+    if args.auto_roi and args.roi_radius is None:
+        parser.error("--auto_roi needs --roi_radius, the level set has no stopping value to bound it.")
+    profiler = profiler_from_args(args)
 
-    input_path = './data/BrainProtonDensitySlice.png'
-    smoothing_output_path = './output/ShapeDetection/BrainProtonDensitySliceSmoothing.png'
-    gradient_output_path = './output/ShapeDetection/BrainProtonDensitySliceGradient.png'
-    sigmoid_output_path = './output/ShapeDetection/BrainProtonDensitySliceSigmoid.png'
-    fast_marching_output_path = './output/ShapeDetection/BrainProtonDensitySliceFastMarching.png'
-    thresholded_output_path = './output/ShapeDetection/Thresholded_BrainProtonDensitySliceShapeDetection.png'
+    input_path = args.input
 
     InternalPixelType = itk.F
-    Dimension = 2
+    Dimension = args.dimension
     InternalImageType = itk.Image[InternalPixelType, Dimension]
     OutputPixelType = itk.UC
     OutputImageType = itk.Image[OutputPixelType, Dimension]
 
-    reader = itk.ImageFileReader[InternalImageType].New()
-    reader.SetFileName(input_path)
+    smoothing_output_path = volume_output_path('./output/ShapeDetection/BrainProtonDensitySliceSmoothing.png', Dimension)
+    gradient_output_path = volume_output_path('./output/ShapeDetection/BrainProtonDensitySliceGradient.png', Dimension)
+    sigmoid_output_path = volume_output_path('./output/ShapeDetection/BrainProtonDensitySliceSigmoid.png', Dimension)
+    fast_marching_output_path = volume_output_path('./output/ShapeDetection/BrainProtonDensitySliceFastMarching.png', Dimension)
+    thresholded_output_path = volume_output_path('./output/ShapeDetection/Thresholded_BrainProtonDensitySliceShapeDetection.png', Dimension)
+
     writer = itk.ImageFileWriter[OutputImageType].New()
     writer.SetFileName(thresholded_output_path)
 
@@ -56,26 +74,26 @@ def main():
     thresholder.SetOutsideValue(0)
     thresholder.SetInsideValue(255)
 
-    smoothing = itk.CurvatureAnisotropicDiffusionImageFilter[InternalImageType, InternalImageType].New()
-    smoothing.SetInput(reader.GetOutput())
-    smoothing.SetTimeStep(0.125)
-    smoothing.SetNumberOfIterations(5)
-    smoothing.SetConductanceParameter(9.0)
+    seedPosition = seed_index(args, Dimension)
 
-    gradient = itk.GradientMagnitudeRecursiveGaussianImageFilter[InternalImageType, InternalImageType].New()
-    gradient.SetInput(smoothing.GetOutput())
-    gradient.SetSigma(args.sigma)
+    # With --auto_roi the chain only runs on a box of --roi_radius around the seed
+    input_region = None
+    geometry = None
+    if args.auto_roi:
+        info = read_image_information(input_path, InternalImageType)
+        input_region = seed_region(info, [seedPosition], args.roi_radius, speed_image_margin(args.sigma, info))
+        geometry = image_geometry(info)
+        print(f"Auto ROI: {list(input_region.GetSize())} of {geometry['size']} pixels from index {list(input_region.GetIndex())}.")
 
-    sigmoid = itk.SigmoidImageFilter[InternalImageType, InternalImageType].New()
-    sigmoid.SetInput(gradient.GetOutput())
-    sigmoid.SetAlpha(args.alpha)
-    sigmoid.SetBeta(args.beta)
-    sigmoid.SetOutputMinimum(0.0)
-    sigmoid.SetOutputMaximum(1.0)
+    # Smoothing, gradient and sigmoid stages, reused from the cache when their inputs are unchanged
+    # With --memory_budget they are streamed to the cache and only the --roi region is loaded.
+    cache = StageCache(args.cache_dir, use_disk=not args.no_cache)
+    smoothing_image, gradient_image, sigmoid_image = speed_image_stages(
+        input_path, InternalImageType, args.sigma, args.alpha, args.beta, cache,
+        args.memory_budget, parse_region(args.roi, Dimension), input_region)
 
     NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
     seeds = NodeContainer.New()
-    seedPosition = [args.seedX, args.seedY]
 
     node = itk.LevelSetNode[itk.F, Dimension]()
     node.SetValue(-args.initial_distance)  # Make this positive
@@ -84,33 +102,37 @@ def main():
     seeds.InsertElement(0, node)
 
     fast_marching = itk.FastMarchingImageFilter[InternalImageType, InternalImageType].New()
-    fast_marching.SetInput(sigmoid.GetOutput())
+    fast_marching.SetInput(sigmoid_image)
     fast_marching.SetTrialPoints(seeds)
     fast_marching.SetSpeedConstant(1.0)
-    fast_marching.SetOutputSize(reader.GetOutput().GetBufferedRegion().GetSize())
+    set_fast_marching_geometry(fast_marching, sigmoid_image)
 
-    shape_detection = itk.ShapeDetectionLevelSetImageFilter[InternalImageType, InternalImageType, InternalPixelType].New()
-    shape_detection.SetInput(fast_marching.GetOutput())
-    shape_detection.SetFeatureImage(sigmoid.GetOutput())  # Ensure FeatureImage is set correctly
-    shape_detection.SetPropagationScaling(args.propagation_scaling)
-    shape_detection.SetCurvatureScaling(args.curvature_scaling)
-    shape_detection.SetMaximumRMSError(0.02)
-    shape_detection.SetNumberOfIterations(800)
+    shape_detection = shape_detection_filter(fast_marching.GetOutput(), sigmoid_image,
+                                             args.propagation_scaling, args.curvature_scaling, args.max_iterations)
+    monitor = monitor_from_args(shape_detection, args)
 
     thresholder.SetInput(shape_detection.GetOutput())
     writer.SetInput(thresholder.GetOutput())
 
+    # Intermediate images are written in the background while the level set evolves
+    debug_writer = debug_writer_from_args(args)
     try:
-        rescale_and_write(smoothing.GetOutput(), OutputImageType, smoothing_output_path)
-        rescale_and_write(gradient.GetOutput(), OutputImageType, gradient_output_path)
-        rescale_and_write(sigmoid.GetOutput(), OutputImageType, sigmoid_output_path)
-        rescale_and_write(fast_marching.GetOutput(), OutputImageType, fast_marching_output_path)
-
-
+        debug_writer.write(smoothing_image, smoothing_output_path)
+        debug_writer.write(gradient_image, gradient_output_path)
+        debug_writer.write(sigmoid_image, sigmoid_output_path)
+        debug_writer.write(fast_marching.GetOutput(), fast_marching_output_path)
+
+        if geometry is not None:
+            # The crop goes back into a full-size image with the input's grid
+            thresholder.Update()
+            writer.SetInput(paste_region(thresholder.GetOutput(), geometry, 0))
         writer.Update()
+        report(monitor, args, "Shape detection")
         print(f"Shape detection segmentation complete. Output written to {thresholded_output_path}.")
     except Exception as e:
         print(f"Exception caught while writing {thresholded_output_path}!", str(e))
+    debug_writer.close()
+    profiler.report()
 
 if __name__ == "__main__":
     main()
@@ -125,3 +147,5 @@ if __name__ == "__main__":
 
 
     
+# Only filter a box of 40 mm around the seed:
+# python shape_detection_segmentation.py --seedX 81 --seedY 114 --initial_distance 5 --sigma 1.0 --alpha -0.5 --beta 3.0 --propagation_scaling 1.0 --curvature_scaling 0.05 --auto_roi --roi_radius 40
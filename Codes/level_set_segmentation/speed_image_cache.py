@@ -0,0 +1,250 @@
+# Content-addressed cache for the smoothing -> gradient -> sigmoid front end
+# shared by fast_marching_filter.py, shape_detection_segmentation.py and
+# geodesic_active_contours.py.
+#
+# Every stage output is keyed by the SHA-256 of the input file contents plus
+# the parameters of that stage and of every stage upstream of it. Changing
+# only --alpha/--beta therefore reuses the cached smoothing and gradient
+# images, and changing only the seed reuses the whole speed image.
+
+import hashlib
+import json
+import math
+import os
+
+import itk
+
+from volume_streaming import (average_gradient_magnitude, extract_region, gaussian_halo, read_image_information,
+                              read_region, stream_diffusion, stream_filter)
+
+DEFAULT_CACHE_DIR = './cache'
+
+# Parameters of the CurvatureAnisotropicDiffusionImageFilter used by the scripts.
+# The time step is the largest stable one for the image, 0.125 for 2D slices.
+SMOOTHING_ITERATIONS = 5
+SMOOTHING_CONDUCTANCE = 9.0
+# Slab size for measuring the whole input's gradient magnitude when no --memory_budget is given
+MAGNITUDE_BUDGET_MB = 256
+
+
+def stable_time_step(image):
+    # Anisotropic diffusion is stable for time steps up to min(spacing) / 2^(N+1)
+    return min(image.GetSpacing()) / 2.0 ** (image.GetImageDimension() + 1)
+
+
+def speed_image_margin(sigma, image):
+    # Pixels on each side of a crop needed by the smoothing and gradient
+    # footprints (the Gaussian's as in gaussian_halo). The crop's diffusion
+    # holds the whole input's average gradient magnitude fixed, while the
+    # full-image filter re-estimates it every iteration, so the speed image
+    # inside the crop is close to, not equal to, the full-image one
+    return [SMOOTHING_ITERATIONS + 1 + int(math.ceil(6.0 * sigma / spacing)) + 1 for spacing in image.GetSpacing()]
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def stage_key(parent_key, stage_name, **params):
+    # The parent key chains every upstream parameter into this stage's key
+    payload = json.dumps([parent_key, stage_name, sorted(params.items())])
+    return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+
+class StageCache:
+    """In-process and on-disk store of intermediate images keyed by stage_key()."""
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, use_disk=True):
+        self.cache_dir = cache_dir
+        self.use_disk = use_disk and cache_dir is not None
+        self._memory = {}
+        self.hits = 0
+        self.misses = 0
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + '.mha')
+
+    def get(self, key, image_type):
+        image = self._memory.get(key)
+        if image is not None:
+            self.hits += 1
+            return image
+
+        path = self.path(key) if self.use_disk else None
+        if path is not None and os.path.exists(path):
+            reader = itk.ImageFileReader[image_type].New()
+            reader.SetFileName(path)
+            try:
+                reader.Update()
+            except Exception as e:
+                print(f"Ignoring unreadable cache entry {path}!", str(e))
+                return None
+            image = reader.GetOutput()
+            image.DisconnectPipeline()
+            self._memory[key] = image
+            self.hits += 1
+            return image
+        return None
+
+    def put(self, key, image):
+        self._memory[key] = image
+        if not self.use_disk:
+            return
+
+        path = self.path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary name first so a concurrent reader never sees a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp.mha"
+        writer = itk.ImageFileWriter[type(image)].New()
+        writer.SetFileName(tmp_path)
+        writer.SetInput(image)
+        try:
+            writer.Update()
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"Exception caught while caching {path}!", str(e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def get_or_compute(self, key, image_type, compute):
+        image = self.get(key, image_type)
+        if image is None:
+            self.misses += 1
+            image = compute()
+            image.DisconnectPipeline()
+            self.put(key, image)
+        return image
+
+
+def _run_filter(filter_type, input_image, **setters):
+    image_filter = filter_type.New()
+    image_filter.SetInput(input_image)
+    for name, value in setters.items():
+        getattr(image_filter, 'Set' + name)(value)
+    image_filter.Update()
+    return image_filter.GetOutput()
+
+
+def speed_image_keys(input_path, image_type, sigma, alpha, beta, input_region=None):
+    input_key = stage_key(file_digest(input_path), 'input', image_type=str(image_type))
+    # The conductance is scaled by the whole image's average gradient magnitude at every
+    # iteration, also when streamed; a crop uses the whole input's, fixed for all iterations
+    conductance_scaling = 'whole_image'
+    if input_region is not None:
+        input_key = stage_key(input_key, 'crop', index=list(input_region.GetIndex()), size=list(input_region.GetSize()))
+        conductance_scaling = 'whole_input_fixed'
+    smoothing_key = stage_key(input_key, 'smoothing',
+                              time_step='stable',
+                              iterations=SMOOTHING_ITERATIONS,
+                              conductance=SMOOTHING_CONDUCTANCE,
+                              conductance_scaling=conductance_scaling)
+    gradient_key = stage_key(smoothing_key, 'gradient', sigma=float(sigma))
+    sigmoid_key = stage_key(gradient_key, 'sigmoid', alpha=float(alpha), beta=float(beta),
+                            output_minimum=0.0, output_maximum=1.0)
+    return smoothing_key, gradient_key, sigmoid_key
+
+
+def smoothing_stage(image, number_of_iterations=SMOOTHING_ITERATIONS, average_gradient_magnitude=None):
+    # A fixed average gradient magnitude replaces the filter's own estimate, for streamed slabs
+    image_type = type(image)
+    fixed = {} if average_gradient_magnitude is None else {'FixedAverageGradientMagnitude': average_gradient_magnitude}
+    return _run_filter(itk.CurvatureAnisotropicDiffusionImageFilter[image_type, image_type], image,
+                       TimeStep=stable_time_step(image),
+                       NumberOfIterations=number_of_iterations,
+                       ConductanceParameter=SMOOTHING_CONDUCTANCE,
+                       **fixed)
+
+
+def gradient_stage(image, sigma):
+    image_type = type(image)
+    return _run_filter(itk.GradientMagnitudeRecursiveGaussianImageFilter[image_type, image_type], image,
+                       Sigma=sigma)
+
+
+def sigmoid_stage(image, alpha, beta):
+    image_type = type(image)
+    return _run_filter(itk.SigmoidImageFilter[image_type, image_type], image,
+                       Alpha=alpha, Beta=beta, OutputMinimum=0.0, OutputMaximum=1.0)
+
+
+def compute_speed_image(input_path, image_type, sigma, alpha, beta, cache=None, input_region=None,
+                        memory_budget_mb=None):
+    """Return (smoothing, gradient, sigmoid) images, reusing cached stages where possible.
+
+    With an input region only that crop of the input is filtered; the whole
+    input is only read, in slabs, for the average gradient magnitude that
+    scales the crop's conductance.
+    """
+    if cache is None:
+        cache = StageCache(use_disk=False)
+
+    smoothing_key, gradient_key, sigmoid_key = speed_image_keys(input_path, image_type, sigma, alpha, beta, input_region)
+
+    def read_input():
+        return read_region(input_path, image_type, input_region)
+
+    def smooth():
+        if input_region is None:
+            return smoothing_stage(read_input())
+        magnitude = average_gradient_magnitude(input_path, image_type, memory_budget_mb or MAGNITUDE_BUDGET_MB)
+        return smoothing_stage(read_input(), average_gradient_magnitude=magnitude)
+
+    smoothing = cache.get_or_compute(smoothing_key, image_type, smooth)
+    gradient = cache.get_or_compute(gradient_key, image_type, lambda: gradient_stage(smoothing, sigma))
+    sigmoid = cache.get_or_compute(sigmoid_key, image_type, lambda: sigmoid_stage(gradient, alpha, beta))
+    return smoothing, gradient, sigmoid
+
+
+def compute_speed_image_streamed(input_path, image_type, sigma, alpha, beta, cache, memory_budget_mb):
+    """Stream each missing stage slab by slab into the disk cache and return the three stage paths."""
+    if not cache.use_disk:
+        raise ValueError("Streamed execution writes its stages to the disk cache; it cannot run with the cache disabled.")
+
+    keys = speed_image_keys(input_path, image_type, sigma, alpha, beta)
+    halo = gaussian_halo(sigma, read_image_information(input_path, image_type))
+    stages = [
+        lambda source, path: stream_diffusion(source, path, image_type, smoothing_stage, SMOOTHING_ITERATIONS,
+                                              memory_budget_mb),
+        # Halo in slices along the streamed axis for the Gaussian footprint
+        lambda source, path: stream_filter(source, path, image_type, lambda slab: gradient_stage(slab, sigma), halo,
+                                           memory_budget_mb),
+        lambda source, path: stream_filter(source, path, image_type, lambda slab: sigmoid_stage(slab, alpha, beta), 0,
+                                           memory_budget_mb),
+    ]
+
+    paths = []
+    source_path = input_path
+    for key, stream in zip(keys, stages):
+        path = cache.path(key)
+        if os.path.exists(path):
+            cache.hits += 1
+        else:
+            cache.misses += 1
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp.mha"
+            stream(source_path, tmp_path)
+            os.replace(tmp_path, path)
+        paths.append(path)
+        source_path = path
+    return paths
+
+
+def speed_image_stages(input_path, image_type, sigma, alpha, beta, cache, memory_budget_mb=None, region=None,
+                       input_region=None):
+    """Return (smoothing, gradient, sigmoid) images cropped to region.
+
+    With a memory budget the stages are streamed to the disk cache and only
+    the region is read back; otherwise they are computed in memory. With an
+    input region the stages only ever see that crop of the input.
+    """
+    if input_region is not None:
+        return compute_speed_image(input_path, image_type, sigma, alpha, beta, cache, input_region, memory_budget_mb)
+    if memory_budget_mb:
+        paths = compute_speed_image_streamed(input_path, image_type, sigma, alpha, beta, cache, memory_budget_mb)
+        return tuple(read_region(path, image_type, region) for path in paths)
+    stages = compute_speed_image(input_path, image_type, sigma, alpha, beta, cache)
+    return tuple(extract_region(image, region) for image in stages)
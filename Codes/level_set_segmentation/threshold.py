@@ -1,31 +1,56 @@
 import itk
 import argparse
+import os
+import sys
+
+from level_set_monitor import add_monitor_arguments, monitor_from_args, report
+from level_set_pyramid import add_pyramid_arguments, evolve_pyramid
+from volume_streaming import add_volume_arguments, parse_region, read_region, seed_index, set_fast_marching_geometry, volume_output_path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'common'))
+from pipeline_profiler import add_profiler_arguments, profiler_from_args
+
+def threshold_segmentation_filter(initial_level_set, feature_image, lower_threshold, upper_threshold, number_of_iterations=1500):
+    InternalImageType = type(feature_image)
+    threshold_segmentation = itk.ThresholdSegmentationLevelSetImageFilter[InternalImageType, InternalImageType, itk.F].New()
+    threshold_segmentation.SetInput(initial_level_set)
+    threshold_segmentation.SetFeatureImage(feature_image)
+    threshold_segmentation.SetPropagationScaling(1.0)
+    threshold_segmentation.SetCurvatureScaling(1.0)
+    threshold_segmentation.SetUpperThreshold(upper_threshold)
+    threshold_segmentation.SetLowerThreshold(lower_threshold)
+    threshold_segmentation.SetIsoSurfaceValue(0.0)
+    threshold_segmentation.SetMaximumRMSError(0.02)
+    threshold_segmentation.SetNumberOfIterations(number_of_iterations)
+    return threshold_segmentation
 
 # Argument parser setup with flags
 def main():
     parser = argparse.ArgumentParser(description="ITK Geodesic active contour Segmentation with Smoothing, Gradient, and Sigmoid Filters.")
     parser.add_argument("-x", "--seedX", type=int, required=True, help="X coordinate of the seed point.")
     parser.add_argument("-y", "--seedY", type=int, required=True, help="Y coordinate of the seed point.")
+    parser.add_argument("-z", "--seedZ", type=int, default=0, help="Z coordinate of the seed point (3D only).")
     parser.add_argument("-d", "--initial_distance", type=float, required=True, help="Stopping value for fast marching.")
     parser.add_argument("-l", "--lower_threshold", type=float, required=True, help="Lower threshold value for the threshold filter.")
     parser.add_argument("-u", "--upper_threshold", type=float, required=True, help="Upper threshold value for the threshold filter.")
+    parser.add_argument("-n", "--max_iterations", type=int, default=1500, help="Iteration budget for the threshold level set filter.")
+    add_monitor_arguments(parser)
+    add_pyramid_arguments(parser)
+    add_volume_arguments(parser, streaming=False)
+    add_profiler_arguments(parser)
 
     args = parser.parse_args()
-
-    # Input and output paths
-    input_path = './data/BrainProtonDensitySlice.png'
-    thresholded_output_path = './output/Threshold/BrainProtonDensitySliceThreshold.png'
+    profiler = profiler_from_args(args)
 
     #define input types
     InternalPixelType = itk.F
-    Dimension = 2
+    Dimension = args.dimension
     InternalImageType = itk.Image[InternalPixelType, Dimension]
     OutputPixelType = itk.UC
     OutputImageType = itk.Image[OutputPixelType, Dimension]
 
-    # Reader
-    reader = itk.ImageFileReader[InternalImageType].New()
-    reader.SetFileName(input_path)
+    # Input and output paths
+    input_path = args.input
+    thresholded_output_path = volume_output_path('./output/Threshold/BrainProtonDensitySliceThreshold.png', Dimension)
 
     # writer
     writer = itk.ImageFileWriter[OutputImageType].New()
@@ -41,7 +66,7 @@ def main():
     # Initializing seeds
     NodeContainer = itk.VectorContainer[itk.UI, itk.LevelSetNode[itk.F, Dimension]].New()
     seeds = NodeContainer.New()
-    seedPosition = [args.seedX, args.seedY]
+    seedPosition = seed_index(args, Dimension)
 
     node = itk.LevelSetNode[itk.F, Dimension]()
     node.SetValue(-args.initial_distance)
@@ -54,33 +79,32 @@ def main():
     fast_marching.SetTrialPoints(seeds)
     fast_marching.SetSpeedConstant(1.0)
 
-    # ThresholdSegmentationLevelSetImageFilter
-    threshold_segmentation = itk.ThresholdSegmentationLevelSetImageFilter[InternalImageType, InternalImageType, InternalPixelType].New()
-
-    threshold_segmentation.SetPropagationScaling(1.0)
-    threshold_segmentation.SetCurvatureScaling(1.0)
-    threshold_segmentation.SetUpperThreshold(args.upper_threshold)
-    threshold_segmentation.SetLowerThreshold(args.lower_threshold)
-    threshold_segmentation.SetIsoSurfaceValue(0.0)
-    threshold_segmentation.SetMaximumRMSError(0.02)
-    threshold_segmentation.SetNumberOfIterations(1500)
-
-    threshold_segmentation.SetInput(fast_marching.GetOutput())
-    threshold_segmentation.SetFeatureImage(reader.GetOutput())
-    threshold.SetInput(threshold_segmentation.GetOutput())
-    writer.SetInput(threshold.GetOutput())
-
     try:
-        reader.Update()
-        input_image = reader.GetOutput()
-        fast_marching.SetOutputRegion(input_image.GetBufferedRegion())
-        fast_marching.SetOutputSpacing(input_image.GetSpacing())
-        fast_marching.SetOutputOrigin(input_image.GetOrigin())
-        fast_marching.SetOutputDirection(input_image.GetDirection())
+        # Only the --roi region of the input is read when one is given
+        input_image = read_region(input_path, InternalImageType, parse_region(args.roi, Dimension))
+        set_fast_marching_geometry(fast_marching, input_image)
+
+        # ThresholdSegmentationLevelSetImageFilter
+        def make_threshold_segmentation(initial, feature, number_of_iterations):
+            return threshold_segmentation_filter(initial, feature, args.lower_threshold, args.upper_threshold,
+                                                 number_of_iterations=number_of_iterations)
+        if args.pyramid_levels > 1:
+            fast_marching.Update()
+            threshold_segmentation, monitor = evolve_pyramid(make_threshold_segmentation, fast_marching.GetOutput(), input_image,
+                                                             args.pyramid_levels, args.max_iterations, args.refine_iterations,
+                                                             args, "Threshold segmentation")
+        else:
+            threshold_segmentation = make_threshold_segmentation(fast_marching.GetOutput(), input_image, args.max_iterations)
+            monitor = monitor_from_args(threshold_segmentation, args)
+
+        threshold.SetInput(threshold_segmentation.GetOutput())
+        writer.SetInput(threshold.GetOutput())
         writer.Update()
+        report(monitor, args, "Threshold segmentation")
         print("Thresholding completed successfully.")
     except Exception as e:
         print("Exception caught while thresholding!", str(e))
+    profiler.report()
         
 
 
@@ -0,0 +1,317 @@
+# Dimension-generic input handling and slab-streamed execution for the
+# level-set scripts.
+#
+# Point-wise and local filters (gradient magnitude, sigmoid, thresholds) are
+# run slab by slab along the last image axis. Each slab is read with a halo
+# wide enough for the filter footprint, filtered, trimmed back to its core and
+# written straight into an uncompressed MetaImage on disk, so peak memory
+# follows --memory_budget instead of the volume size. Stages that need the
+# whole domain at once (fast marching and the level-set evolutions) read back
+# only the region of interest given by --roi.
+#
+# Anisotropic diffusion is not local: ITK scales the conductance by the
+# average gradient magnitude of the whole image, re-estimated every
+# iteration, so slabs diffused on their own would each be normalized
+# differently whatever their halo. stream_diffusion() therefore runs one
+# iteration per pass. A streamed pass first measures the average gradient
+# magnitude of the current image, and every slab's filter is handed that
+# value through SetFixedAverageGradientMagnitude, which makes the result
+# equal to the whole-volume filter's.
+
+import math
+import os
+
+import numpy as np
+import itk
+
+# MetaImage element types and NumPy dtypes for the pixel types the scripts use
+_META_TYPES = {
+    'F': ('MET_FLOAT', np.float32),
+    'UC': ('MET_UCHAR', np.uint8),
+    'SS': ('MET_SHORT', np.int16),
+    'US': ('MET_USHORT', np.uint16),
+}
+
+# Full-volume float buffers alive at once inside the heaviest streamed stage
+DEFAULT_BUFFER_COPIES = 6
+
+
+def add_volume_arguments(parser, default_input='./data/BrainProtonDensitySlice.png', streaming=True):
+    parser.add_argument("--input", default=default_input, help="Input image; 3D inputs should be uncompressed .mha/.nrrd so slabs can be read on their own.")
+    parser.add_argument("--dimension", type=int, choices=[2, 3], default=2, help="Image dimension of the pipeline.")
+    if streaming:
+        parser.add_argument("--memory_budget", type=float, help="Stream the smoothing, gradient and sigmoid stages in slabs that fit this many MB.")
+    parser.add_argument("--roi", type=int, nargs='+', metavar='N', help="Region of interest as start indices followed by sizes, e.g. x y z sx sy sz.")
+
+
+def add_auto_roi_arguments(parser, radius_help):
+    parser.add_argument("--auto_roi", action="store_true", help="Run the whole chain on a box around the seeds only and paste the result into a full-size output.")
+    parser.add_argument("--roi_radius", type=float, help=radius_help)
+
+
+def volume_output_path(path, dimension):
+    # PNG holds 2D images only, 3D outputs are written as NRRD next to them
+    root, ext = os.path.splitext(path)
+    return root + '.nrrd' if dimension > 2 and ext.lower() == '.png' else path
+
+
+def seed_index(args, dimension):
+    return [args.seedX, args.seedY, getattr(args, 'seedZ', 0)][:dimension]
+
+
+def make_region(index, size):
+    region = itk.ImageRegion[len(index)]()
+    region.SetIndex([int(i) for i in index])
+    region.SetSize([int(s) for s in size])
+    return region
+
+
+def parse_region(values, dimension):
+    if values is None:
+        return None
+    if len(values) != 2 * dimension:
+        raise ValueError(f"--roi needs {2 * dimension} values for a {dimension}D image, got {len(values)}.")
+    return make_region(values[:dimension], values[dimension:])
+
+
+def read_image_information(path, image_type):
+    reader = itk.ImageFileReader[image_type].New()
+    reader.SetFileName(path)
+    reader.UpdateOutputInformation()
+    return reader.GetOutput()
+
+
+def read_region(path, image_type, region=None):
+    # ExtractImageFilter keeps the start index, so seeds and physical
+    # coordinates stay valid in the cropped image
+    reader = itk.ImageFileReader[image_type].New()
+    reader.SetFileName(path)
+    if region is None:
+        reader.Update()
+        image = reader.GetOutput()
+    else:
+        reader.UpdateOutputInformation()
+        region = clip_region(region, reader.GetOutput().GetLargestPossibleRegion())
+        extract = itk.ExtractImageFilter[image_type, image_type].New()
+        extract.SetInput(reader.GetOutput())
+        extract.SetExtractionRegion(region)
+        extract.SetDirectionCollapseToSubmatrix()
+        extract.Update()
+        image = extract.GetOutput()
+    image.DisconnectPipeline()
+    return image
+
+
+def extract_region(image, region):
+    if region is None:
+        return image
+    image_type = type(image)
+    extract = itk.ExtractImageFilter[image_type, image_type].New()
+    extract.SetInput(image)
+    extract.SetExtractionRegion(clip_region(region, image.GetLargestPossibleRegion()))
+    extract.SetDirectionCollapseToSubmatrix()
+    extract.Update()
+    output = extract.GetOutput()
+    output.DisconnectPipeline()
+    return output
+
+
+def clip_region(region, largest):
+    clipped = type(region)(region)
+    if not clipped.Crop(largest):
+        raise ValueError(f"Region {region} lies outside the image region {largest}.")
+    return clipped
+
+
+def set_fast_marching_geometry(fast_marching, reference_image):
+    fast_marching.SetOutputRegion(reference_image.GetBufferedRegion())
+    fast_marching.SetOutputSpacing(reference_image.GetSpacing())
+    fast_marching.SetOutputOrigin(reference_image.GetOrigin())
+    fast_marching.SetOutputDirection(reference_image.GetDirection())
+
+
+def seed_region(reference_image, seeds, radius, margin):
+    # Box around the seeds reaching radius (physical units) plus margin pixels
+    # on every axis, clipped to the image
+    spacing = reference_image.GetSpacing()
+    dimension = reference_image.GetImageDimension()
+    lower, upper = [], []
+    for d in range(dimension):
+        reach = int(math.ceil(radius / spacing[d])) + margin[d]
+        lower.append(min(seed[d] for seed in seeds) - reach)
+        upper.append(max(seed[d] for seed in seeds) + reach)
+    region = make_region(lower, [u - l + 1 for l, u in zip(lower, upper)])
+    return clip_region(region, reference_image.GetLargestPossibleRegion())
+
+
+def image_geometry(image):
+    # Plain-Python copy of the grid of an image, so it can be handed to worker processes
+    largest = image.GetLargestPossibleRegion()
+    return {
+        'index': list(largest.GetIndex()),
+        'size': list(largest.GetSize()),
+        'spacing': list(image.GetSpacing()),
+        'origin': list(image.GetOrigin()),
+        'direction': itk.array_from_matrix(image.GetDirection()).tolist(),
+    }
+
+
+def paste_region(image, geometry, background=0):
+    """Return a full-size image on the grid of geometry holding image in its own region and background elsewhere."""
+    region = image.GetBufferedRegion()
+    if list(region.GetIndex()) == geometry['index'] and list(region.GetSize()) == geometry['size']:
+        return image
+
+    full = type(image).New()
+    full.SetRegions(make_region(geometry['index'], geometry['size']))
+    full.SetSpacing(geometry['spacing'])
+    full.SetOrigin(geometry['origin'])
+    full.SetDirection(itk.matrix_from_array(np.array(geometry['direction'], dtype=np.float64)))
+    full.Allocate()
+    full.FillBuffer(background)
+
+    # Both images share one index space; NumPy views are indexed [z, y, x]
+    start = [i - j for i, j in zip(region.GetIndex(), geometry['index'])]
+    window = tuple(slice(b, b + n) for b, n in zip(reversed(start), reversed(list(region.GetSize()))))
+    itk.array_view_from_image(full)[window] = itk.array_view_from_image(image)
+    return full
+
+
+def slab_thickness(size, halo, memory_budget_mb, bytes_per_pixel=4, copies=DEFAULT_BUFFER_COPIES):
+    slice_bytes = bytes_per_pixel * copies * int(np.prod(size[:-1]))
+    slices = int(memory_budget_mb * 2**20 // slice_bytes) - 2 * halo
+    if slices < 1:
+        print(f"Memory budget of {memory_budget_mb} MB is below one slab with a {halo}-slice halo; streaming single slices.")
+        slices = 1
+    return min(slices, size[-1])
+
+
+def create_mha(path, reference_image, pixel_type):
+    # Uncompressed MetaImage with the pixel data right after the header, so the
+    # payload can be filled through a memory map and read back region by region
+    element_type, dtype = _META_TYPES[_pixel_code(pixel_type)]
+    size = list(reference_image.GetLargestPossibleRegion().GetSize())
+    direction = itk.array_from_matrix(reference_image.GetDirection())
+    header = "\n".join([
+        "ObjectType = Image",
+        f"NDims = {len(size)}",
+        "BinaryData = True",
+        "BinaryDataByteOrderMSB = False",
+        "CompressedData = False",
+        "TransformMatrix = " + " ".join(repr(float(v)) for v in direction.T.ravel()),
+        "Offset = " + " ".join(repr(float(v)) for v in _start_origin(reference_image)),
+        "ElementSpacing = " + " ".join(repr(float(v)) for v in reference_image.GetSpacing()),
+        "DimSize = " + " ".join(str(s) for s in size),
+        f"ElementType = {element_type}",
+        "ElementDataFile = LOCAL",
+    ]) + "\n"
+    with open(path, 'wb') as f:
+        f.write(header.encode('ascii'))
+    return np.memmap(path, dtype=dtype, mode='r+', offset=len(header), shape=tuple(reversed(size)))
+
+
+def _pixel_code(pixel_type):
+    for code in _META_TYPES:
+        if getattr(itk, code) == pixel_type:
+            return code
+    raise ValueError(f"Unsupported pixel type for streamed output: {pixel_type}")
+
+
+def _start_origin(image):
+    # Physical position of the first pixel of the largest possible region
+    start = image.GetLargestPossibleRegion().GetIndex()
+    return image.TransformIndexToPhysicalPoint(start)
+
+
+def _slabs(input_path, image_type, halo, memory_budget_mb, copies=DEFAULT_BUFFER_COPIES):
+    # Yields (core_start, core_stop, slab_start, slab) along the last axis, each slab read with its halo
+    info = read_image_information(input_path, image_type)
+    largest = info.GetLargestPossibleRegion()
+    size = list(largest.GetSize())
+    start = list(largest.GetIndex())
+    thickness = slab_thickness(size, halo, memory_budget_mb, copies=copies)
+
+    reader = itk.ImageFileReader[image_type].New()
+    reader.SetFileName(input_path)
+    extract = itk.ExtractImageFilter[image_type, image_type].New()
+    extract.SetInput(reader.GetOutput())
+    extract.SetDirectionCollapseToSubmatrix()
+
+    for core_start in range(0, size[-1], thickness):
+        core_stop = min(core_start + thickness, size[-1])
+        slab_start = max(core_start - halo, 0)
+        slab_stop = min(core_stop + halo, size[-1])
+
+        extract.SetExtractionRegion(make_region(start[:-1] + [start[-1] + slab_start],
+                                                size[:-1] + [slab_stop - slab_start]))
+        extract.UpdateLargestPossibleRegion()
+        yield core_start, core_stop, slab_start, extract.GetOutput()
+
+
+def stream_filter(input_path, output_path, image_type, pipeline, halo, memory_budget_mb,
+                  output_pixel_type=itk.F, copies=DEFAULT_BUFFER_COPIES):
+    """Run pipeline(slab) slab by slab from input_path into an uncompressed .mha at output_path.
+
+    pipeline must be local: its output within the slab's core may only depend on pixels at most halo slices away.
+    """
+    payload = create_mha(output_path, read_image_information(input_path, image_type), output_pixel_type)
+    for core_start, core_stop, slab_start, slab in _slabs(input_path, image_type, halo, memory_budget_mb, copies):
+        output = itk.array_view_from_image(pipeline(slab))
+        payload[core_start:core_stop] = output[core_start - slab_start:core_stop - slab_start]
+
+    payload.flush()
+    del payload
+    return output_path
+
+
+def average_gradient_magnitude(input_path, image_type, memory_budget_mb):
+    """Average gradient magnitude of an image as the anisotropic diffusion filters estimate it, streamed in slabs.
+
+    This is the root mean square of the central differences (divided by the spacing), with the
+    image edges repeated, over every pixel of the image.
+    """
+    spacing = list(read_image_information(input_path, image_type).GetSpacing())[::-1]
+    total = 0.0
+    count = 0
+    for core_start, core_stop, slab_start, slab in _slabs(input_path, image_type, 1, memory_budget_mb):
+        view = itk.array_view_from_image(slab)
+        core = slice(core_start - slab_start, core_stop - slab_start)
+        for axis in range(view.ndim):
+            padded = np.concatenate([view.take([0], axis), view, view.take([-1], axis)], axis=axis).astype(np.float64)
+            upper = [slice(None)] * view.ndim
+            lower = [slice(None)] * view.ndim
+            upper[axis], lower[axis] = slice(2, None), slice(0, -2)
+            difference = (padded[tuple(upper)] - padded[tuple(lower)]) / (2.0 * spacing[axis])
+            # Halo slices only supply neighbours; the NumPy axis 0 is the streamed one
+            total += float(np.sum(difference[core] ** 2))
+        count += view[core].size
+    return math.sqrt(total / count)
+
+
+def stream_diffusion(input_path, output_path, image_type, diffuse, number_of_iterations, memory_budget_mb):
+    """Stream number_of_iterations of an anisotropic diffusion from input_path into an .mha at output_path.
+
+    diffuse(slab, number_of_iterations, average_gradient_magnitude) runs the diffusion filter with
+    its average gradient magnitude fixed. Each iteration is one pass over the volume with a one-slice
+    halo, after a pass that measures the average gradient magnitude of the current image, so the
+    output equals that of the filter run on the whole volume.
+    """
+    source_path = input_path
+    for iteration in range(number_of_iterations):
+        magnitude = average_gradient_magnitude(source_path, image_type, memory_budget_mb)
+        pass_path = f"{output_path}.{iteration % 2}.tmp.mha"
+        stream_filter(source_path, pass_path, image_type,
+                      lambda slab: diffuse(slab, 1, magnitude), 1, memory_budget_mb)
+        if source_path != input_path:
+            os.remove(source_path)
+        source_path = pass_path
+    if source_path == input_path:
+        return stream_filter(input_path, output_path, image_type, lambda slab: slab, 0, memory_budget_mb)
+    os.replace(source_path, output_path)
+    return output_path
+
+
+def gaussian_halo(sigma, image):
+    # Slices needed on either side for a recursive Gaussian along the streamed axis; its
+    # infinite tail still shifts gradient magnitudes by ~1e-3 of their range at 4 sigma
+    return int(math.ceil(6.0 * sigma / image.GetSpacing()[image.GetImageDimension() - 1])) + 1